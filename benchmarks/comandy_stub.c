@@ -0,0 +1,38 @@
+/*
+ * libcomandy的替身 和真的导出同样的request/add_dns 不联网
+ * 固定返回200和"hello"，COMANDY_STUB_DELAY_MS 模拟网络延迟
+ *
+ * gcc -O2 -shared -fPIC -o libcomandy_stub.so benchmarks/comandy_stub.c
+ * 然后 TLSCHEAT_LIBRARY = "/path/to/libcomandy_stub.so"
+ */
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+static const char RESPONSE[] =
+    "{\"status\":200,\"headers\":{\"Content-Type\":[\"text/plain\"]},"
+    "\"data\":\"hello\"}";
+
+static char *copy(const char *s) {
+    size_t n = strlen(s) + 1;
+    char *ret = malloc(n);
+    if (ret != NULL) {
+        memcpy(ret, s, n);
+    }
+    return ret;
+}
+
+char *request(char *payload) {
+    const char *delay = getenv("COMANDY_STUB_DELAY_MS");
+    (void)payload;
+    if (delay != NULL) {
+        usleep((useconds_t)atoi(delay) * 1000);
+    }
+    return copy(RESPONSE);
+}
+
+char *add_dns(char *host, int port) {
+    (void)host;
+    (void)port;
+    return NULL;
+}
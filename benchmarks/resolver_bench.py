@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+resolver.py 的压测
+本地起一个udp dns和一个doh服务器，可以设置延迟 丢包 ttl，然后按不同的域名分布去查
+
+在仓库根目录运行
+python -m benchmarks.resolver_bench --resolver aiodns --workload zipf
+python -m benchmarks.resolver_bench --resolver doh-wire --workload burst --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import struct
+import time
+import tracemalloc
+import zlib
+from typing import List, Tuple
+
+from aiohttp import web
+
+from resolver import (
+    QTYPE_A,
+    QTYPE_AAAA,
+    CachingAsyncDohResolver,
+    CachingAsyncResolver,
+    DNSCache,
+)
+
+
+def fake_address(name: str, qtype: int) -> str:
+    """
+    同一个域名永远给同一个地址
+    """
+    h = zlib.crc32(name.encode())
+    if qtype == QTYPE_AAAA:
+        return "2001:db8::{:x}:{:x}".format(h >> 16, h & 0xFFFF)
+    return "10.{}.{}.{}".format((h >> 16) & 0xFF, (h >> 8) & 0xFF, h & 0xFF)
+
+
+def parse_question(data: bytes) -> Tuple[int, str, int, int]:
+    """
+    返回 (id, name, qtype, 问题段结束的位置)
+    """
+    qid = struct.unpack_from("!H", data)[0]
+    offset = 12
+    labels = []
+    while data[offset]:
+        length = data[offset]
+        labels.append(data[offset + 1 : offset + 1 + length].decode())
+        offset += length + 1
+    offset += 1
+    qtype = struct.unpack_from("!H", data, offset)[0]
+    return qid, ".".join(labels), qtype, offset + 4
+
+
+class Upstream:
+    """
+    假的权威服务器，nx开头的域名返回NXDOMAIN
+    """
+
+    def __init__(self, latency: float = 0.0, loss: float = 0.0, ttl: int = 300):
+        self.latency = latency
+        self.loss = loss
+        self.ttl = ttl
+        self.queries = 0
+
+    def answer(self, name: str, qtype: int) -> Tuple[int, List[str]]:
+        if name.startswith("nx"):
+            return 3, []
+        return 0, [fake_address(name, qtype)]
+
+    def wire_response(self, query: bytes) -> bytes:
+        qid, name, qtype, end = parse_question(query)
+        rcode, addresses = self.answer(name, qtype)
+        family = socket.AF_INET6 if qtype == QTYPE_AAAA else socket.AF_INET
+        body = query[12:end]
+        for address in addresses:
+            rdata = socket.inet_pton(family, address)
+            body += b"\xc0\x0c" + struct.pack("!HHIH", qtype, 1, self.ttl, len(rdata))
+            body += rdata
+        return struct.pack("!HHHHHH", qid, 0x8180 | rcode, 1, len(addresses), 0, 0) + body
+
+
+class UDPStub(asyncio.DatagramProtocol):
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.upstream.queries += 1
+        if random.random() < self.upstream.loss:
+            return
+        response = self.upstream.wire_response(data)
+        if self.upstream.latency:
+            asyncio.get_running_loop().call_later(
+                self.upstream.latency, self.transport.sendto, response, addr
+            )
+        else:
+            self.transport.sendto(response, addr)
+
+
+def doh_app(upstream: Upstream) -> web.Application:
+    async def drop_or_wait():
+        upstream.queries += 1
+        if random.random() < upstream.loss:
+            await asyncio.sleep(3600)  # 丢包就让客户端等到超时
+        if upstream.latency:
+            await asyncio.sleep(upstream.latency)
+
+    async def resolve_json(request: web.Request):
+        await drop_or_wait()
+        name = request.query["name"]
+        qtype = QTYPE_AAAA if request.query.get("type") == "AAAA" else QTYPE_A
+        rcode, addresses = upstream.answer(name, qtype)
+        data = {"Status": rcode}
+        if addresses:
+            data["Answer"] = [
+                {"name": name, "type": qtype, "TTL": upstream.ttl, "data": address}
+                for address in addresses
+            ]
+        return web.Response(text=json.dumps(data), content_type="application/dns-json")
+
+    async def resolve_wire(request: web.Request):
+        await drop_or_wait()
+        return web.Response(
+            body=upstream.wire_response(await request.read()),
+            content_type="application/dns-message",
+        )
+
+    app = web.Application()
+    app.router.add_get("/resolve", resolve_json)
+    app.router.add_post("/dns-query", resolve_wire)
+    return app
+
+
+def workload(kind: str, lookups: int, hosts: int, zipf_s: float) -> List[str]:
+    """
+    zipf 少数热门域名占大头
+    burst 全部查同一个域名
+    cold 每个域名只查一次
+    """
+    if kind == "burst":
+        return ["burst.bench.test"] * lookups
+    if kind == "cold":
+        return ["h{}.bench.test".format(i) for i in range(lookups)]
+    weights = [1 / (rank**zipf_s) for rank in range(1, hosts + 1)]
+    names = ["h{}.bench.test".format(i) for i in range(hosts)]
+    return random.choices(names, weights, k=lookups)
+
+
+async def drive(resolver, names: List[str], concurrency: int) -> List[float]:
+    latencies = []
+    queue = iter(names)
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for name in queue:
+            start = time.perf_counter()
+            try:
+                await resolver.resolve_all(name, 5)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    if errors:
+        print("errors: {}".format(errors))
+    return latencies
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+async def main(args):
+    upstream = Upstream(args.latency, args.loss, args.ttl)
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPStub(upstream), local_addr=("127.0.0.1", 0)
+    )
+    dns_port = transport.get_extra_info("sockname")[1]
+    runner = web.AppRunner(doh_app(upstream))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    doh_port = site._server.sockets[0].getsockname()[1]
+
+    dns_cache = DNSCache(args.cache_size)
+    if args.resolver == "aiodns":
+        resolver = CachingAsyncResolver(
+            None,
+            args.cache_size,
+            5,
+            ["127.0.0.1:{}".format(dns_port)],
+            dns_cache,
+            tries=1,
+        )
+    else:
+        wire = args.resolver == "doh-wire"
+        resolver = CachingAsyncDohResolver(
+            None,
+            args.cache_size,
+            5,
+            [
+                "http://127.0.0.1:{}/{}".format(
+                    doh_port, "dns-query" if wire else "resolve"
+                )
+            ],
+            dns_cache=dns_cache,
+            wire_format=wire,
+        )
+
+    names = workload(args.workload, args.lookups, args.hosts, args.zipf)
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    latencies = await drive(resolver, names, args.concurrency)
+    elapsed = time.perf_counter() - start
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(
+        "{} {} lookups={} hosts={} concurrency={}".format(
+            args.resolver, args.workload, len(names), len(set(names)), args.concurrency
+        )
+    )
+    print("lookups/s        {:.0f}".format(len(latencies) / elapsed))
+    print("p50              {:.3f} ms".format(percentile(latencies, 0.5) * 1000))
+    print("p99              {:.3f} ms".format(percentile(latencies, 0.99) * 1000))
+    print("upstream/lookup  {:.4f}".format(upstream.queries / len(latencies)))
+    print("cache entries    {}".format(len(dns_cache)))
+    if args.trace_memory:
+        print("peak memory      {:.1f} KiB".format(peak / 1024))
+
+    if args.resolver != "aiodns":
+        if resolver._client_session is not None:
+            await resolver._client_session.close()
+        if resolver._h2_client is not None:
+            await resolver._h2_client.aclose()
+    transport.close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--resolver", choices=["aiodns", "doh", "doh-wire"], default="aiodns"
+    )
+    parser.add_argument(
+        "--workload", choices=["zipf", "burst", "cold"], default="zipf"
+    )
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--hosts", type=int, default=2000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--cache-size", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.005, help="秒")
+    parser.add_argument("--loss", type=float, default=0.0, help="0~1")
+    parser.add_argument("--ttl", type=int, default=300)
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="用tracemalloc统计内存峰值 会拖慢吞吐",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+tlsproxy的替身 不联网 json接口和ws二进制帧接口都有
+body是固定的字节 url里?size=N指定大小 默认--body-size
+body超过--chunk-size就用FRAME_BODY分段发 段之间等--chunk-delay 收到FRAME_CANCEL就不发了
+make_app传了cancelled列表的话 被取消的请求id记在里面
+
+在仓库根目录运行
+python -m benchmarks.tlsproxy_stub --port 11000 --delay 0.01
+然后 TLSPROXY_TRANSPORT = "ws"
+"""
+import argparse
+import asyncio
+import base64
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from aiohttp import web
+
+from downloadhandlers.tlsproxy import (
+    FRAME_BODY,
+    FRAME_CANCEL,
+    FRAME_REQUEST,
+    FRAME_RESPONSE,
+    decode_frame,
+    encode_frame,
+)
+
+
+def make_body(url: str, default_size: int) -> bytes:
+    query = parse_qs(urlsplit(url).query)
+    size = int(query.get("size", [default_size])[0])
+    return b"x" * size
+
+
+def make_app(args, cancelled: Optional[List[int]] = None) -> web.Application:
+    async def json_request(request: web.Request):
+        data = await request.json()
+        await asyncio.sleep(args.delay)
+        body = make_body(data["url"], args.body_size)
+        return web.json_response(
+            {
+                "status": 200,
+                "headers": {"Content-Type": ["text/plain"]},
+                "body": base64.b64encode(body).decode(),
+            }
+        )
+
+    async def ws_handler(request: web.Request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        tasks = {}  # type: Dict[int, asyncio.Task]
+
+        async def respond(stream_id: int, meta: dict):
+            await asyncio.sleep(args.delay)
+            body = make_body(meta["url"], args.body_size)
+            head = {
+                "status": 200,
+                "headers": {"Content-Type": ["text/plain"]},
+                "url": meta["url"],
+                "length": len(body),
+                "more": len(body) > args.chunk_size,
+            }
+            await ws.send_bytes(
+                encode_frame(stream_id, FRAME_RESPONSE, head, body[: args.chunk_size])
+            )
+            for start in range(args.chunk_size, len(body), args.chunk_size):
+                end = start + args.chunk_size
+                more = {"more": end < len(body)}
+                await asyncio.sleep(args.chunk_delay)
+                await ws.send_bytes(
+                    encode_frame(stream_id, FRAME_BODY, more, body[start:end])
+                )
+
+        async for message in ws:
+            stream_id, kind, meta, _ = decode_frame(message.data)
+            if kind == FRAME_REQUEST:
+                task = asyncio.ensure_future(respond(stream_id, meta))
+                tasks[stream_id] = task
+                task.add_done_callback(lambda _, i=stream_id: tasks.pop(i, None))
+            elif kind == FRAME_CANCEL and stream_id in tasks:
+                tasks[stream_id].cancel()
+                if cancelled is not None:
+                    cancelled.append(stream_id)
+        for task in list(tasks.values()):
+            task.cancel()
+        return ws
+
+    app = web.Application()
+    app.router.add_post("/request", json_request)
+    app.router.add_get("/ws", ws_handler)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11000)
+    parser.add_argument("--delay", type=float, default=0, help="每个请求的延迟 秒")
+    parser.add_argument("--body-size", type=int, default=1024)
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024)
+    parser.add_argument("--chunk-delay", type=float, default=0, help="每段body之间的延迟 秒")
+    args = parser.parse_args()
+    web.run_app(make_app(args), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
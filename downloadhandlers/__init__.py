@@ -1,3 +1,5 @@
 # -*- coding: utf-8 -*-
 from .http2 import HttpxDownloadHandler
 from .ja3 import Ja3DownloadHandler
+from .replay import ReplayDownloadHandler
+from .router import RouterDownloadHandler
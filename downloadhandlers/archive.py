@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+下载记录归档 RouterDownloadHandler录 ReplayDownloadHandler放
+
+文件格式 只追加
+xxx.log  一条一条的记录 FRAME_HEADER(请求指纹20字节, 压缩后长度) + zlib(RECORD_HEADER(meta长度) + meta json + body)
+xxx.log.idx  FRAME_INDEX(请求指纹, 偏移, 长度) 放的时候直接mmap读log 不用把整个log解一遍
+idx没写完(进程被杀之类的)就从log里最后一条有索引的记录往后扫一遍补上
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+from scrapy.http import Headers, Request, Response
+from scrapy.responsetypes import responsetypes
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct("!20sI")
+FRAME_INDEX = struct.Struct("!20sQI")
+RECORD_HEADER = struct.Struct("!I")
+
+
+def request_key(crawler, request: Request) -> bytes:
+    """scrapy的请求指纹 统一成20字节"""
+    fingerprinter = getattr(crawler, "request_fingerprinter", None)
+    if fingerprinter is not None:
+        key = fingerprinter.fingerprint(request)
+    else:  # scrapy < 2.7
+        from scrapy.utils.request import request_fingerprint
+
+        key = bytes.fromhex(request_fingerprint(request))
+    if len(key) != 20:
+        key = hashlib.sha1(key).digest()
+    return key
+
+
+def encode_record(request: Request, response: Response, backend: str) -> bytes:
+    protocol = getattr(response, "protocol", None)
+    if protocol is not None and not isinstance(protocol, str):  # aiohttp的HttpVersion
+        protocol = "HTTP/{}.{}".format(*protocol)
+    meta = {
+        "method": request.method,
+        "request_url": request.url,
+        "url": response.url,
+        "status": response.status,
+        "headers": [
+            [key.decode("latin-1"), value.decode("latin-1")]
+            for key, values in response.headers.items()
+            for value in values
+        ],
+        "flags": response.flags,
+        "protocol": protocol,
+        "backend": backend,
+        "time": time.time(),
+    }
+    data = json.dumps(meta).encode("utf-8")
+    return RECORD_HEADER.pack(len(data)) + data + response.body
+
+
+def decode_record(data: bytes) -> Tuple[dict, bytes]:
+    (size,) = RECORD_HEADER.unpack_from(data)
+    end = RECORD_HEADER.size + size
+    return json.loads(data[RECORD_HEADER.size : end]), data[end:]
+
+
+class ArchiveWriter:
+    """
+    压缩和写文件都在一个专门的线程里 按提交的顺序追加
+    writer.write(key, record)  不阻塞
+    writer.close()  阻塞 等剩下的都写完
+    """
+
+    def __init__(self, path: str, level: int = 6):
+        self.path = path
+        self.level = level
+        self._log = open(path, "ab")
+        self._index = open(path + ".idx", "ab")
+        self._offset = self._log.seek(0, os.SEEK_END)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="archive")
+        self.count = 0
+
+    def write(self, key: bytes, record: bytes):
+        self._executor.submit(self._write, key, record)
+
+    def _write(self, key: bytes, record: bytes):
+        try:
+            data = zlib.compress(record, self.level)
+            self._log.write(FRAME_HEADER.pack(key, len(data)))
+            self._log.write(data)
+            self._index.write(FRAME_INDEX.pack(key, self._offset, len(data)))
+            self._offset += FRAME_HEADER.size + len(data)
+            self.count += 1
+        except Exception:
+            logger.exception("Failed to write archive record to %s", self.path)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._log.close()
+        self._index.close()
+
+
+class ArchiveReader:
+    """
+    mmap打开log 同一个请求录了好几次的用最后一次
+    reader.get(key) -> (meta, body) 或者 None
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if size
+            else None
+        )
+        self.index = {}  # type: Dict[bytes, Tuple[int, int]]
+        end = self._load_index(size)
+        for key, offset, length in self._scan(end, size):  # 补上idx里没有的
+            self.index[key] = (offset, length)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key: bytes):
+        return key in self.index
+
+    def _load_index(self, size: int) -> int:
+        """返回idx覆盖到log的哪里"""
+        end = 0
+        try:
+            with open(self.path + ".idx", "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return end
+        usable = len(data) - len(data) % FRAME_INDEX.size
+        for key, offset, length in FRAME_INDEX.iter_unpack(data[:usable]):
+            if offset + FRAME_HEADER.size + length > size:
+                break
+            self.index[key] = (offset, length)
+            end = max(end, offset + FRAME_HEADER.size + length)
+        return end
+
+    def _scan(self, offset: int, size: int) -> Iterator[Tuple[bytes, int, int]]:
+        while offset + FRAME_HEADER.size <= size:
+            key, length = FRAME_HEADER.unpack_from(self._mmap, offset)
+            if offset + FRAME_HEADER.size + length > size:  # 最后一条没写完
+                logger.warning("Truncated archive record at %s in %s", offset, self.path)
+                return
+            yield key, offset, length
+            offset += FRAME_HEADER.size + length
+
+    def get(self, key: bytes) -> Optional[Tuple[dict, bytes]]:
+        position = self.index.get(key)
+        if position is None:
+            return None
+        offset, length = position
+        start = offset + FRAME_HEADER.size
+        return decode_record(zlib.decompress(self._mmap[start : start + length]))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+def build_response(request: Request, meta: dict, body: bytes) -> Response:
+    headers = Headers()
+    for key, value in meta["headers"]:
+        headers.appendlist(key, value)
+    respcls = responsetypes.from_args(headers=headers, url=meta["url"], body=body)
+    return respcls(
+        url=meta["url"],
+        status=meta["status"],
+        headers=headers,
+        body=body,
+        flags=list(meta.get("flags") or []) + ["replay"],
+        request=request,
+        protocol=meta.get("protocol"),
+    )
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+边下边收body，和scrapy自己的http11一样遵守DOWNLOAD_MAXSIZE DOWNLOAD_WARNSIZE
+超过DOWNLOAD_MAXSIZE马上停 不用等收完
+"""
+import logging
+from typing import List, Optional, Tuple
+
+from scrapy.http import Request
+
+try:
+    from scrapy.exceptions import DownloadCancelledError
+except ImportError:  # scrapy < 2.13
+    from twisted.internet.defer import CancelledError as DownloadCancelledError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def download_limits(request: Request, settings) -> Tuple[int, int]:
+    """(maxsize, warnsize) meta里的优先 和scrapy一样"""
+    return (
+        request.meta.get("download_maxsize", settings.getint("DOWNLOAD_MAXSIZE")),
+        request.meta.get("download_warnsize", settings.getint("DOWNLOAD_WARNSIZE")),
+    )
+
+
+def _check_size(
+    request: Request,
+    size: int,
+    maxsize: int,
+    warnsize: int,
+    expected: bool = False,
+    warn: bool = True,
+) -> bool:
+    """超过maxsize抛DownloadCancelledError 返回有没有超过warnsize"""
+    kind = "expected response size" if expected else "received"
+    if maxsize and size > maxsize:
+        msg = (
+            f"Cancelling download of {request.url}: {kind} ({size}) "
+            f"larger than download max size ({maxsize})."
+        )
+        logger.warning(msg)
+        raise DownloadCancelledError(msg)
+    if warnsize and size > warnsize:
+        if warn:
+            logger.warning(
+                f"{request.url}: {kind} ({size}) larger than "
+                f"download warn size ({warnsize})."
+            )
+        return True
+    return False
+
+
+def check_size(
+    request: Request, settings, size: int, expected: bool = False, warn: bool = True
+):
+    """一次拿到整个body的后端用 DOWNLOAD_MAXSIZE DOWNLOAD_WARNSIZE"""
+    _check_size(request, size, *download_limits(request, settings), expected, warn)
+
+
+class BodyBuffer:
+    """
+    用法
+    buffer = BodyBuffer(request, settings, expected_size)  # 声明的大小就超了直接抛DownloadCancelledError
+    for chunk in ...:
+        buffer.write(chunk)  # 收到的超了也抛 调用方关掉连接就行
+    body = buffer.getvalue()
+    """
+
+    def __init__(self, request: Request, settings, expected_size: Optional[int] = None):
+        self.request = request
+        self.maxsize, self.warnsize = download_limits(request, settings)
+        self.size = 0
+        self._chunks = []  # type: List[bytes]
+        self._warned = False
+        if expected_size is not None and expected_size >= 0:
+            self._check(expected_size, expected=True)
+
+    @staticmethod
+    def expected_size(headers) -> Optional[int]:
+        try:
+            return int(headers.get("content-length"))
+        except (TypeError, ValueError):
+            return None
+
+    def _check(self, size: int, expected: bool = False):
+        try:
+            if _check_size(
+                self.request,
+                size,
+                self.maxsize,
+                self.warnsize,
+                expected,
+                warn=not self._warned,
+            ):
+                self._warned = True
+        except DownloadCancelledError:
+            self.close()
+            raise
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        self._check(self.size)
+        self._chunks.append(chunk)
+
+    def getvalue(self) -> bytes:
+        return b"".join(self._chunks)
+
+    def close(self):
+        """不要了 提前放掉收到的chunk"""
+        self._chunks = []
@@ -1,9 +1,8 @@
 import asyncio
-from functools import partial
-from typing import Optional
+from typing import Dict, List, Optional
+from urllib.parse import urldefrag
 
-from requests import Session
-from requests_curl import CURLAdapter
+import pycurl
 from scrapy import signals
 from scrapy.core.downloader.handlers.http11 import (
     HTTP11DownloadHandler as HTTPDownloadHandler,
@@ -11,23 +10,259 @@ from scrapy.core.downloader.handlers.http11 import (
 from scrapy.crawler import Crawler
 from scrapy.http import Headers, Request, Response
 from scrapy.responsetypes import responsetypes
-from scrapy.settings import Settings
-from scrapy.spiders import Spider
-from scrapy.utils.defer import deferred_from_coro
-from twisted.internet.defer import Deferred
+
+from .body import BodyBuffer
+from .proxy import proxy_url_with_auth, split_proxy
+from .resolve import CurlResolveList, get_shared_resolver
+from .timing import DownloadTimer
+
+HTTP_VERSIONS = {
+    getattr(pycurl, "CURL_HTTP_VERSION_1_0", 1): "HTTP/1.0",
+    getattr(pycurl, "CURL_HTTP_VERSION_1_1", 2): "HTTP/1.1",
+    getattr(pycurl, "CURL_HTTP_VERSION_2_0", 3): "HTTP/2",
+    getattr(pycurl, "CURL_HTTP_VERSION_3", 30): "HTTP/3",
+}
+
+
+CURL_TIMES = (
+    pycurl.NAMELOOKUP_TIME,
+    pycurl.CONNECT_TIME,
+    pycurl.APPCONNECT_TIME,
+    pycurl.STARTTRANSFER_TIME,
+    pycurl.TOTAL_TIME,
+)
+
+
+class CurlTransfer:
+    """
+    一个easy handle上的一次请求，边收边写进BodyBuffer
+    """
+
+    def __init__(self, curl: pycurl.Curl, request: Request, settings):
+        self.curl = curl
+        self.request = request
+        self.settings = settings
+        self.headers = Headers()
+        self.buffer = None  # type: Optional[BodyBuffer]
+        self.error = None  # type: Optional[BaseException]
+        self.url = request.url
+        self.status = 0
+        self.protocol = None  # type: Optional[str]
+        self.timer = DownloadTimer()
+        self.future = asyncio.get_running_loop().create_future()
+
+    def on_header(self, line: bytes):
+        line = line.rstrip(b"\r\n")
+        if line.startswith(b"HTTP/"):  # 100-continue 代理CONNECT 之后还会有一组头
+            self.headers = Headers()
+            return
+        name, sep, value = line.partition(b":")
+        if sep:
+            self.headers.appendlist(name.strip(), value.strip())
+
+    def on_body(self, chunk: bytes):
+        try:
+            if self.buffer is None:
+                self.buffer = BodyBuffer(
+                    self.request,
+                    self.settings,
+                    BodyBuffer.expected_size(self.headers),
+                )
+            self.buffer.write(chunk)
+        except Exception as e:  # 回调里的异常pycurl只会打印 记下来返回-1让curl中止
+            self.error = e
+            return -1
+
+    def finish(self):
+        """handle要被复用 结果先取出来"""
+        self.url = self.curl.getinfo(pycurl.EFFECTIVE_URL)
+        self.status = self.curl.getinfo(pycurl.RESPONSE_CODE)
+        self.protocol = HTTP_VERSIONS.get(self.curl.getinfo(pycurl.INFO_HTTP_VERSION))
+        self.timer.from_curl(self.curl.getinfo, CURL_TIMES)
+        self.timer.bytes = self.buffer.size if self.buffer is not None else 0
+
+    def body(self) -> bytes:
+        if self.buffer is None:
+            return b""
+        return self.buffer.getvalue()
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+
+
+class CurlMulti:
+    """
+    pycurl的multi接口挂在asyncio的loop上，socket就绪了loop回调socket_action，不占线程
+    同一个multi里的handle共用连接池和dns缓存，再用CurlShare共用tls session
+    """
+
+    def __init__(
+        self,
+        max_transfers: int = 16,
+        max_host_connections: int = 8,
+        max_total_connections: int = 0,
+    ):
+        self.loop = asyncio.get_running_loop()
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._on_socket_change)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._on_timer_change)
+        self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_host_connections)
+        if max_total_connections:
+            self.multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, max_total_connections)
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.max_transfers = max_transfers
+        self._slots = asyncio.Semaphore(max_transfers)
+        self._idle = []  # type: List[pycurl.Curl]
+        self._transfers = {}  # type: Dict[pycurl.Curl, CurlTransfer]
+        self._timer = None  # type: Optional[asyncio.TimerHandle]
+        self._watched = {}  # type: Dict[int, int]
+
+    def _on_socket_change(self, what, fd, multi, data):
+        old = self._watched.pop(fd, 0)
+        if old & pycurl.POLL_IN:
+            self.loop.remove_reader(fd)
+        if old & pycurl.POLL_OUT:
+            self.loop.remove_writer(fd)
+        if what == pycurl.POLL_REMOVE:
+            return
+        if what & pycurl.POLL_IN:
+            self.loop.add_reader(fd, self._socket_action, fd, pycurl.CSELECT_IN)
+        if what & pycurl.POLL_OUT:
+            self.loop.add_writer(fd, self._socket_action, fd, pycurl.CSELECT_OUT)
+        self._watched[fd] = what
+
+    def _on_timer_change(self, timeout_ms):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if timeout_ms >= 0:  # 回调里不能直接socket_action 放到loop上做
+            self._timer = self.loop.call_later(
+                timeout_ms / 1000,
+                self._socket_action,
+                pycurl.SOCKET_TIMEOUT,
+                0,
+            )
+
+    def _socket_action(self, fd, event):
+        while True:
+            ret, _ = self.multi.socket_action(fd, event)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        self._collect()
+
+    def _collect(self):
+        while True:
+            queued, succeeded, failed = self.multi.info_read()
+            for curl in succeeded:
+                self._finish(curl, None)
+            for curl, errno, message in failed:
+                self._finish(curl, pycurl.error(errno, message))
+            if not queued:
+                break
+
+    def _finish(self, curl, error):
+        self.multi.remove_handle(curl)
+        transfer = self._transfers.pop(curl, None)
+        if transfer is None or transfer.future.done():
+            return
+        if transfer.error is not None:
+            transfer.future.set_exception(transfer.error)
+        elif error is not None:
+            transfer.future.set_exception(error)
+        else:
+            transfer.finish()
+            transfer.future.set_result(None)
+
+    def _get_handle(self) -> pycurl.Curl:
+        if self._idle:
+            return self._idle.pop()
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self.share)  # reset()不会清掉share
+        return curl
+
+    def _release_handle(self, curl: pycurl.Curl):
+        curl.reset()
+        if len(self._idle) < self.max_transfers:
+            self._idle.append(curl)
+        else:
+            curl.close()
+
+    async def perform(self, transfer_factory, setup) -> CurlTransfer:
+        """
+        transfer_factory(curl) 返回CurlTransfer，setup(curl)设置好url header等
+        同时最多max_transfers个在跑
+        """
+        async with self._slots:
+            curl = self._get_handle()
+            transfer = transfer_factory(curl)
+            try:
+                curl.setopt(pycurl.HEADERFUNCTION, transfer.on_header)
+                curl.setopt(pycurl.WRITEFUNCTION, transfer.on_body)
+                setup(curl)
+                self._transfers[curl] = transfer
+                self.multi.add_handle(curl)
+                self._socket_action(pycurl.SOCKET_TIMEOUT, 0)  # 踢一下让curl开始连
+                await transfer.future
+                return transfer
+            except BaseException:
+                if self._transfers.pop(curl, None) is not None:  # 被取消了 从multi里摘掉
+                    self.multi.remove_handle(curl)
+                transfer.close()
+                raise
+            finally:
+                self._release_handle(curl)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        for curl, transfer in list(self._transfers.items()):
+            self.multi.remove_handle(curl)
+            if not transfer.future.done():
+                transfer.future.cancel()
+        self._transfers.clear()
+        for fd in list(self._watched):
+            self._on_socket_change(pycurl.POLL_REMOVE, fd, self.multi, None)
+        for curl in self._idle:
+            curl.close()
+        self._idle.clear()
+        self.multi.close()
+        self.share.close()
 
 
 class CurlDownloadHandler(HTTPDownloadHandler):
+    """
+    用pycurl的multi接口下载，不再一个请求占一个线程
+
+    settings.py 中可选
+    CURL_MAX_TRANSFERS  同时在跑的请求数 默认CONCURRENT_REQUESTS
+    CURL_MAX_HOST_CONNECTIONS  每个host最多几个连接 默认CONCURRENT_REQUESTS_PER_DOMAIN
+    CURL_MAX_TOTAL_CONNECTIONS  总连接数 默认0不限
+    """
+
     def __init__(self, crawler: Optional[Crawler] = None):
         super().__init__(crawler)
-        self.client = None  # type: Session
+        self.multi = None  # type: Optional[CurlMulti]
+        self._resolve_list = None  # type: Optional[CurlResolveList]
         crawler.signals.connect(self.engine_started, signals.engine_started)
 
     def engine_started(self, signal, sender):
-        client = Session()
-        client.mount("https://", CURLAdapter())
-        client.headers = {}
-        self.client = client.__enter__()
+        settings = self.crawler.settings
+        self.multi = CurlMulti(
+            settings.getint(
+                "CURL_MAX_TRANSFERS", settings.getint("CONCURRENT_REQUESTS")
+            ),
+            settings.getint(
+                "CURL_MAX_HOST_CONNECTIONS",
+                settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN"),
+            ),
+            settings.getint("CURL_MAX_TOTAL_CONNECTIONS", 0),
+        )
+        resolver = get_shared_resolver()
+        if resolver is not None:
+            self._resolve_list = CurlResolveList(resolver)
 
     async def download_request(self, request: Request) -> Response:
         if request.meta.get("tls"):
@@ -36,30 +271,65 @@ class CurlDownloadHandler(HTTPDownloadHandler):
 
     async def _download_request(self, request: Request) -> Response:
         """pycurl下载逻辑"""
-        # asyncio.get_running_loop().run_in_executor(None, self.client.request, request.method)
-        pfunc = partial(
-            self.client.request,
-            request.method,
-            request.url,
-            data=request.body,
-            headers=request.headers.to_unicode_dict(),
-            cookies=request.cookies,
-        )
-        response = await asyncio.get_running_loop().run_in_executor(None, pfunc)
-        del response.headers["content-encoding"]  # 防止scrapy二次解压
-        headers = Headers(response.headers)
-        respcls = responsetypes.from_args(
-            headers=headers, url=response.url, body=response.content
+        timeout = request.meta.get(
+            "download_timeout", self.crawler.settings.getfloat("DOWNLOAD_TIMEOUT")
         )
+        proxy, proxy_auth, headers = split_proxy(request)
+        proxy = proxy_url_with_auth(proxy, proxy_auth)
+        resolve = None
+        if self._resolve_list is not None:  # 用共享的resolver 别让curl自己解析
+            resolve = await self._resolve_list.update(request.url)
+
+        def setup(curl: pycurl.Curl):
+            curl.setopt(pycurl.URL, request.url)
+            curl.setopt(pycurl.CUSTOMREQUEST, request.method)
+            if request.method == "HEAD":
+                curl.setopt(pycurl.NOBODY, True)
+            elif request.body:
+                curl.setopt(pycurl.POSTFIELDS, request.body)
+            if isinstance(request.cookies, dict) and request.cookies:
+                headers.setdefault(
+                    "Cookie",
+                    "; ".join(f"{k}={v}" for k, v in request.cookies.items()),
+                )
+            curl.setopt(
+                pycurl.HTTPHEADER, [f"{name}: {value}" for name, value in headers.items()]
+            )
+            curl.setopt(pycurl.ACCEPT_ENCODING, "")  # curl自己解压
+            curl.setopt(pycurl.TIMEOUT_MS, int(timeout * 1000))
+            curl.setopt(pycurl.NOSIGNAL, True)
+            if proxy:  # 同一个代理的连接multi会复用
+                curl.setopt(pycurl.PROXY, proxy)
+            if resolve:
+                curl.setopt(pycurl.RESOLVE, resolve)
+
+        try:
+            transfer = await self.multi.perform(
+                lambda curl: CurlTransfer(curl, request, self.crawler.settings), setup
+            )
+        except pycurl.error as e:
+            if e.args[0] == pycurl.E_OPERATION_TIMEDOUT:
+                url = urldefrag(request.url)[0]
+                raise TimeoutError(
+                    f"Requesting {url} took longer than {timeout} seconds."
+                ) from e
+            raise
+        headers = transfer.headers
+        headers.pop("content-encoding", None)  # 防止scrapy二次解压
+        body = transfer.body()
+        transfer.timer.record(self.crawler, request, "curl")
+        respcls = responsetypes.from_args(headers=headers, url=transfer.url, body=body)
         return respcls(
-            url=response.url,
-            status=response.status_code,
+            url=transfer.url,
+            status=transfer.status,
             headers=headers,
-            body=response.content,
+            body=body,
             flags=["antitls"],
             request=request,
+            protocol=transfer.protocol,
         )  # scrapy 2.6
 
     async def close(self):
-        self.client.__exit__()
+        if self.multi is not None:
+            self.multi.close()
         await super().close()
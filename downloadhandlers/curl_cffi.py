@@ -1,6 +1,9 @@
+import asyncio
 import random
-from typing import Optional
-from urllib.parse import urldefrag
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+from urllib.parse import urldefrag, urlsplit
 
 try:
     import cycurl
@@ -8,12 +11,28 @@ try:
     from cycurl.requests import AsyncSession
 
     OPERATION_TIMEDOUT = cycurl.CURLE_OPERATION_TIMEDOUT
+    RESOLVE = cycurl.CURLOPT_RESOLVE
+    CURL_TIMES = (
+        cycurl.CURLINFO_NAMELOOKUP_TIME,
+        cycurl.CURLINFO_CONNECT_TIME,
+        cycurl.CURLINFO_APPCONNECT_TIME,
+        cycurl.CURLINFO_STARTTRANSFER_TIME,
+        cycurl.CURLINFO_TOTAL_TIME,
+    )
 except ImportError:
     from curl_cffi import CurlError
-    from curl_cffi.const import CurlECode
+    from curl_cffi.const import CurlECode, CurlInfo, CurlOpt
     from curl_cffi.requests import AsyncSession
 
     OPERATION_TIMEDOUT = CurlECode.OPERATION_TIMEDOUT
+    RESOLVE = CurlOpt.RESOLVE
+    CURL_TIMES = (
+        CurlInfo.NAMELOOKUP_TIME,
+        CurlInfo.CONNECT_TIME,
+        CurlInfo.APPCONNECT_TIME,
+        CurlInfo.STARTTRANSFER_TIME,
+        CurlInfo.TOTAL_TIME,
+    )
 from scrapy import signals
 from scrapy.core.downloader.handlers.http11 import (
     HTTP11DownloadHandler as HTTPDownloadHandler,
@@ -26,16 +45,97 @@ from scrapy.spiders import Spider
 from scrapy.utils.defer import deferred_f_from_coro_f, deferred_from_coro
 from twisted.internet.defer import Deferred
 
+from .body import BodyBuffer
+from .proxy import proxy_url_with_auth, split_proxy
+from .resolve import CurlResolveList, get_shared_resolver
+from .timing import DownloadTimer
+
+
+DEFAULT_IMPERSONATE = ["chrome99", "chrome101", "chrome110", "edge99", "edge101", "chrome107"]
+
+
+class CurlSessionPool:
+    """
+    按(impersonate, proxy)分开的AsyncSession，同一个指纹的请求复用同一批连接
+    超过max_sessions时关掉最久没用且空闲的
+    """
+
+    def __init__(self, max_clients: int = 10, max_sessions: int = 64):
+        self.max_clients = max_clients
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # type: Dict[Tuple[str, Optional[str]], AsyncSession]
+        self._busy = {}  # type: Dict[Tuple[str, Optional[str]], int]
+        self.resolve_list = None  # type: Optional[CurlResolveList]
+
+    @asynccontextmanager
+    async def session(self, impersonate: str, proxy: Optional[str] = None):
+        key = (impersonate, proxy)
+        self._busy[key] = self._busy.get(key, 0) + 1  # 先占上 不会被下面淘汰掉
+        session = self._sessions.get(key)
+        if session is None:
+            session = AsyncSession(max_clients=self.max_clients, impersonate=impersonate)
+            self._sessions[key] = session
+            self._evict()
+        self._sessions.move_to_end(key)
+        try:
+            yield session
+        finally:
+            self._busy[key] -= 1
+            if not self._busy[key]:
+                del self._busy[key]
+                if len(self._sessions) > self.max_sessions:
+                    self._evict()
+
+    def _evict(self):
+        """都在用的话先超着 等用完了再关"""
+        for key in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if key in self._busy:
+                continue
+            asyncio.ensure_future(self._sessions.pop(key).close())
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
 
 class CurlCFFIDownloadHandler(HTTPDownloadHandler):
+    """
+    settings.py 中可选
+    CURL_CFFI_IMPERSONATE  可用的指纹 列表或者{指纹: 权重} 默认几个chrome和edge
+    CURL_CFFI_STICKY  domain同一个域名固定一个指纹 cookiejar按meta['cookiejar']固定 none每次随机 默认domain
+    CURL_CFFI_STICKY_MAX  最多记住多少个域名/cookiejar的指纹 超了先忘最早的 默认100000
+    CURL_CFFI_MAX_CLIENTS  每个session最多同时几个连接 默认10
+    CURL_CFFI_MAX_SESSIONS  最多保留几个session 默认64
+    meta['impersonate'] 可以直接指定
+    """
+
     def __init__(self, crawler: Optional[Crawler] = None):
         super().__init__(crawler)
-        self.session = AsyncSession()
+        impersonate = crawler.settings.get("CURL_CFFI_IMPERSONATE") or DEFAULT_IMPERSONATE
+        if isinstance(impersonate, dict):
+            self.profiles = list(impersonate)
+            self.weights = [float(w) for w in impersonate.values()]
+        else:
+            self.profiles = crawler.settings.getlist("CURL_CFFI_IMPERSONATE") or list(
+                DEFAULT_IMPERSONATE
+            )
+            self.weights = None
+        self.sticky = crawler.settings.get("CURL_CFFI_STICKY", "domain")
+        self.sticky_max = crawler.settings.getint("CURL_CFFI_STICKY_MAX", 100000)
+        self._assigned = OrderedDict()  # type: Dict[str, str]
+        self.sessions = CurlSessionPool(
+            crawler.settings.getint("CURL_CFFI_MAX_CLIENTS", 10),
+            crawler.settings.getint("CURL_CFFI_MAX_SESSIONS", 64),
+        )
         crawler.signals.connect(self.engine_started, signals.engine_started)
 
     async def engine_started(self, *args, **kwargs):
-        # print(f"{self.__class__.__name__} aenter, {args}, {kwargs}")  # todo del
-        await self.session.__aenter__()
+        resolver = get_shared_resolver()
+        if resolver is not None:
+            self.sessions.resolve_list = CurlResolveList(resolver)
 
     async def download_request(self, request: Request) -> Response:
         # print(f"{self.__class__.__name__} download_request {request.url}{request.meta}")
@@ -44,23 +144,55 @@ class CurlCFFIDownloadHandler(HTTPDownloadHandler):
             return await self._download_request(request)
         return await super().download_request(request)  # 普通下载
 
+    def choose_impersonate(self, request: Request) -> str:
+        if request.meta.get("impersonate"):
+            return request.meta["impersonate"]
+        key = None
+        if self.sticky == "cookiejar" and "cookiejar" in request.meta:
+            key = "cookiejar:{}".format(request.meta["cookiejar"])
+        elif self.sticky in ("domain", "cookiejar"):
+            key = urlsplit(request.url).hostname
+        if key is None:
+            return random.choices(self.profiles, self.weights)[0]
+        profile = self._assigned.get(key)
+        if profile is None:
+            profile = random.choices(self.profiles, self.weights)[0]
+            self._assigned[key] = profile
+            if len(self._assigned) > self.sticky_max:
+                self._assigned.popitem(last=False)
+        return profile
+
     async def _download_request(self, request: Request) -> Response:
         """curl-cffi下载逻辑"""
-        # spider = self.crawler.spider
-        # asyncio.get_running_loop().run_in_executor(None, self.client.request, request.method)
-        impersonate = request.meta.get("impersonate") or random.choice(
-            ["chrome99", "chrome101", "chrome110", "edge99", "edge101", "chrome107"]
-        )
+        impersonate = self.choose_impersonate(request)
         timeout = request.meta.get(
             "download_timeout", self.crawler.settings.get("DOWNLOAD_TIMEOUT")
         )
-        proxy = request.meta.get("proxy")
+        proxy, proxy_auth, headers = split_proxy(request)
+        proxy = proxy_url_with_auth(proxy, proxy_auth)
+        async with self.sessions.session(impersonate, proxy) as session:
+            return await self._request(
+                session, request, headers, impersonate, timeout, proxy
+            )
+
+    async def _request(
+        self,
+        session: AsyncSession,
+        request: Request,
+        request_headers: dict,
+        impersonate,
+        timeout,
+        proxy,
+    ) -> Response:
+        resolve_list = self.sessions.resolve_list
+        if resolve_list is not None:  # 用共享的resolver 别让curl自己解析
+            session.curl_options[RESOLVE] = await resolve_list.update(request.url)
         try:
-            response = await self.session.request(
+            response = await session.request(
                 request.method,
                 request.url,
                 data=request.body,
-                headers=request.headers.to_unicode_dict(),
+                headers=request_headers,
                 proxies=(
                     {
                         "http": proxy,
@@ -71,30 +203,42 @@ class CurlCFFIDownloadHandler(HTTPDownloadHandler):
                 ),
                 timeout=timeout,
                 impersonate=impersonate,
+                stream=True,
             )
+            try:
+                headers = Headers(response.headers)
+                headers.pop("content-encoding", None)  # 防止scrapy二次解压
+                buffer = BodyBuffer(
+                    request, self.crawler.settings, BodyBuffer.expected_size(headers)
+                )
+                async for chunk in response.aiter_content():
+                    buffer.write(chunk)
+                body = buffer.getvalue()
+                timer = DownloadTimer()
+                timer.from_curl(response.curl.getinfo, CURL_TIMES)
+                timer.bytes = len(body)
+            finally:
+                await response.aclose()  # 超了大小就在这里断掉
         except CurlError as e:
             if e.code == OPERATION_TIMEDOUT:
                 url = urldefrag(request.url)[0]
                 raise TimeoutError(
                     f"Requesting {url} took longer than {timeout} seconds."
                 ) from e
-        del response.headers["content-encoding"]  # 防止scrapy二次解压
+            raise
 
-        headers = Headers(response.headers)
-        respcls = responsetypes.from_args(
-            headers=headers, url=response.url, body=response.content
-        )
+        timer.record(self.crawler, request, "curl_cffi")
+        respcls = responsetypes.from_args(headers=headers, url=response.url, body=body)
         return respcls(
             url=response.url,
             status=response.status_code,
             headers=headers,
-            body=response.content,
+            body=body,
             flags=["antitls"],
             request=request,
             protocol=response.http_version,
         )  # scrapy 2.6
 
     async def close(self):
-        # print(f"{self.__class__.__name__} aexit")  # todo del
-        await self.session.__aexit__()
+        await self.sessions.close()
         await super(CurlCFFIDownloadHandler, self).close()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+handler自己边收边解压，不让aiohttp/httpx在loop上一口气解压整个body
+收到的压缩数据超过DOWNLOAD_DECOMPRESS_THREAD_THRESHOLD(默认256KB)后，剩下的块放到线程里解
+解压后和压缩前的比例超过DOWNLOAD_DECOMPRESSION_RATIO(默认200)就当解压炸弹，抛DownloadCancelledError
+brotli zstd 装了才用，和scrapy自己的HttpCompressionMiddleware一样
+"""
+import asyncio
+import logging
+import zlib
+from typing import Iterator, List, Optional
+
+from scrapy.http import Headers, Request
+
+from .body import CHUNK_SIZE, DownloadCancelledError
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    from compression import zstd  # python 3.14
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED = ["gzip", "deflate", "x-gzip"]
+if brotli is not None:
+    SUPPORTED.append("br")
+if zstd is not None:
+    SUPPORTED.append("zstd")
+ACCEPT_ENCODING = ", ".join(encoding for encoding in SUPPORTED if encoding != "x-gzip")
+
+RATIO_MIN_SIZE = 1024 * 1024  # 解压出来不到1MB的不看比例
+
+
+class _ZlibDecoder:
+    def __init__(self, encoding: str):
+        # gzip和zlib头都认 deflate还可能是不带头的raw deflate
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        self._raw_fallback = encoding == "deflate"
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        try:
+            piece = self._decompressor.decompress(data, CHUNK_SIZE)
+        except zlib.error:
+            if not self._raw_fallback:
+                raise
+            self._raw_fallback = False
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            piece = self._decompressor.decompress(data, CHUNK_SIZE)
+        self._raw_fallback = False
+        yield piece
+        while self._decompressor.unconsumed_tail and not self._decompressor.eof:
+            yield self._decompressor.decompress(
+                self._decompressor.unconsumed_tail, CHUNK_SIZE
+            )
+
+    def flush(self) -> bytes:
+        return self._decompressor.flush()
+
+
+class _BrotliDecoder:
+    def __init__(self, encoding: str):
+        self._decompressor = brotli.Decompressor()
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        try:
+            piece = self._decompressor.process(data, output_buffer_limit=CHUNK_SIZE)
+        except TypeError:  # 老版本brotli没有output_buffer_limit
+            yield self._decompressor.process(data)
+            return
+        yield piece
+        while not self._decompressor.is_finished():
+            piece = self._decompressor.process(b"", output_buffer_limit=CHUNK_SIZE)
+            if not piece:
+                break
+            yield piece
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _ZstdDecoder:
+    def __init__(self, encoding: str):
+        self._decompressor = zstd.ZstdDecompressor()
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        if self._decompressor.eof:  # 多个frame拼在一起
+            data = self._decompressor.unused_data + data
+            self._decompressor = zstd.ZstdDecompressor()
+        yield self._decompressor.decompress(data, CHUNK_SIZE)
+        while not self._decompressor.needs_input and not self._decompressor.eof:
+            yield self._decompressor.decompress(b"", CHUNK_SIZE)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+_DECODERS = {
+    "gzip": _ZlibDecoder,
+    "x-gzip": _ZlibDecoder,
+    "deflate": _ZlibDecoder,
+    "br": _BrotliDecoder,
+    "zstd": _ZstdDecoder,
+}
+
+
+class StreamDecoder:
+    """
+    Content-Encoding可能有好几层 "gzip, br" 是先gzip再br，解的时候倒过来
+    """
+
+    def __init__(self, encodings: List[str], max_ratio: float = 0, url: str = ""):
+        self._decoders = [
+            _DECODERS[encoding](encoding) for encoding in reversed(encodings)
+        ]
+        self.max_ratio = max_ratio
+        self.url = url
+        self.received = 0
+        self.decoded = 0
+
+    def _check(self):
+        if (
+            self.max_ratio
+            and self.decoded > RATIO_MIN_SIZE
+            and self.decoded > self.received * self.max_ratio
+        ):
+            msg = (
+                f"Cancelling download of {self.url}: decompressed {self.decoded} "
+                f"bytes from {self.received}, ratio larger than {self.max_ratio}."
+            )
+            logger.warning(msg)
+            raise DownloadCancelledError(msg)
+
+    def _feed(self, level: int, data: bytes, out: List[bytes]):
+        if level == len(self._decoders):
+            if data:
+                self.decoded += len(data)
+                self._check()
+                out.append(data)
+            return
+        for piece in self._decoders[level].feed(data):
+            self._feed(level + 1, piece, out)
+
+    def decompress(self, chunk: bytes) -> bytes:
+        self.received += len(chunk)
+        out = []  # type: List[bytes]
+        self._feed(0, chunk, out)
+        return b"".join(out)
+
+    def flush(self) -> bytes:
+        out = []  # type: List[bytes]
+        for level, decoder in enumerate(self._decoders):
+            self._feed(level + 1, decoder.flush(), out)
+        return b"".join(out)
+
+
+class BodyDecoder:
+    """
+    用法
+    decoder = BodyDecoder(request, settings, headers)  # 认识的编码会从headers里去掉content-encoding
+    for chunk in ...:
+        buffer.write(await decoder.feed(chunk))
+    buffer.write(decoder.flush())
+    不认识的编码原样返回 content-encoding留着给scrapy的HttpCompressionMiddleware
+    """
+
+    def __init__(self, request: Request, settings, headers: Headers):
+        self.threshold = settings.getint(
+            "DOWNLOAD_DECOMPRESS_THREAD_THRESHOLD", 256 * 1024
+        )
+        self._decoder = None  # type: Optional[StreamDecoder]
+        value = headers.get("content-encoding")
+        if not value:
+            return
+        encodings = [
+            encoding.strip().lower()
+            for encoding in value.decode("latin-1").split(",")
+            if encoding.strip() and encoding.strip().lower() != "identity"
+        ]
+        if not all(encoding in SUPPORTED for encoding in encodings):
+            return  # 解不了的原样交给scrapy
+        if encodings:
+            self._decoder = StreamDecoder(
+                encodings,
+                settings.getfloat("DOWNLOAD_DECOMPRESSION_RATIO", 200),
+                request.url,
+            )
+        headers.pop("content-encoding", None)
+
+    async def feed(self, chunk: bytes) -> bytes:
+        if self._decoder is None:
+            return chunk
+        if self._decoder.received + len(chunk) > self.threshold:  # 大的body放线程里解
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._decoder.decompress, chunk
+            )
+        return self._decoder.decompress(chunk)
+
+    def flush(self) -> bytes:
+        if self._decoder is None:
+            return b""
+        return self._decoder.flush()
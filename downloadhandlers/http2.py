@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
-from typing import Optional
+import asyncio
+import time
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urldefrag, urlsplit
 
 import httpx
 from scrapy import signals
@@ -14,16 +18,184 @@ from scrapy.spiders import Spider
 from scrapy.utils.defer import deferred_f_from_coro_f, deferred_from_coro
 from twisted.internet.defer import Deferred
 
+from .body import CHUNK_SIZE, BodyBuffer
+from .decompress import ACCEPT_ENCODING, BodyDecoder
+from .proxy import split_proxy
+from .resolve import get_shared_resolver, install_httpx_resolver
+from .timing import DownloadTimer
+
+
+class H2Lane:
+    """
+    一个AsyncClient里只放一条连接，in_flight是上面正在跑的stream数
+    """
+
+    __slots__ = ("client", "in_flight", "capacity", "idle_since")
+
+    def __init__(self, client: httpx.AsyncClient, capacity: Optional[int] = None):
+        self.client = client
+        self.in_flight = 0
+        self.capacity = capacity  # 连上之前不知道是h2还是http/1.1
+        self.idle_since = time.monotonic()
+
+    @property
+    def available(self) -> bool:
+        return self.in_flight < (self.capacity or 1)
+
+    def update_capacity(self, default: int):
+        """
+        连接上服务器的SETTINGS到了之后按MAX_CONCURRENT_STREAMS来，http/1.1就是1
+        httpcore自己只会在一条连接上排队等stream，不会多开连接
+        """
+        try:
+            connections = self.client._transport._pool.connections
+        except AttributeError:  # httpx内部变了
+            self.capacity = default
+            return
+        for connection in connections:
+            inner = getattr(connection, "_connection", None)
+            if inner is not None:
+                self.capacity = max(getattr(inner, "_max_streams", 1), 1)
+                return
+
+
+class OriginPool:
+    """
+    一个(origin, proxy)的连接，stream满了再开新连接，最多max_connections条，都满了就排队
+    """
+
+    def __init__(self, make_client, max_connections: int, default_streams: int):
+        self.make_client = make_client
+        self.max_connections = max(max_connections, 1)
+        self.default_streams = default_streams
+        self.lanes = []  # type: List[H2Lane]
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> H2Lane:
+        async with self._cond:
+            while True:
+                available = [lane for lane in self.lanes if lane.available]
+                known = next(
+                    (lane.capacity for lane in self.lanes if lane.capacity), None
+                )
+                if available:
+                    lane = min(available, key=lambda lane: lane.in_flight)
+                elif len(self.lanes) < self.max_connections and (
+                    known is not None or not self.lanes
+                ):
+                    # 等第一条连接谈好协议再决定要不要多开 h2的话一条就够了
+                    lane = H2Lane(self.make_client(), known)
+                    self.lanes.append(lane)
+                else:
+                    await self._cond.wait()
+                    continue
+                lane.in_flight += 1
+                return lane
+
+    async def connected(self, lane: H2Lane):
+        """收到响应头 连接的协议和stream上限都知道了"""
+        if lane.capacity is None:
+            async with self._cond:
+                lane.update_capacity(self.default_streams)
+                self._cond.notify_all()
+
+    async def release(self, lane: H2Lane):
+        async with self._cond:
+            lane.in_flight -= 1
+            lane.update_capacity(self.default_streams)
+            if not lane.in_flight:
+                lane.idle_since = time.monotonic()
+            self._cond.notify_all()
+
+    async def close_idle(self, idle_timeout: float):
+        async with self._cond:
+            now = time.monotonic()
+            idle = [
+                lane
+                for lane in self.lanes
+                if not lane.in_flight and now - lane.idle_since > idle_timeout
+            ]
+            for lane in idle:
+                self.lanes.remove(lane)
+        for lane in idle:
+            await lane.client.aclose()
+
+    async def close(self):
+        lanes, self.lanes = self.lanes, []
+        for lane in lanes:
+            await lane.client.aclose()
+
 
 class HttpxDownloadHandler(HTTPDownloadHandler):
+    """
+    每个(origin, proxy)一组http2连接，一条连接上的stream数跟着服务器的MAX_CONCURRENT_STREAMS走
+    遵守DOWNLOAD_TIMEOUT meta['download_timeout'] meta['proxy']
+
+    settings.py 中可选
+    HTTPX_MAX_CONNECTIONS_PER_ORIGIN  每个origin最多几条连接 默认CONCURRENT_REQUESTS_PER_DOMAIN
+    HTTPX_DEFAULT_STREAMS  读不到服务器的MAX_CONCURRENT_STREAMS时一条连接放几个stream 默认100
+    HTTPX_IDLE_TIMEOUT  连接空闲多少秒关掉 默认60
+    """
+
     def __init__(self, crawler: Optional[Crawler] = None):
         super().__init__(crawler)
-        self.client = None
+        settings = crawler.settings
+        self.max_connections = settings.getint(
+            "HTTPX_MAX_CONNECTIONS_PER_ORIGIN",
+            settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN"),
+        )
+        self.default_streams = settings.getint("HTTPX_DEFAULT_STREAMS", 100)
+        self.idle_timeout = settings.getfloat("HTTPX_IDLE_TIMEOUT", 60)
+        # (origin, proxy, Proxy-Authorization) -> OriginPool
+        self.pools = {}  # type: Dict[Tuple[str, Optional[str], Optional[str]], OriginPool]
+        self._resolver = None
+        self._last_sweep = time.monotonic()
         crawler.signals.connect(self.engine_started, signals.engine_started)
 
     async def engine_started(self, signal, sender):
-        client = httpx.AsyncClient(http2=True)
-        self.client = await client.__aenter__()
+        self._resolver = get_shared_resolver()
+
+    def _make_client(
+        self, proxy: Optional[str], proxy_auth: Optional[str]
+    ) -> httpx.AsyncClient:
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            proxy=(
+                httpx.Proxy(proxy, headers={"Proxy-Authorization": proxy_auth})
+                if proxy and proxy_auth
+                else proxy
+            ),
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        )
+        if self._resolver is not None and proxy is None:  # 走代理的话由代理解析
+            install_httpx_resolver(transport, self._resolver)
+        self.crawler.stats.inc_value("httpx/connections")
+        return httpx.AsyncClient(http2=True, transport=transport)
+
+    def _get_pool(
+        self, request: Request, proxy: Optional[str], proxy_auth: Optional[str]
+    ) -> OriginPool:
+        parts = urlsplit(request.url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (f"{parts.scheme}://{parts.hostname}:{port}", proxy, proxy_auth)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = OriginPool(
+                partial(self._make_client, proxy, proxy_auth),
+                self.max_connections,
+                self.default_streams,
+            )
+        return pool
+
+    async def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_timeout:
+            return
+        self._last_sweep = now
+        for key, pool in list(self.pools.items()):
+            await pool.close_idle(self.idle_timeout)
+            if not pool.lanes:
+                self.pools.pop(key, None)
 
     async def download_request(self, request: Request) -> Response:
         if request.meta.get("h2"):
@@ -32,28 +204,77 @@ class HttpxDownloadHandler(HTTPDownloadHandler):
 
     async def _download_request(self, request: Request) -> Response:
         """httpx下载逻辑"""
-        response = await self.client.request(
-            request.method,
-            request.url,
-            content=request.body,
-            headers=request.headers.to_unicode_dict(),
-            cookies=request.cookies,
+        timeout = request.meta.get(
+            "download_timeout", self.crawler.settings.getfloat("DOWNLOAD_TIMEOUT")
         )
-        del response.headers["content-encoding"]  # 防止scrapy二次解压
-        headers = Headers(response.headers)
+        proxy, proxy_auth, headers = split_proxy(request)
+        headers.setdefault("Accept-Encoding", ACCEPT_ENCODING)
+        await self._sweep()
+        pool = self._get_pool(request, proxy, proxy_auth)
+        timer = DownloadTimer()
+        try:
+            # 排队等连接 发请求 读body 一共不超过timeout
+            response, headers, body = await asyncio.wait_for(
+                self._fetch(request, pool, headers, timeout, timer), timeout or None
+            )
+        except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+            url = urldefrag(request.url)[0]
+            raise TimeoutError(
+                f"Requesting {url} took longer than {timeout} seconds."
+            ) from e
+        timer.bytes = len(body)
+        timer.finish_httpx()
+        timer.record(self.crawler, request, "httpx")
         respcls = responsetypes.from_args(
-            headers=headers, url=response.url, body=response.content
+            headers=headers, url=str(response.url), body=body
         )
         return respcls(
             url=str(response.url),
             status=response.status_code,
             headers=headers,
-            body=response.content,
+            body=body,
             flags=["httpx"],
             request=request,
             protocol=response.http_version,
         )
 
+    async def _fetch(
+        self,
+        request: Request,
+        pool: OriginPool,
+        headers: dict,
+        timeout: float,
+        timer: DownloadTimer,
+    ) -> Tuple[httpx.Response, Headers, bytes]:
+        lane = await pool.acquire()
+        try:
+            async with lane.client.stream(
+                request.method,
+                request.url,
+                content=request.body,
+                headers=headers,
+                cookies=request.cookies,
+                timeout=timeout,
+                extensions={"trace": timer.httpx_trace},
+            ) as response:
+                timer.mark("headers")
+                await pool.connected(lane)
+                headers = Headers(response.headers)
+                buffer = BodyBuffer(
+                    request, self.crawler.settings, BodyBuffer.expected_size(headers)
+                )
+                decoder = BodyDecoder(request, self.crawler.settings, headers)
+                async for chunk in response.aiter_raw(CHUNK_SIZE):  # httpx不解压
+                    buffer.write(await decoder.feed(chunk))
+                buffer.write(decoder.flush())
+                body = buffer.getvalue()
+                timer.mark("body")
+        finally:
+            await pool.release(lane)
+        return response, headers, body
+
     async def close(self):
-        await self.client.__aexit__()
+        for pool in self.pools.values():
+            await pool.close()
+        self.pools.clear()
         await super().close()
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import random
 import ssl
-from typing import Optional
+import zlib
+from functools import partial
+from typing import List, Optional
+from urllib.parse import urlsplit
 
 import aiohttp
 from scrapy import signals
@@ -16,6 +20,13 @@ from scrapy.spiders import Spider
 from scrapy.utils.defer import deferred_f_from_coro_f, deferred_from_coro
 from twisted.internet.defer import Deferred
 
+from .body import CHUNK_SIZE, BodyBuffer
+from .decompress import ACCEPT_ENCODING, BodyDecoder
+from .proxy import split_proxy
+from .resolve import AiohttpResolver, get_shared_resolver
+from .sessions import get_session_registry
+from .timing import DownloadTimer, aiohttp_trace_config
+
 # ssl._create_default_https_context = ssl._create_unverified_context
 
 
@@ -42,15 +53,83 @@ class SSLFactory:
 sslgen = SSLFactory()
 
 
+class SSLContextPool:
+    """
+    启动时在线程里建好一批cipher顺序不同的SSLContext，之后每个请求直接拿
+    同一个context的连接aiohttp才会复用，所以不再每个请求都握手
+    rotation="host" 同一个域名固定用一个 "connection" 每次换下一个
+    """
+
+    def __init__(self, size: int = 8, rotation: str = "host"):
+        self.size = max(size, 1)
+        self.rotation = rotation
+        self._contexts = []  # type: List[ssl.SSLContext]
+        self._index = 0
+
+    async def start(self):
+        self._contexts = await asyncio.get_running_loop().run_in_executor(
+            None, self._build
+        )
+
+    def _build(self) -> List[ssl.SSLContext]:
+        factory = SSLFactory()
+        contexts = []
+        orders = set()
+        for _ in range(self.size * 4):  # cipher顺序尽量不重复
+            context = factory()
+            order = ":".join(factory.ciphers)
+            if order in orders:
+                continue
+            orders.add(order)
+            contexts.append(context)
+            if len(contexts) >= self.size:
+                break
+        return contexts
+
+    def get(self, host: Optional[str] = None) -> ssl.SSLContext:
+        if not self._contexts:  # 还没start 先凑合一个
+            self._contexts.append(sslgen())
+        if self.rotation == "host" and host:
+            return self._contexts[zlib.crc32(host.encode()) % len(self._contexts)]
+        context = self._contexts[self._index % len(self._contexts)]
+        self._index += 1
+        return context
+
+
 class Ja3DownloadHandler(HTTPDownloadHandler):
+    """
+    settings.py 中可选
+    JA3_SSL_POOL_SIZE  预先建多少个SSLContext 默认8
+    JA3_SSL_ROTATION  host按域名固定 connection每个请求轮换 默认host
+    """
+
     def __init__(self, crawler: Optional[Crawler] = None):
         super().__init__(crawler)
         self.client = None
+        self.ssl_pool = SSLContextPool(
+            crawler.settings.getint("JA3_SSL_POOL_SIZE", 8),
+            crawler.settings.get("JA3_SSL_ROTATION", "host"),
+        )
         crawler.signals.connect(self.engine_started, signals.engine_started)
 
     async def engine_started(self, signal, sender):
-        client = aiohttp.ClientSession()
-        self.client = await client.__aenter__()
+        await self.ssl_pool.start()
+        resolver = get_shared_resolver()
+        connector = (
+            partial(
+                aiohttp.TCPConnector,
+                resolver=AiohttpResolver(resolver),
+                use_dns_cache=False,
+            )
+            if resolver is not None
+            else None
+        )
+        self.client = get_session_registry(self.crawler).session(
+            "ja3",
+            connector=connector,
+            trace_configs=[aiohttp_trace_config()],
+            auto_decompress=False,  # 自己边收边解压
+        )
 
     async def download_request(self, request: Request) -> Response:
         if request.meta.get("ja3"):
@@ -59,17 +138,33 @@ class Ja3DownloadHandler(HTTPDownloadHandler):
 
     async def _download_request(self, request: Request) -> Response:
         """aiohttp下载逻辑"""
+        timer = DownloadTimer()
+        proxy, proxy_auth, request_headers = split_proxy(request)
+        request_headers.setdefault("Accept-Encoding", ACCEPT_ENCODING)
         async with self.client.request(
             request.method,
             request.url,
             data=request.body,
-            headers=request.headers.to_unicode_dict(),
+            headers=request_headers,
             cookies=request.cookies,
-            ssl=sslgen(),
+            ssl=self.ssl_pool.get(urlsplit(request.url).hostname),
+            proxy=proxy,  # 同一个代理的连接connector会复用
+            proxy_headers={"Proxy-Authorization": proxy_auth} if proxy_auth else None,
+            trace_request_ctx=timer,
         ) as response:
-            del response.headers["content-encoding"]  # 防止scrapy二次解压
             headers = Headers(response.headers)
-            body = await response.read()
+            buffer = BodyBuffer(
+                request, self.crawler.settings, BodyBuffer.expected_size(headers)
+            )
+            decoder = BodyDecoder(request, self.crawler.settings, headers)
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                buffer.write(await decoder.feed(chunk))
+            buffer.write(decoder.flush())
+            body = buffer.getvalue()
+            timer.mark("body")
+            timer.bytes = len(body)
+            timer.finish_aiohttp()
+            timer.record(self.crawler, request, "ja3")
             respcls = responsetypes.from_args(
                 headers=headers, url=str(response.url), body=body
             )
@@ -84,5 +179,5 @@ class Ja3DownloadHandler(HTTPDownloadHandler):
             )
 
     async def close(self):
-        await self.client.__aexit__(None, None, None)
+        # session归SessionRegistry管 spider_closed时关
         await super().close()
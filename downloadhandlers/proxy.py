@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+scrapy的HttpProxyMiddleware会把代理的账号密码从meta['proxy']里拿掉，改成Proxy-Authorization头
+这个头只能给代理，不能跟着请求发给网站
+"""
+import base64
+from typing import Optional, Tuple
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from scrapy.http import Request
+
+
+def split_proxy(request: Request) -> Tuple[Optional[str], Optional[str], dict]:
+    """
+    返回 (代理, Proxy-Authorization, 去掉了Proxy-Authorization的headers)
+    """
+    headers = dict(request.headers.to_unicode_dict())
+    auth = headers.pop("Proxy-Authorization", None)
+    return request.meta.get("proxy"), auth, headers
+
+
+def proxy_url_with_auth(proxy: Optional[str], auth: Optional[str]) -> Optional[str]:
+    """
+    curl系的只认url里的user:pass，把Basic头塞回代理url里
+    """
+    if not proxy or not auth or not auth.startswith("Basic "):
+        return proxy
+    user, _, password = base64.b64decode(auth[6:]).decode("latin-1").partition(":")
+    parts = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+    netloc = "{}:{}@{}".format(
+        quote(user, safe=""), quote(password, safe=""), parts.netloc.rpartition("@")[2]
+    )
+    return urlunsplit(parts._replace(netloc=netloc))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+
+from scrapy.core.downloader.handlers.http11 import (
+    HTTP11DownloadHandler as HTTPDownloadHandler,
+)
+from scrapy.crawler import Crawler
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Request, Response
+
+from .archive import ArchiveReader, build_response, request_key
+
+
+class ReplayDownloadHandler(HTTPDownloadHandler):
+    """
+    不联网 从RouterDownloadHandler录下来的归档里按请求指纹拿响应
+    离线压测解析和pipeline 或者复现线上的问题
+    DOWNLOAD_HANDLERS = {"http": "...ReplayDownloadHandler", "https": "...ReplayDownloadHandler"}
+    也可以挂在router上 meta['download_backend'] = "replay"
+
+    settings.py 中
+    DOWNLOAD_ARCHIVE_REPLAY  归档路径 DOWNLOAD_ARCHIVE_RECORD录的那个
+    DOWNLOAD_ARCHIVE_REPLAY_MISS  归档里没有的请求 ignore丢掉 network正常下载 默认ignore
+    """
+
+    def __init__(self, crawler: Optional[Crawler] = None):
+        super().__init__(crawler)
+        path = crawler.settings.get("DOWNLOAD_ARCHIVE_REPLAY")
+        if not path:
+            raise NotConfigured("DOWNLOAD_ARCHIVE_REPLAY is not set")
+        self.reader = ArchiveReader(path)
+        self.miss = crawler.settings.get("DOWNLOAD_ARCHIVE_REPLAY_MISS", "ignore")
+        self.stats = crawler.stats
+
+    def engine_started(self, signal, sender):
+        pass
+
+    async def download_request(self, request: Request) -> Response:
+        return await self._download_request(request)
+
+    async def _download_request(self, request: Request) -> Response:
+        record = self.reader.get(request_key(self.crawler, request))
+        if record is None:
+            self.stats.inc_value("downloader/replay/miss")
+            if self.miss == "network":
+                return await super().download_request(request)  # 普通下载
+            raise IgnoreRequest(f"{request.url} is not in the download archive")
+        self.stats.inc_value("downloader/replay/hit")
+        return build_response(request, *record)
+
+    async def close(self):
+        self.reader.close()
+        await super().close()
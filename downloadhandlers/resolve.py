@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+让各个下载器共用装在reactor上的async resolver(resolver.py里的CachingAsyncResolver/CachingAsyncDohResolver)
+这样DNSCACHE_*和aiodns/doh的设置对aiohttp httpx curl_cffi也生效，不再各自在线程池里getaddrinfo
+"""
+import socket
+from collections import OrderedDict
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+import httpcore
+from aiohttp.abc import AbstractResolver
+
+from resolver import is_ip_address
+
+
+def get_shared_resolver():
+    """
+    找reactor上装好的async resolver，只认有resolve_all方法的，没有就返回None让各个库自己解析
+    """
+    from twisted.internet import reactor
+
+    for candidate in (
+        getattr(reactor, "nameResolver", None),
+        getattr(reactor, "resolver", None),
+    ):
+        if hasattr(candidate, "resolve_all"):
+            return candidate
+    return None
+
+
+def _family(address: str) -> int:
+    return socket.AF_INET6 if ":" in address else socket.AF_INET
+
+
+class AiohttpResolver(AbstractResolver):
+    """
+    给aiohttp.TCPConnector用的resolver
+    """
+
+    def __init__(self, resolver):
+        self._resolver = resolver
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        addresses = await self._resolver.resolve_all(host)
+        result = [
+            {
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": _family(address),
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+            }
+            for address in addresses
+            if family in (socket.AF_UNSPEC, _family(address))
+        ]
+        if not result:
+            raise OSError("No address of family {} for {}".format(family, host))
+        return result
+
+    async def close(self):
+        pass  # resolver是大家共用的 不归这里关
+
+
+class ResolvingNetworkBackend(httpcore.AsyncNetworkBackend):
+    """
+    给httpx用的network backend，按resolver排好的顺序连，连不上的地址告诉resolver
+    """
+
+    def __init__(self, resolver, backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        self._resolver = resolver
+        self._backend = backend or httpcore.AnyIOBackend()
+
+    async def connect_tcp(
+        self, host, port, timeout=None, local_address=None, socket_options=None
+    ):
+        if is_ip_address(host):
+            return await self._backend.connect_tcp(
+                host, port, timeout, local_address, socket_options
+            )
+        try:
+            addresses = await self._resolver.resolve_all(host, timeout)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(
+                    address, port, timeout, local_address, socket_options
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                self._resolver.mark_failed(address)
+                error = e
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+def install_httpx_resolver(transport, resolver):
+    """
+    httpx.AsyncHTTPTransport没有开放network_backend参数，只能直接换掉连接池里的
+    """
+    transport._pool._network_backend = ResolvingNetworkBackend(resolver)
+    return transport
+
+
+class CurlResolveList:
+    """
+    curl的RESOLVE条目 host:port:addr1,addr2
+    curl_cffi只能在session上设curl_options，每个请求都会带上整张表，所以只留最近用过的一些
+    """
+
+    def __init__(self, resolver, limit: int = 256):
+        self._resolver = resolver
+        self.limit = limit
+        self._entries = OrderedDict()
+
+    async def update(self, url: str) -> List[str]:
+        parts = urlsplit(url)
+        host = parts.hostname
+        if not host or is_ip_address(host):
+            return list(self._entries.values())
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = await self._resolver.resolve_all(host)
+        key = "{}:{}".format(host, port)
+        self._entries[key] = "{}:{}".format(
+            key,
+            ",".join(
+                "[{}]".format(address) if ":" in address else address
+                for address in addresses
+            ),
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.limit:
+            self._entries.popitem(last=False)
+        return list(self._entries.values())
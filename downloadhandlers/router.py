@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import importlib
+import inspect
+from typing import Dict, Optional
+from urllib.parse import urldefrag, urlsplit
+
+from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import (
+    HTTP11DownloadHandler as HTTPDownloadHandler,
+)
+from scrapy.crawler import Crawler
+from scrapy.http import Request, Response
+from scrapy.utils.misc import load_object
+
+from .archive import ArchiveWriter, encode_record, request_key
+
+DEFAULT_BACKENDS = {
+    "httpx": ".http2.HttpxDownloadHandler",
+    "ja3": ".ja3.Ja3DownloadHandler",
+    "curl_cffi": ".curl_cffi.CurlCFFIDownloadHandler",
+    "tlsproxy": ".tlsproxy.TLSProxyDownloadHandler",
+    "curl": ".curl.CurlDownloadHandler",
+    "tlscheat": ".tlscheat.TLSCheatDownloadHandler",
+    "replay": ".replay.ReplayDownloadHandler",
+}
+
+
+class RouterDownloadHandler(HTTPDownloadHandler):
+    """
+    一个handler里装下所有后端，按请求分发，没指定的走scrapy自己的twisted
+    用到哪个后端才导入和启动哪个，所以没装curl_cffi之类的也不影响别的
+
+    选后端的顺序
+    1. request.meta['download_backend'] = "curl_cffi"  twisted就写"twisted"
+    2. DOWNLOAD_BACKEND_RULES = {"example.com": "curl_cffi"}  按域名匹配，子域名也算
+    3. 老的meta开关 meta['h2'] -> httpx  meta['ja3'] -> ja3  meta['tls'] -> DOWNLOAD_BACKEND_TLS 默认curl_cffi
+
+    settings.py 中可选
+    DOWNLOAD_BACKENDS  {名字: 类路径} 追加或者覆盖默认的后端
+    DOWNLOAD_ARCHIVE_RECORD  归档路径 设了就把每个请求和响应录下来 ReplayDownloadHandler放
+    """
+
+    def __init__(self, crawler: Optional[Crawler] = None):
+        super().__init__(crawler)
+        self.backend_paths = dict(DEFAULT_BACKENDS)
+        self.backend_paths.update(crawler.settings.getdict("DOWNLOAD_BACKENDS"))
+        self.rules = crawler.settings.getdict("DOWNLOAD_BACKEND_RULES")
+        self.tls_backend = crawler.settings.get("DOWNLOAD_BACKEND_TLS", "curl_cffi")
+        self.stats = crawler.stats
+        self._backends = {}  # type: Dict[str, HTTPDownloadHandler]
+        self._starting = {}  # type: Dict[str, asyncio.Future]
+        path = crawler.settings.get("DOWNLOAD_ARCHIVE_RECORD")
+        self.archive = ArchiveWriter(path) if path else None
+
+    def choose_backend(self, request: Request) -> str:
+        backend = request.meta.get("download_backend")
+        if backend:
+            return backend
+        if self.rules:
+            host = urlsplit(request.url).hostname or ""
+            while host:
+                if host in self.rules:
+                    return self.rules[host]
+                host = host.partition(".")[2]
+        if request.meta.get("h2"):
+            return "httpx"
+        if request.meta.get("ja3"):
+            return "ja3"
+        if request.meta.get("tls"):
+            return self.tls_backend
+        return "twisted"
+
+    async def download_request(self, request: Request) -> Response:
+        name = self.choose_backend(request)
+        self.stats.inc_value(f"downloader/backend/{name}/request_count")
+        response = await self._dispatch(name, request)
+        if self.archive is not None and name != "replay":
+            self.archive.write(
+                request_key(self.crawler, request),
+                encode_record(request, response, name),
+            )
+            self.stats.inc_value("downloader/archive/recorded")
+        return response
+
+    async def _dispatch(self, name: str, request: Request) -> Response:
+        if name == "twisted":
+            return await super().download_request(request)  # 普通下载
+        backend = await self.get_backend(name)
+        timeout = request.meta.get(
+            "download_timeout", self.crawler.settings.getfloat("DOWNLOAD_TIMEOUT")
+        )
+        try:
+            return await asyncio.wait_for(backend._download_request(request), timeout)
+        except asyncio.TimeoutError as e:
+            url = urldefrag(request.url)[0]
+            raise TimeoutError(
+                f"Requesting {url} took longer than {timeout} seconds."
+            ) from e
+
+    async def get_backend(self, name: str) -> HTTPDownloadHandler:
+        backend = self._backends.get(name)
+        if backend is not None:
+            return backend
+        if name not in self._starting:
+            self._starting[name] = asyncio.ensure_future(self._start_backend(name))
+        try:
+            return await asyncio.shield(self._starting[name])
+        finally:
+            if self._starting.get(name) is not None and self._starting[name].done():
+                del self._starting[name]
+
+    async def _start_backend(self, name: str) -> HTTPDownloadHandler:
+        try:
+            path = self.backend_paths[name]
+        except KeyError:
+            raise ValueError(f"Unknown download backend {name!r}") from None
+        if path.startswith("."):
+            module, _, clsname = path.rpartition(".")
+            cls = getattr(importlib.import_module(module, __package__), clsname)
+        else:
+            cls = load_object(path)
+        backend = cls(self.crawler)
+        # engine早就启动了 手动补一次
+        ret = backend.engine_started(
+            signal=signals.engine_started, sender=self.crawler
+        )
+        if inspect.isawaitable(ret):
+            await ret
+        self._backends[name] = backend
+        return backend
+
+    async def close(self):
+        for backend in self._backends.values():
+            await backend.close()
+        self._backends.clear()
+        if self.archive is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.archive.close)
+        await super().close()
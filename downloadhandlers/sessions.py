@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+一个crawler共用的aiohttp session和httpx client，按(用途, 代理)分，spider_closed时统一关掉
+不再每个请求都建一个session 把tcp和tls连接白白扔掉
+
+stats
+aiohttp_session/<用途>/connections_created  新建的连接
+aiohttp_session/<用途>/connections_reused  复用的连接
+aiohttp_session/<用途>/queued_count  连接数到上限排队的次数
+aiohttp_session/<用途>/queued_ms  排队一共等了多久
+aiohttp_session/<用途>/max_open  同时在用的连接最多有几个
+"""
+import asyncio
+import logging
+from typing import Callable, Dict, Optional, Tuple, Union
+
+import aiohttp
+from scrapy import signals
+from scrapy.utils.defer import deferred_from_coro
+
+logger = logging.getLogger(__name__)
+
+SessionKey = Tuple[str, Optional[str]]
+
+
+def _open_connections(connector: aiohttp.BaseConnector) -> int:
+    return len(getattr(connector, "_acquired", ()))
+
+
+def _idle_connections(connector: aiohttp.BaseConnector) -> int:
+    return sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+
+
+class SessionRegistry:
+    """
+    registry = get_session_registry(crawler)
+    session = registry.session("ja3")  协程里调 同一个用途同一个代理拿到的是同一个
+    client = registry.httpx_client("middleware", proxy)  httpx的代理只能设在client上
+
+    settings.py 中可选
+    AIOHTTP_SESSION_LIMIT  每个session最多多少连接 默认100
+    AIOHTTP_SESSION_LIMIT_PER_HOST  每个host最多多少连接 默认0不限
+    AIOHTTP_SESSION_KEEPALIVE  空闲连接留多少秒 默认15
+    """
+
+    def __init__(self, settings, stats=None):
+        self.limit = settings.getint("AIOHTTP_SESSION_LIMIT", 100)
+        self.limit_per_host = settings.getint("AIOHTTP_SESSION_LIMIT_PER_HOST", 0)
+        self.keepalive = settings.getfloat("AIOHTTP_SESSION_KEEPALIVE", 15)
+        self.stats = stats
+        self._sessions = {}  # type: Dict[SessionKey, aiohttp.ClientSession]
+        self._clients = {}  # type: Dict[SessionKey, "httpx.AsyncClient"]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    @classmethod
+    def from_crawler_process(cls, crawler_process, reactor=None):
+        """
+        CrawlerProcess上没有stats和signals(比如DNS_RESOLVER就是拿它建的)
+        整个进程共用 reactor关闭前再关
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        s = cls(crawler_process.settings)
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", lambda: deferred_from_coro(s.close())
+        )
+        return s
+
+    def _connector_kwargs(self) -> dict:
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "keepalive_timeout": self.keepalive,
+        }
+
+    def session(
+        self,
+        purpose: str,
+        proxy: Optional[str] = None,
+        connector: Optional[Callable[..., aiohttp.BaseConnector]] = None,
+        **kwargs,
+    ) -> aiohttp.ClientSession:
+        """
+        connector  建connector的函数 会传limit limit_per_host keepalive_timeout进去 默认TCPConnector
+        kwargs  给ClientSession的参数 只有第一次建的时候有用
+        """
+        key = (purpose, proxy)
+        session = self._sessions.get(key)
+        if session is not None and not session.closed:
+            return session
+        factory = connector or aiohttp.TCPConnector
+        trace_configs = list(kwargs.pop("trace_configs", None) or [])
+        trace_configs.append(self._trace_config(purpose))
+        session = aiohttp.ClientSession(
+            connector=factory(**self._connector_kwargs()),
+            trace_configs=trace_configs,
+            **kwargs,
+        )
+        self._sessions[key] = session
+        return session
+
+    def httpx_client(self, purpose: str, proxy: Optional[str] = None, **kwargs):
+        import httpx
+
+        key = (purpose, proxy)
+        client = self._clients.get(key)
+        if client is not None and not client.is_closed:
+            return client
+        limits = httpx.Limits(
+            max_connections=self.limit or None,
+            keepalive_expiry=self.keepalive,
+        )
+        if proxy is not None:
+            kwargs["proxy"] = proxy
+        client = httpx.AsyncClient(limits=limits, **kwargs)
+        self._clients[key] = client
+        return client
+
+    def _trace_config(self, purpose: str) -> aiohttp.TraceConfig:
+        prefix = f"aiohttp_session/{purpose}"
+        stats = self.stats
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_connection_queued_start(session, context, params):
+            context.queued = asyncio.get_running_loop().time()
+
+        async def on_connection_queued_end(session, context, params):
+            waited = asyncio.get_running_loop().time() - context.queued
+            stats.inc_value(f"{prefix}/queued_count")
+            stats.inc_value(f"{prefix}/queued_ms", int(waited * 1000))
+
+        async def on_connection_create_end(session, context, params):
+            stats.inc_value(f"{prefix}/connections_created")
+            stats.max_value(f"{prefix}/max_open", _open_connections(session.connector))
+
+        async def on_connection_reuseconn(session, context, params):
+            stats.inc_value(f"{prefix}/connections_reused")
+            stats.max_value(f"{prefix}/max_open", _open_connections(session.connector))
+
+        if stats is not None:
+            trace_config.on_connection_queued_start.append(on_connection_queued_start)
+            trace_config.on_connection_queued_end.append(on_connection_queued_end)
+            trace_config.on_connection_create_end.append(on_connection_create_end)
+            trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def connector_stats(self) -> Dict[str, Dict[str, Union[int, None]]]:
+        """现在每个session有多少连接 用途/代理 -> {open idle limit}"""
+        result = {}
+        for (purpose, proxy), session in self._sessions.items():
+            if session.closed:
+                continue
+            connector = session.connector
+            result[f"{purpose}/{proxy}" if proxy else purpose] = {
+                "open": _open_connections(connector),
+                "idle": _idle_connections(connector),
+                "limit": connector.limit,
+            }
+        for (purpose, proxy), client in self._clients.items():
+            if client.is_closed:
+                continue
+            pool = getattr(client._transport, "_pool", None)
+            connections = getattr(pool, "connections", [])
+            idle = sum(1 for connection in connections if connection.is_idle())
+            result[f"httpx:{purpose}/{proxy}" if proxy else f"httpx:{purpose}"] = {
+                "open": len(connections) - idle,
+                "idle": idle,
+                "limit": self.limit or None,
+            }
+        return result
+
+    async def close(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        clients, self._clients = list(self._clients.values()), {}
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        for client in clients:
+            if not client.is_closed:
+                await client.aclose()
+
+    async def spider_closed(self, spider):
+        await self.close()
+
+
+def get_session_registry(crawler, reactor=None) -> SessionRegistry:
+    """
+    同一个crawler或者CrawlerProcess只有一个 第一次用的时候建
+    reactor  CrawlerProcess的registry在这个reactor关闭前关 默认全局的reactor
+    """
+    registry = getattr(crawler, "_session_registry", None)
+    if registry is None:
+        if hasattr(crawler, "signals"):
+            registry = SessionRegistry.from_crawler(crawler)
+        else:
+            registry = SessionRegistry.from_crawler_process(crawler, reactor)
+        crawler._session_registry = registry
+    return registry
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+各个下载后端的分阶段耗时 dns connect tls ttfb transfer total 和收到的字节数
+写进request.meta['download_phases'](response.meta就是它)和crawler.stats的直方图
+
+stats的key
+downloader/phase/<backend>/<阶段>/le_<毫秒>  落在这个桶里的次数 桶是累加的 和prometheus一样
+downloader/phase/<backend>/<阶段>/sum_ms
+downloader/phase/<backend>/<阶段>/count
+downloader/phase/<backend>/bytes
+DOWNLOAD_PHASE_STATS_DOMAINS = True 时再按域名记一份 downloader/phase/<backend>/<域名>/... 默认False
+DOWNLOAD_PHASE_STATS_MAX_DOMAINS  按域名最多记几个 后面来的都算进 <backend>/other 默认100
+
+后端拿不到的阶段就不记，比如aiohttp的tls算在connect里，tlsproxy只知道ttfb和total
+"""
+import time
+from typing import Dict, Optional, Set
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+
+import aiohttp
+from scrapy.http import Request
+
+PHASES = ("dns", "connect", "tls", "ttfb", "transfer", "total")
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# crawler -> 单独记的域名 不往crawler上挂属性 crawler没了跟着释放
+_domains = WeakKeyDictionary()  # type: WeakKeyDictionary[object, Set[str]]
+
+
+def _domain_label(crawler, hostname: Optional[str]) -> str:
+    """先来的前DOWNLOAD_PHASE_STATS_MAX_DOMAINS个域名单独记 其余的都是other"""
+    domains = _domains.setdefault(crawler, set())
+    if hostname in domains:
+        return hostname
+    if hostname and len(domains) < crawler.settings.getint(
+        "DOWNLOAD_PHASE_STATS_MAX_DOMAINS", 100
+    ):
+        domains.add(hostname)
+        return hostname
+    return "other"
+
+
+class DownloadTimer:
+    """
+    一个请求一个 用法
+    timer = DownloadTimer()
+    timer.mark("headers")  # 或者 timer.set("dns", 0.01)
+    timer.record(crawler, request, "ja3")
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}  # type: Dict[str, float]
+        self.bytes = 0
+        self._marks = {"start": self.start}  # type: Dict[str, float]
+
+    def mark(self, name: str):
+        self._marks.setdefault(name, time.perf_counter())
+
+    def since(self, name: str) -> Optional[float]:
+        mark = self._marks.get(name)
+        return None if mark is None else mark - self.start
+
+    def span(self, phase: str, start: str, end: str):
+        if start in self._marks and end in self._marks:
+            self.phases[phase] = self._marks[end] - self._marks[start]
+
+    def set(self, phase: str, seconds: Optional[float]):
+        if seconds is not None and seconds >= 0:
+            self.phases[phase] = seconds
+
+    def record(self, crawler, request: Request, backend: str):
+        self.phases.setdefault("total", time.perf_counter() - self.start)
+        phases = {phase: self.phases[phase] for phase in PHASES if phase in self.phases}
+        request.meta["download_phases"] = dict(
+            phases, backend=backend, bytes=self.bytes
+        )
+        prefixes = [f"downloader/phase/{backend}"]
+        if crawler.settings.getbool("DOWNLOAD_PHASE_STATS_DOMAINS", False):
+            domain = _domain_label(crawler, urlsplit(request.url).hostname)
+            prefixes.append(f"downloader/phase/{backend}/{domain}")
+        stats = crawler.stats
+        for prefix in prefixes:
+            stats.inc_value(f"{prefix}/bytes", self.bytes)
+            for phase, seconds in phases.items():
+                ms = seconds * 1000
+                stats.inc_value(f"{prefix}/{phase}/count")
+                stats.inc_value(f"{prefix}/{phase}/sum_ms", ms)
+                for bucket in BUCKETS_MS:
+                    if ms <= bucket:
+                        stats.inc_value(f"{prefix}/{phase}/le_{bucket}")
+                stats.inc_value(f"{prefix}/{phase}/le_inf")
+
+    def from_curl(self, getinfo, names):
+        """
+        curl的*_TIME都是从开始算的累计值
+        names是(namelookup, connect, appconnect, starttransfer, total)对应的常量
+        """
+        namelookup, connect, appconnect, starttransfer, total = (
+            getinfo(name) for name in names
+        )
+        self.set("dns", namelookup)
+        self.set("connect", connect - namelookup)
+        if appconnect > 0:
+            self.set("tls", appconnect - connect)
+        self.set("ttfb", starttransfer - max(appconnect, connect))
+        self.set("transfer", total - starttransfer)
+        self.set("total", total)
+
+    # httpx/httpcore 的 extensions={"trace": timer.httpx_trace}
+    async def httpx_trace(self, event_name: str, info: dict):
+        self.mark(event_name)
+
+    def finish_httpx(self):
+        self.span(
+            "connect",
+            "connection.connect_tcp.started",
+            "connection.connect_tcp.complete",
+        )
+        self.span(
+            "tls", "connection.start_tls.started", "connection.start_tls.complete"
+        )
+        for proto in ("http11", "http2"):
+            self.span(
+                "ttfb",
+                f"{proto}.send_request_headers.started",
+                f"{proto}.receive_response_headers.complete",
+            )
+        self.span("transfer", "headers", "body")
+
+    def finish_aiohttp(self):
+        self.span("dns", "dns_start", "dns_end")
+        if "dns_end" in self._marks:
+            self.span("connect", "dns_end", "connect_end")  # 建连接的时间里包含了解析
+        else:
+            self.span("connect", "connect_start", "connect_end")
+        self.span("ttfb", "headers_sent", "headers")
+        self.span("transfer", "headers", "body")
+
+
+def aiohttp_trace_config() -> aiohttp.TraceConfig:
+    """
+    session.get(..., trace_request_ctx=DownloadTimer())
+    aiohttp不单独报tls握手 算在connect里
+    """
+
+    async def on_dns_start(session, ctx, params):
+        ctx.trace_request_ctx.mark("dns_start")
+
+    async def on_dns_end(session, ctx, params):
+        ctx.trace_request_ctx.mark("dns_end")
+
+    async def on_connect_start(session, ctx, params):
+        ctx.trace_request_ctx.mark("connect_start")
+
+    async def on_connect_end(session, ctx, params):
+        ctx.trace_request_ctx.mark("connect_end")
+
+    async def on_headers_sent(session, ctx, params):
+        ctx.trace_request_ctx.mark("headers_sent")
+
+    async def on_request_end(session, ctx, params):
+        ctx.trace_request_ctx.mark("headers")
+
+    trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=_TimerContext)
+    trace_config.on_dns_resolvehost_start.append(on_dns_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_end)
+    trace_config.on_connection_create_start.append(on_connect_start)
+    trace_config.on_connection_create_end.append(on_connect_end)
+    trace_config.on_request_headers_sent.append(on_headers_sent)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+class _TimerContext:
+    def __init__(self, trace_request_ctx=None):
+        self.trace_request_ctx = trace_request_ctx or DownloadTimer()
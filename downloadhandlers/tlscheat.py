@@ -2,31 +2,156 @@
 """
 Copyright (c) 2008-2024 synodriver <diguohuangjiajinweijun@gmail.com>
 """
+import asyncio
 import ctypes
+import ctypes.util
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-lib = ctypes.cdll.LoadLibrary("libcomandy.so")
-_request = lib.request
-_request.argtypes = [ctypes.c_char_p]
-_request.restype = ctypes.c_char_p
+from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import (
+    HTTP11DownloadHandler as HTTPDownloadHandler,
+)
+from scrapy.crawler import Crawler
+from scrapy.http import Headers, Request, Response
+from scrapy.responsetypes import responsetypes
 
-_add_dns = lib.add_dns
-_add_dns.argtypes = [ctypes.c_char_p, ctypes.c_int]
-_add_dns.restype = ctypes.c_char_p
+from .body import check_size
+from .timing import DownloadTimer
+
+
+def _libc_free():
+    if sys.platform == "win32":
+        return ctypes.cdll.msvcrt.free
+    return ctypes.CDLL(ctypes.util.find_library("c")).free
+
+
+class Comandy:
+    """
+    libcomandy的ctypes封装
+    返回的字符串是cgo用malloc分配的，要用同一个C运行库的free释放，restype用c_void_p自己拷出来
+    请求和响应都是一个json字符串 body是data里的普通字符串 二进制的body过不来
+    """
+
+    def __init__(self, path: str = "libcomandy.so"):
+        self.lib = ctypes.cdll.LoadLibrary(path)
+        self._request = self.lib.request
+        self._request.argtypes = [ctypes.c_char_p]
+        self._request.restype = ctypes.c_void_p
+        self._add_dns = self.lib.add_dns
+        self._add_dns.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        self._add_dns.restype = ctypes.c_void_p
+        self._free = _libc_free()
+        self._free.argtypes = [ctypes.c_void_p]
+        self._free.restype = None
+
+    def _take(self, ptr) -> Optional[bytes]:
+        if not ptr:
+            return None
+        try:
+            return ctypes.string_at(ptr)
+        finally:
+            self._free(ptr)
+
+    def request(self, payload: dict) -> dict:
+        """阻塞 在线程里调"""
+        ret = self._take(self._request(json.dumps(payload).encode("utf-8")))
+        if ret is None:
+            raise ConnectionError("libcomandy returned NULL")
+        return json.loads(ret)
+
+    def add_dns(self, host: str, port: int) -> Optional[str]:
+        ret = self._take(self._add_dns(host.encode("utf-8"), port))
+        return ret.decode("utf-8") if ret else None
 
-import asyncio
-import json
-from functools import partial
+
+_default = None  # type: Optional[Comandy]
+
+
+def _get_default() -> Comandy:
+    global _default
+    if _default is None:
+        _default = Comandy()
+    return _default
 
 
 async def request(method: str, url: str, headers: dict = None, data: str = None):
     payload = {"method": method, "url": url, "headers": headers or {}}
     if data is not None:
         payload["data"] = data
-    payload = json.dumps(payload).encode("utf-8")
-    ret = await asyncio.get_running_loop().run_in_executor(
-        None, partial(_request, payload)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _get_default().request, payload
     )
-    try:
-        return json.loads(ret.decode("utf8"))
-    finally:
-        ctypes.windll.msvcrt.free(ret)
+
+
+class TLSCheatDownloadHandler(HTTPDownloadHandler):
+    """
+    用libcomandy下载 request.meta['tls'] = {} 启用
+    请求body只能是utf-8文本 二进制的body直接报错 要发就走tlsproxy
+
+    settings.py 中可选
+    TLSCHEAT_LIBRARY  动态库路径 默认libcomandy.so
+    TLSCHEAT_WORKERS  专用线程数 也是同时在跑的请求数上限 默认16
+    """
+
+    def __init__(self, crawler: Optional[Crawler] = None):
+        super().__init__(crawler)
+        settings = crawler.settings
+        self.comandy = Comandy(settings.get("TLSCHEAT_LIBRARY", "libcomandy.so"))
+        workers = settings.getint("TLSCHEAT_WORKERS", 16)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="comandy")
+        self._slots = None  # type: Optional[asyncio.Semaphore]
+        self._workers = workers
+        crawler.signals.connect(self.engine_started, signals.engine_started)
+
+    def engine_started(self, signal, sender):
+        self._slots = asyncio.Semaphore(self._workers)
+
+    async def download_request(self, request: Request) -> Response:
+        if "tls" in request.meta:
+            return await self._download_request(request)
+        return await super().download_request(request)  # 普通下载
+
+    async def _download_request(self, request: Request) -> Response:
+        """转给libcomandy 排队在loop里等 不在线程池队列里堆"""
+        payload = {
+            "method": request.method,
+            "url": request.url,
+            "headers": dict(request.headers.to_unicode_dict()),
+        }
+        if request.body:
+            try:
+                payload["data"] = request.body.decode("utf-8")
+            except UnicodeDecodeError:  # 替换掉的话发出去的body就不对了
+                raise ValueError(
+                    "tlscheat can only send utf-8 request bodies, "
+                    f"{request} has a binary body; use the tlsproxy backend instead"
+                ) from None
+        timer = DownloadTimer()
+        async with self._slots:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.comandy.request, payload
+            )
+        if result.get("error"):
+            raise ConnectionError(result["error"])
+        body = (result.get("data") or "").encode("utf-8")
+        timer.bytes = len(body)
+        timer.record(self.crawler, request, "tlscheat")
+        check_size(request, self.crawler.settings, len(body))
+        headers = Headers(result.get("headers") or {})
+        headers.pop("content-encoding", None)  # 防止scrapy二次解压
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return respcls(
+            url=request.url,
+            status=result["status"],
+            headers=headers,
+            body=body,
+            flags=["tls"],
+            request=request,
+        )
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+        await super().close()
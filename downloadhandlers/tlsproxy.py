@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import base64
-from typing import Optional
+import itertools
+import json
+import logging
+import struct
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
 
 import aiohttp
 from scrapy import signals
@@ -15,18 +21,283 @@ from scrapy.spiders import Spider
 from scrapy.utils.defer import deferred_f_from_coro_f, deferred_from_coro
 from twisted.internet.defer import Deferred
 
+from .body import check_size
+from .sessions import get_session_registry
+from .timing import DownloadTimer
+
+logger = logging.getLogger(__name__)
+
 # ssl._create_default_https_context = ssl._create_unverified_context
 
+FRAME_REQUEST = 0
+FRAME_RESPONSE = 1  # 元数据里more为true的话 body接着用FRAME_BODY分段发 length是body总长 可以不给
+FRAME_ERROR = 2
+FRAME_BODY = 3  # {"more": bool} + 一段body 最后一段more为false
+FRAME_CANCEL = 4  # 客户端不要了 代理停掉这个请求
+FRAME_HEADER = struct.Struct("!IBI")  # 请求id 帧类型 元数据长度
+
+
+def encode_frame(stream_id: int, kind: int, meta: dict, body: bytes = b"") -> bytes:
+    """
+    一个websocket二进制消息就是一帧
+    | id 4字节 | 类型 1字节 | json长度 4字节 | json | body原样 |
+    """
+    data = json.dumps(meta, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(stream_id, kind, len(data)) + data + body
+
+
+def decode_frame(frame: bytes) -> Tuple[int, int, dict, bytes]:
+    stream_id, kind, length = FRAME_HEADER.unpack_from(frame)
+    start = FRAME_HEADER.size
+    meta = json.loads(frame[start : start + length])
+    return stream_id, kind, meta, frame[start + length :]
+
+
+class _FramedResponse:
+    """一个请求的响应 头在FRAME_RESPONSE里 body可能跟着好几个FRAME_BODY"""
+
+    __slots__ = ("future", "check", "meta", "chunks", "size")
+
+    def __init__(self, future: asyncio.Future, check: Optional[Callable] = None):
+        self.future = future
+        self.check = check
+        self.meta = None  # type: Optional[dict]
+        self.chunks = []  # type: List[bytes]
+        self.size = 0
+
+    def feed(self, kind: int, meta: dict, body: bytes) -> bool:
+        """返回收完了没有 超过大小check会抛异常"""
+        if kind == FRAME_RESPONSE:
+            self.meta = meta
+            if self.check is not None and meta.get("length") is not None:
+                self.check(meta["length"], True)
+        elif self.meta is None:
+            raise ConnectionError("tlsproxy sent body before headers")
+        if body:
+            self.size += len(body)
+            if self.check is not None:
+                self.check(self.size, False)
+            self.chunks.append(body)
+        return not meta.get("more", False)
+
+
+class FramedTLSProxyClient:
+    """
+    和tlsproxy之间一条常驻websocket，请求按id复用在上面，body不再base64
+    断了就让在等的请求都失败，下一个请求再重连
+    body超过大小或者请求被取消 发FRAME_CANCEL让代理别再发了
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str):
+        self.session = session
+        self.url = url
+        self._ws = None  # type: Optional[aiohttp.ClientWebSocketResponse]
+        self._reader = None  # type: Optional[asyncio.Task]
+        self._connecting = None  # type: Optional[asyncio.Future]
+        self._ids = itertools.count(1)
+        self._pending = {}  # type: Dict[int, _FramedResponse]
+
+    async def _connect(self) -> aiohttp.ClientWebSocketResponse:
+        if self._ws is not None and not self._ws.closed:
+            return self._ws
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(
+                self.session.ws_connect(self.url, max_msg_size=0, autoping=True)
+            )
+        try:
+            ws = await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+        if self._ws is not ws:
+            self._ws = ws
+            self._reader = asyncio.ensure_future(self._read(ws))
+        return ws
+
+    async def _read(self, ws: aiohttp.ClientWebSocketResponse):
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.BINARY:
+                    continue
+                stream_id, kind, meta, body = decode_frame(message.data)
+                response = self._pending.get(stream_id)
+                if response is None:
+                    continue  # 已经取消了的请求
+                if response.future.done():
+                    del self._pending[stream_id]
+                    continue
+                try:
+                    if kind == FRAME_ERROR:
+                        raise ConnectionError(meta.get("error", "tlsproxy error"))
+                    finished = response.feed(kind, meta, body)
+                except Exception as e:
+                    del self._pending[stream_id]
+                    response.future.set_exception(e)
+                    if kind != FRAME_ERROR:
+                        asyncio.ensure_future(self._cancel(ws, stream_id))
+                    continue
+                if finished:
+                    del self._pending[stream_id]
+                    response.future.set_result(
+                        (response.meta, b"".join(response.chunks))
+                    )
+        finally:
+            pending, self._pending = self._pending, {}
+            for response in pending.values():
+                if not response.future.done():
+                    response.future.set_exception(
+                        ConnectionError("tlsproxy connection lost")
+                    )
+
+    async def _cancel(self, ws: aiohttp.ClientWebSocketResponse, stream_id: int):
+        if ws.closed:
+            return
+        try:
+            await ws.send_bytes(encode_frame(stream_id, FRAME_CANCEL, {}))
+        except (ConnectionError, aiohttp.ClientError):
+            pass
+
+    async def request(
+        self, meta: dict, body: bytes, check: Optional[Callable] = None
+    ) -> Tuple[dict, bytes]:
+        """
+        check(size, expected)  收body的时候调 抛异常就不收了 比如超过DOWNLOAD_MAXSIZE
+        """
+        ws = await self._connect()
+        stream_id = next(self._ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._pending[stream_id] = _FramedResponse(future, check)
+        try:
+            await ws.send_bytes(encode_frame(stream_id, FRAME_REQUEST, meta, body))
+            return await future
+        finally:
+            if self._pending.pop(stream_id, None) is not None:  # 被取消了 还没收完
+                asyncio.ensure_future(self._cancel(ws, stream_id))
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await self._reader
+
+
+TLS_OPTIONS = frozenset(
+    [
+        "header_order",
+        "pheader_order",
+        "verify",
+        "cert",
+        "ja3",
+        "force_http1",
+        "supported_signature_algorithms",
+        "cert_compression_algo",
+        "record_size_limit",
+        "delegated_credentials",
+        "supported_versions",
+        "pskkey_exchange_modes",
+        "signature_algorithms_cert",
+        "key_share_curves",
+        "h2settings",
+        "h2settings_order",
+        "h2connectionflow",
+        "h2headerpriority",
+        "h2priorityframes",
+    ]
+)
+
+
+class TLSProfileRegistry:
+    """
+    TLSPROXY_PROFILES = {
+        "chrome120": {"ja3": "771,4865-...", "h2settings": {...}, "header_order": [...]},
+    }
+    启动时整理好，请求里写meta['tls'] = {"profile": "chrome120", "verify": False}
+    tlsproxy支持注册的话 只发profile名字和覆盖的字段
+    """
+
+    def __init__(self, profiles: Optional[Dict[str, dict]] = None):
+        self.profiles = {}  # type: Dict[str, dict]
+        self.registered = set()
+        for name, options in (profiles or {}).items():
+            unknown = set(options) - TLS_OPTIONS
+            if unknown:
+                raise ValueError(
+                    f"Unknown tls options {sorted(unknown)} in profile {name!r}"
+                )
+            self.profiles[name] = dict(options)
+
+    async def register(self, client: aiohttp.ClientSession, url: str):
+        """把profile挨个POST给tlsproxy 返回2xx的才算注册上"""
+        for name, options in self.profiles.items():
+            try:
+                async with client.post(
+                    url, json={"name": name, "options": options}
+                ) as response:
+                    if response.status < 300:
+                        self.registered.add(name)
+            except aiohttp.ClientError:
+                pass
+        if len(self.registered) < len(self.profiles):
+            logger.info(
+                "tlsproxy accepted %d of %d tls profiles, the rest are sent inline",
+                len(self.registered),
+                len(self.profiles),
+            )
+
+    def resolve(self, tls: dict) -> dict:
+        """meta['tls'] -> 要发给tlsproxy的字段"""
+        options = {key: value for key, value in tls.items() if key in TLS_OPTIONS}
+        name = tls.get("profile")
+        if name is None:
+            return options
+        try:
+            profile = self.profiles[name]
+        except KeyError:
+            raise ValueError(f"Unknown tls profile {name!r}") from None
+        if name in self.registered:
+            options["profile"] = name
+            return options
+        return {**profile, **options}
+
 
 class TLSProxyDownloadHandler(HTTPDownloadHandler):
+    """
+    settings.py 中可选
+    TLSPROXY  json接口 默认http://127.0.0.1:11000/request
+    TLSPROXY_TRANSPORT  "json"每个请求POST一次json  "ws"走一条websocket发二进制帧 默认json
+    TLSPROXY_WS  ws接口 默认ws://127.0.0.1:11000/ws
+    TLSPROXY_UNIX_SOCKET  tlsproxy监听的unix socket路径 设了就不走tcp
+    TLSPROXY_PROFILES  {名字: tls参数} 见TLSProfileRegistry
+    TLSPROXY_PROFILE_URL  tlsproxy注册profile的接口 不设就每次把profile内容带上
+    """
+
     def __init__(self, crawler: Optional[Crawler] = None):
         super().__init__(crawler)
         self.client = None  # type: aiohttp.ClientSession
+        self.framed = None  # type: Optional[FramedTLSProxyClient]
+        self.profiles = TLSProfileRegistry(
+            crawler.settings.getdict("TLSPROXY_PROFILES")
+        )
         crawler.signals.connect(self.engine_started, signals.engine_started)
 
     async def engine_started(self, signal, sender):
-        client = aiohttp.ClientSession()
-        self.client = await client.__aenter__()
+        settings = self.crawler.settings
+        connector = None
+        if settings.get("TLSPROXY_UNIX_SOCKET"):
+            connector = partial(
+                aiohttp.UnixConnector, settings.get("TLSPROXY_UNIX_SOCKET")
+            )
+        self.client = get_session_registry(self.crawler).session(
+            "tlsproxy", connector=connector
+        )
+        if settings.get("TLSPROXY_TRANSPORT", "json") == "ws":
+            self.framed = FramedTLSProxyClient(
+                self.client, settings.get("TLSPROXY_WS", "ws://127.0.0.1:11000/ws")
+            )
+        if settings.get("TLSPROXY_PROFILE_URL") and self.profiles.profiles:
+            await self.profiles.register(
+                self.client, settings.get("TLSPROXY_PROFILE_URL")
+            )
 
     async def download_request(self, request: Request) -> Response:
         """
@@ -38,85 +309,29 @@ class TLSProxyDownloadHandler(HTTPDownloadHandler):
 
     async def _download_request(self, request: Request) -> Response:
         """转发给tlsproxy下载逻辑"""
-        post_data = {
-            "method": request.method,
-            "url": request.url,
-            "timeout": request.meta.get(
-                "download_timeout", self.crawler.settings.get("DOWNLOAD_TIMEOUT")
-            ),
-            "headers": request.headers.to_unicode_dict(),
-        }
+        timer = DownloadTimer()
+        post_data = self._build_payload(request)
+        if self.framed is not None:
+            return await self._download_framed(request, post_data, timer)
         if request.body:
             post_data["body"] = base64.b64encode(request.body).decode()
-        if "proxy" in request.meta:
-            post_data["proxy"] = request.meta["proxy"]
-        if "header_order" in request.meta["tls"]:
-            post_data["header_order"] = request.meta["tls"]["header_order"]
-        if "pheader_order" in request.meta["tls"]:
-            post_data["pheader_order"] = request.meta["tls"]["pheader_order"]
-        if request.meta.get(
-            "dont_redirect", False
-        ):  # and not spider.settings.get("REDIRECT_ENABLED", True):
-            post_data["allow_redirects"] = False
-        if "dont_redirect" not in request.meta and not self.crawler.settings.get(
-            "REDIRECT_ENABLED", True
-        ):
-            post_data["allow_redirects"] = False
-        if "verify" in request.meta["tls"]:
-            post_data["verify"] = request.meta["tls"]["verify"]
-        if "cert" in request.meta["tls"]:
-            post_data["cert"] = request.meta["tls"]["cert"]
-        if "ja3" in request.meta["tls"]:
-            post_data["ja3"] = request.meta["tls"]["ja3"]
-        if "force_http1" in request.meta["tls"]:
-            post_data["force_http1"] = request.meta["tls"]["force_http1"]
-        if "supported_signature_algorithms" in request.meta["tls"]:
-            post_data["supported_signature_algorithms"] = request.meta["tls"][
-                "supported_signature_algorithms"
-            ]
-        if "cert_compression_algo" in request.meta["tls"]:
-            post_data["cert_compression_algo"] = request.meta["tls"][
-                "cert_compression_algo"
-            ]
-        if "record_size_limit" in request.meta["tls"]:
-            post_data["record_size_limit"] = request.meta["tls"]["record_size_limit"]
-        if "delegated_credentials" in request.meta["tls"]:
-            post_data["delegated_credentials"] = request.meta["tls"][
-                "delegated_credentials"
-            ]
-        if "supported_versions" in request.meta["tls"]:
-            post_data["supported_versions"] = request.meta["tls"]["supported_versions"]
-        if "pskkey_exchange_modes" in request.meta["tls"]:
-            post_data["pskkey_exchange_modes"] = request.meta["tls"][
-                "pskkey_exchange_modes"
-            ]
-        if "signature_algorithms_cert" in request.meta["tls"]:
-            post_data["signature_algorithms_cert"] = request.meta["tls"][
-                "signature_algorithms_cert"
-            ]
-        if "key_share_curves" in request.meta["tls"]:
-            post_data["key_share_curves"] = request.meta["tls"]["key_share_curves"]
-        if "h2settings" in request.meta["tls"]:
-            post_data["h2settings"] = request.meta["tls"]["h2settings"]
-        if "h2settings_order" in request.meta["tls"]:
-            post_data["h2settings_order"] = request.meta["tls"]["h2settings_order"]
-        if "h2connectionflow" in request.meta["tls"]:
-            post_data["h2connectionflow"] = request.meta["tls"]["h2connectionflow"]
-        if "h2headerpriority" in request.meta["tls"]:
-            post_data["h2headerpriority"] = request.meta["tls"]["h2headerpriority"]
-        if "h2priorityframes" in request.meta["tls"]:
-            post_data["h2priorityframes"] = request.meta["tls"]["h2priorityframes"]
 
         async with self.client.post(
             self.crawler.settings.get("TLSPROXY", "http://127.0.0.1:11000/request"),
             json=post_data,
         ) as response:
+            timer.mark("headers")
             # headers = Headers(response.headers)
             respjson = await response.json()
             status = respjson["status"]
             headers = Headers(respjson["headers"])
-            del headers["content-encoding"]  # 防止scrapy二次解压
+            headers.pop("content-encoding", None)  # 防止scrapy二次解压
             body = base64.b64decode(respjson["body"])
+            timer.mark("body")
+            timer.span("ttfb", "start", "headers")
+            timer.span("transfer", "headers", "body")
+            timer.bytes = len(body)
+            timer.record(self.crawler, request, "tlsproxy")
             respcls = responsetypes.from_args(
                 headers=headers, url=str(response.url), body=body
             )
@@ -130,6 +345,59 @@ class TLSProxyDownloadHandler(HTTPDownloadHandler):
                 # protocol=response.version,
             )
 
+    async def _download_framed(
+        self, request: Request, post_data: dict, timer: DownloadTimer
+    ) -> Response:
+        """二进制帧 body直接跟在元数据后面 超过DOWNLOAD_MAXSIZE马上不收了"""
+        settings = self.crawler.settings
+        meta, body = await self.framed.request(
+            post_data,
+            request.body,
+            lambda size, expected: check_size(
+                request, settings, size, expected, warn=False
+            ),
+        )
+        timer.bytes = len(body)
+        timer.record(self.crawler, request, "tlsproxy")
+        check_size(request, settings, len(body))  # DOWNLOAD_WARNSIZE只打一次
+        url = meta.get("url", request.url)
+        headers = Headers(meta["headers"])
+        headers.pop("content-encoding", None)  # 防止scrapy二次解压
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(
+            url=url,
+            status=meta["status"],
+            headers=headers,
+            body=body,
+            flags=["tls"],
+            request=request,
+        )
+
+    def _build_payload(self, request: Request) -> dict:
+        post_data = {
+            "method": request.method,
+            "url": request.url,
+            "timeout": request.meta.get(
+                "download_timeout", self.crawler.settings.get("DOWNLOAD_TIMEOUT")
+            ),
+            "headers": dict(request.headers.to_unicode_dict()),
+        }
+        if "proxy" in request.meta:
+            post_data["proxy"] = request.meta["proxy"]
+        if request.meta.get(
+            "dont_redirect", False
+        ):  # and not spider.settings.get("REDIRECT_ENABLED", True):
+            post_data["allow_redirects"] = False
+        if "dont_redirect" not in request.meta and not self.crawler.settings.get(
+            "REDIRECT_ENABLED", True
+        ):
+            post_data["allow_redirects"] = False
+        # router或者AdaptiveBackendMiddleware选过来的请求可以没有meta['tls'] 用tlsproxy默认的指纹
+        post_data.update(self.profiles.resolve(request.meta.get("tls") or {}))
+        return post_data
+
     async def close(self):
-        await self.client.__aexit__(None, None, None)
+        if self.framed is not None:
+            await self.framed.close()
+        # session归SessionRegistry管 spider_closed时关
         await super().close()
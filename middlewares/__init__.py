@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 from .aiohttp import AiohttpMiddleware
+from .backend import AdaptiveBackendMiddleware
 from .phppath import PHPPathMiddleware
+from .proxypool import ProxyPoolMiddleware
 from .randomua import RandomUAMiddleware
 from .retry import LoggedRetryMiddleware
 
 __all__ = [
     "AiohttpMiddleware",
+    "AdaptiveBackendMiddleware",
     "PHPPathMiddleware",
+    "ProxyPoolMiddleware",
     "RandomUAMiddleware",
     "LoggedRetryMiddleware",
 ]
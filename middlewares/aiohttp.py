@@ -5,6 +5,8 @@ import aiohttp
 import scrapy
 from scrapy import signals
 
+from downloadhandlers.sessions import SessionRegistry, get_session_registry
+
 logger = logging.getLogger(__name__)
 
 
@@ -12,12 +14,16 @@ class AiohttpMiddleware:
     """
     scrapy timeout就用aiohttp试试
     用于解决一些蜜汁bug
+    session从SessionRegistry拿 按代理分开复用
     """
 
+    def __init__(self, sessions: SessionRegistry):
+        self.sessions = sessions
+
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(get_session_registry(crawler))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
@@ -32,17 +38,18 @@ class AiohttpMiddleware:
             logger.debug("使用aiohttp进行尝试")
             url = request.url
             headers = dict(request.headers.to_unicode_dict())
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as resp:
-                    html: bytes = await resp.read()
-                    return scrapy.http.HtmlResponse(
-                        url=request.url,
-                        status=resp.status,
-                        headers=request.headers,
-                        body=html,
-                        request=request,
-                        encoding=resp.get_encoding(),
-                    )
+            proxy = request.meta.get("proxy")
+            session = self.sessions.session("middleware", proxy)
+            async with session.get(url, headers=headers, proxy=proxy) as resp:
+                html: bytes = await resp.read()
+                return scrapy.http.HtmlResponse(
+                    url=request.url,
+                    status=resp.status,
+                    headers=request.headers,
+                    body=html,
+                    request=request,
+                    encoding=resp.get_encoding(),
+                )
 
     def process_response(self, request, response, spider):
         return response
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+按域名自己学该走哪个下载后端，配合downloadhandlers.RouterDownloadHandler用
+"""
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import scrapy
+from scrapy import signals
+from scrapy.utils.misc import load_object
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ORDER = ["twisted", "httpx", "ja3", "curl_cffi", "tlsproxy"]
+DEFAULT_BLOCK_SIGNATURES = [
+    "cf-chl-",
+    "Just a moment...",
+    "_Incapsula_Resource",
+    "px-captcha",
+    "distil_r_captcha",
+]
+# 连接层面的错误 换个后端可能就好了 装了哪个后端认哪个
+DEFAULT_SWITCH_EXCEPTIONS = [
+    "builtins.ConnectionError",
+    "builtins.TimeoutError",  # 各个后端的超时都转成了这个
+    "twisted.internet.error.ConnectError",
+    "twisted.internet.error.ConnectionLost",
+    "twisted.internet.error.ConnectionDone",
+    "twisted.internet.error.TCPTimedOutError",
+    "twisted.internet.error.TimeoutError",
+    "twisted.web.client.ResponseFailed",
+    "scrapy.core.downloader.handlers.http11.TunnelError",
+    "aiohttp.ClientConnectionError",
+    "httpx.TransportError",
+    "curl_cffi.CurlError",
+    "pycurl.error",
+]
+
+
+def load_exceptions(paths: List[str]) -> Tuple[type, ...]:
+    exceptions = []
+    for path in paths:
+        try:
+            exceptions.append(load_object(path) if isinstance(path, str) else path)
+        except (ImportError, NameError):  # 没装这个后端
+            continue
+    return tuple(exceptions)
+
+
+def download_latency(request: scrapy.Request) -> Optional[float]:
+    """
+    scrapy自己的handler写meta['download_latency']
+    router直接调的httpx ja3 curl_cffi tlsproxy之类的只写了meta['download_phases']
+    """
+    latency = request.meta.get("download_latency")
+    if latency is None:
+        latency = (request.meta.get("download_phases") or {}).get("total")
+    return latency
+
+
+class BackendStats:
+    __slots__ = ("successes", "failures", "streak", "latency", "demoted_until")
+
+    def __init__(
+        self,
+        successes: int = 0,
+        failures: int = 0,
+        streak: int = 0,
+        latency: Optional[float] = None,
+        demoted_until: float = 0.0,
+    ):
+        self.successes = successes
+        self.failures = failures
+        self.streak = streak  # 连续失败次数
+        self.latency = latency
+        self.demoted_until = demoted_until
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class AdaptiveBackendMiddleware:
+    """
+    没手动指定后端的请求，按域名选最便宜的还能用的后端，写进meta['download_backend']
+    被拦(状态码 页面特征 异常)了就记一次失败，平均耗时太长也算，连续失败够次数就降级一段时间
+    只有连接出错 ADAPTIVE_BACKEND_SWITCH_CODES 页面特征这几种才马上换下一个后端重发 一个请求最多换MAX_HOPS次
+
+    需要 DOWNLOAD_HANDLERS = {"http": "...RouterDownloadHandler", "https": "...RouterDownloadHandler"}
+    DOWNLOADER_MIDDLEWARES = {"...AdaptiveBackendMiddleware": 560}  要比RetryMiddleware(550)靠近下载器
+
+    settings.py 中可选
+    ADAPTIVE_BACKEND_ORDER  从便宜到贵 默认twisted httpx ja3 curl_cffi tlsproxy
+    ADAPTIVE_BACKEND_BLOCK_CODES  算作被拦的状态码 默认403 503
+    ADAPTIVE_BACKEND_BLOCK_SIGNATURES  body前8KB里出现就算被拦
+    ADAPTIVE_BACKEND_SWITCH_CODES  被拦的状态码里哪些马上换后端重发 默认403
+    ADAPTIVE_BACKEND_SWITCH_EXCEPTIONS  哪些异常马上换后端重发 默认连接错误和超时
+    ADAPTIVE_BACKEND_MAX_HOPS  一个请求最多换几次后端 默认1
+    ADAPTIVE_BACKEND_MAX_FAILURES  连续失败几次降级 默认2
+    ADAPTIVE_BACKEND_RETRY_AFTER  降级多少秒后再试便宜的 默认3600
+    ADAPTIVE_BACKEND_MAX_LATENCY  平均响应(指数移动平均)超过这么多秒也算失败 默认0不限
+    ADAPTIVE_BACKEND_PATH  学到的表存在哪 json 不设就不保存
+    """
+
+    def __init__(self, settings, stats=None):
+        self.order = settings.getlist("ADAPTIVE_BACKEND_ORDER") or list(DEFAULT_ORDER)
+        self.block_codes = set(
+            int(code)
+            for code in settings.getlist("ADAPTIVE_BACKEND_BLOCK_CODES", [403, 503])
+        )
+        self.signatures = [
+            signature.encode() if isinstance(signature, str) else signature
+            for signature in settings.getlist(
+                "ADAPTIVE_BACKEND_BLOCK_SIGNATURES", DEFAULT_BLOCK_SIGNATURES
+            )
+        ]
+        self.switch_codes = set(
+            int(code)
+            for code in settings.getlist("ADAPTIVE_BACKEND_SWITCH_CODES", [403])
+        )
+        self.switch_exceptions = load_exceptions(
+            settings.getlist(
+                "ADAPTIVE_BACKEND_SWITCH_EXCEPTIONS", DEFAULT_SWITCH_EXCEPTIONS
+            )
+        )
+        self.max_hops = settings.getint("ADAPTIVE_BACKEND_MAX_HOPS", 1)
+        self.max_failures = settings.getint("ADAPTIVE_BACKEND_MAX_FAILURES", 2)
+        self.retry_after = settings.getfloat("ADAPTIVE_BACKEND_RETRY_AFTER", 3600)
+        self.max_latency = settings.getfloat("ADAPTIVE_BACKEND_MAX_LATENCY", 0)
+        self.path = settings.get("ADAPTIVE_BACKEND_PATH")
+        self.stats = stats
+        self.table = {}  # type: Dict[str, Dict[str, BackendStats]]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        spider.logger.info(
+            "Spider  %s opened middleware: %s" % (spider.name, self.__class__.__name__)
+        )
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.table = {
+                domain: {
+                    backend: BackendStats(**values)
+                    for backend, values in backends.items()
+                }
+                for domain, backends in data.items()
+            }
+
+    def spider_closed(self, spider):
+        if not self.path:
+            return
+        data = {
+            domain: {backend: stats.to_dict() for backend, stats in backends.items()}
+            for domain, backends in self.table.items()
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _manual(request: scrapy.Request) -> bool:
+        if request.meta.get("adaptive_backend"):
+            return False
+        return any(
+            key in request.meta for key in ("download_backend", "tls", "ja3", "h2")
+        )
+
+    def choose(self, domain: str, exclude: List[str] = ()) -> str:
+        backends = self.table.get(domain, {})
+        now = time.time()
+        for name in self.order:
+            if name in exclude:
+                continue
+            stats = backends.get(name)
+            if stats is None or stats.demoted_until <= now:
+                return name
+        # 全都降级了 挑降级最早结束的
+        candidates = [name for name in self.order if name not in exclude] or self.order
+        return min(
+            candidates,
+            key=lambda name: backends[name].demoted_until if name in backends else 0,
+        )
+
+    def process_request(self, request: scrapy.Request, spider):
+        if self._manual(request):
+            return None
+        domain = urlsplit(request.url).hostname or ""
+        backend = self.choose(domain, request.meta.get("adaptive_backend_tried", []))
+        request.meta["download_backend"] = backend
+        request.meta["adaptive_backend"] = True
+        return None
+
+    def _record(self, request, success: bool, latency: Optional[float] = None):
+        domain = urlsplit(request.url).hostname or ""
+        backend = request.meta["download_backend"]
+        stats = self.table.setdefault(domain, {}).setdefault(backend, BackendStats())
+        if latency is not None:
+            stats.latency = (
+                latency
+                if stats.latency is None
+                else 0.8 * stats.latency + 0.2 * latency
+            )
+            if success and self.max_latency and stats.latency > self.max_latency:
+                success = False  # 一直这么慢 不如换个后端
+                if self.stats is not None:
+                    self.stats.inc_value(f"adaptive_backend/{backend}/slow")
+        if success:
+            stats.successes += 1
+            stats.streak = 0
+            stats.demoted_until = 0.0
+            if self.stats is not None:
+                self.stats.inc_value(f"adaptive_backend/{backend}/successes")
+            return
+        stats.failures += 1
+        stats.streak += 1
+        if self.stats is not None:
+            self.stats.inc_value(f"adaptive_backend/{backend}/failures")
+        if stats.streak >= self.max_failures:
+            stats.demoted_until = time.time() + self.retry_after
+            stats.latency = None  # 过了降级时间重新算
+            logger.info("Demoted backend %s for %s", backend, domain)
+
+    def _signature(self, response) -> bool:
+        head = response.body[:8192]
+        return any(signature in head for signature in self.signatures)
+
+    def _next(self, request: scrapy.Request):
+        """换下一个后端立刻重发 换够MAX_HOPS次或者都试过了就放弃"""
+        tried = list(request.meta.get("adaptive_backend_tried", []))
+        tried.append(request.meta["download_backend"])
+        if len(tried) > self.max_hops or len(tried) >= len(self.order):
+            return None
+        retryreq = request.copy()
+        retryreq.meta["adaptive_backend_tried"] = tried
+        retryreq.dont_filter = True
+        if self.stats is not None:
+            self.stats.inc_value("adaptive_backend/switched")
+        return retryreq
+
+    def process_response(self, request: scrapy.Request, response, spider):
+        if not request.meta.get("adaptive_backend"):
+            return response
+        signature = self._signature(response)
+        if signature or response.status in self.block_codes:
+            self._record(request, False)
+            if signature or response.status in self.switch_codes:
+                return self._next(request) or response
+            return response
+        self._record(request, True, download_latency(request))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not request.meta.get("adaptive_backend"):
+            return None
+        self._record(request, False)
+        if isinstance(exception, self.switch_exceptions):
+            return self._next(request)
+        return None
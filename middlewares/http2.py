@@ -4,20 +4,27 @@ import logging
 import httpx
 import scrapy
 from scrapy import signals
+from scrapy.http import Headers
 from scrapy.responsetypes import responsetypes
 
+from downloadhandlers.sessions import SessionRegistry, get_session_registry
+
 logger = logging.getLogger(__name__)
 
 
 class HttpxMiddleware:
     """
     可以下载http2 处理socks代理
+    client从SessionRegistry拿 httpx的代理设在client上 所以每个代理一个client
     """
 
+    def __init__(self, sessions: SessionRegistry):
+        self.sessions = sessions
+
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(get_session_registry(crawler))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
@@ -29,20 +36,24 @@ class HttpxMiddleware:
     async def process_request(self, request: scrapy.Request, spider):
         logger.info("进来的meta是 {0}".format(request.meta))
         if request.meta.get("use_httpx", False):
-            async with httpx.AsyncClient() as client:
-                req = client.build_request(request.method, request.url)
-                resp = await client.send(req)
-                body = resp.read()
-                resp_cls: type = responsetypes.from_args(
-                    headers=resp.headers, url=resp.url, body=resp.text
-                )
-                response = resp_cls(
-                    url=resp.url,
-                    status=resp.status_code,
-                    headers=resp.headers,
-                    body=body,
-                )
-                return response
+            client = self.sessions.httpx_client("middleware", request.meta.get("proxy"))
+            req = client.build_request(request.method, request.url)
+            resp = await client.send(req)
+            body = resp.read()
+            headers = Headers()
+            for key, value in resp.headers.multi_items():
+                headers.appendlist(key, value)
+            resp_cls: type = responsetypes.from_args(
+                headers=headers, url=str(resp.url), body=body
+            )
+            response = resp_cls(
+                url=str(resp.url),
+                status=resp.status_code,
+                headers=headers,
+                body=body,
+                request=request,
+            )
+            return response
 
     def process_response(self, request, response, spider):
         return response
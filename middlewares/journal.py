@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+放弃重试的请求的记录
+格式 只追加 一条一条的 RECORD_HEADER(长度) + pickle({"request": request.to_dict(), "reason", "retries", "time"})
+和scrapy的JOBDIR磁盘队列一样用pickle，meta里的tuple之类的都能原样还原
+"""
+import logging
+import pickle
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+import scrapy
+
+try:
+    from scrapy.utils.request import request_from_dict
+except ImportError:  # scrapy < 2.6
+    from scrapy.utils.reqser import request_from_dict, request_to_dict
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("!I")
+
+# 和这次下载有关的meta 重放的时候去掉
+TRANSIENT_META = (
+    "retry_times",
+    "download_latency",
+    "download_phases",
+    "download_slot",
+    "is_start_request",
+    "adaptive_backend_tried",
+    "proxy_pool_tried",
+    "_proxy_pool_released",
+)
+
+
+def dump_request(request: scrapy.Request, spider, reason: str, retries: int) -> bytes:
+    if hasattr(request, "to_dict"):
+        data = request.to_dict(spider=spider)
+    else:
+        data = request_to_dict(request, spider)
+    record = {
+        "request": data,
+        "reason": reason,
+        "retries": retries,
+        "time": time.time(),
+    }
+    try:
+        payload = pickle.dumps(record, protocol=4)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        # meta里有存不了的对象 只丢掉这几个key
+        meta = {}
+        for key, value in (data.get("meta") or {}).items():
+            try:
+                pickle.dumps(value, protocol=4)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                logger.warning("Dropped unpicklable meta %r of %s", key, request)
+                continue
+            meta[key] = value
+        data["meta"] = meta
+        payload = pickle.dumps(record, protocol=4)
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+
+def iter_journal(path: str) -> Iterator[dict]:
+    """一条一条读出来 最后一条没写完的跳过"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            (size,) = RECORD_HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                logger.warning("Truncated record at the end of %s", path)
+                return
+            yield pickle.loads(payload)
+
+
+def load_failed_requests(path: str, spider=None) -> Iterator[scrapy.Request]:
+    """
+    还原成Request 重试次数清零 不过滤重复
+    def start_requests(self):
+        yield from load_failed_requests("failed.journal", self)
+    """
+    for record in iter_journal(path):
+        request = request_from_dict(record["request"], spider=spider)
+        for key in TRANSIENT_META:
+            request.meta.pop(key, None)
+        request.dont_filter = True
+        yield request
+
+
+class JournalWriter:
+    """
+    攒够buffer_size字节或者过了flush_interval秒，就交给后台线程写一次，reactor上不碰文件
+    writer.write(data)  不阻塞
+    writer.flush()  不阻塞 定时调
+    writer.close()  阻塞 等剩下的都写完
+    """
+
+    def __init__(
+        self, path: str, buffer_size: int = 64 * 1024, flush_interval: float = 5
+    ):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer = []  # type: List[bytes]
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._file = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="journal")
+        self.count = 0
+
+    def write(self, data: bytes):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.count += 1
+        if (
+            self._buffered >= self.buffer_size
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        chunks, self._buffer, self._buffered = self._buffer, [], 0
+        self._executor.submit(self._write, chunks)
+
+    def _write(self, chunks: List[bytes]):
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.writelines(chunks)
+            self._file.flush()
+        except Exception:
+            logger.exception("Failed to write %s records to %s", len(chunks), self.path)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
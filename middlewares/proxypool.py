@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+代理池 按成功率 延迟 被封的信号给代理打分，给请求分配meta['proxy']
+各个下载后端按代理分开复用连接(httpx按(origin, proxy)建池 curl_cffi按(指纹, proxy)分session
+aiohttp和pycurl自己按代理复用)，所以同一个代理的请求都走热连接
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import scrapy
+from scrapy import signals
+
+from .backend import download_latency
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyState:
+    __slots__ = (
+        "url",
+        "successes",
+        "failures",
+        "streak",
+        "bans",
+        "latency",
+        "in_flight",
+        "banned_until",
+    )
+
+    def __init__(self, url: str):
+        self.url = url
+        self.successes = 0
+        self.failures = 0
+        self.streak = 0  # 连续失败次数
+        self.bans = 0
+        self.latency = None  # type: Optional[float]
+        self.in_flight = 0
+        self.banned_until = 0.0
+
+    def score(self, latency_ref: float) -> float:
+        """成功率(拉普拉斯平滑)除以延迟惩罚 越大越好"""
+        rate = (self.successes + 1) / (self.successes + self.failures + 2)
+        return rate / (1 + (self.latency or latency_ref) / latency_ref)
+
+    def available(self, now: float) -> bool:
+        if self.banned_until > now:
+            return False
+        if self.bans and self.streak:  # 刚解封还没成功过 一次只放一个请求去试
+            return self.in_flight == 0
+        return True
+
+
+class ProxyPool:
+    """
+    strategy
+    least_loaded  在跑的请求最少的 一样多就挑分高的
+    sticky  同一个域名一直用同一个代理 被封了再换
+    """
+
+    def __init__(
+        self,
+        proxies: List[str],
+        strategy: str = "least_loaded",
+        max_failures: int = 3,
+        ban_time: float = 300,
+        max_ban_time: float = 3600,
+        latency_ref: float = 1.0,
+        sticky_max: int = 100000,
+    ):
+        self.proxies = OrderedDict(
+            (url, ProxyState(url)) for url in proxies
+        )  # type: Dict[str, ProxyState]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.ban_time = ban_time
+        self.max_ban_time = max_ban_time
+        self.latency_ref = latency_ref
+        self.sticky_max = sticky_max
+        self._sticky = OrderedDict()  # type: Dict[str, str]
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def choose(self, domain: str, exclude=()) -> Optional[ProxyState]:
+        now = time.time()
+        candidates = [
+            state
+            for state in self.proxies.values()
+            if state.url not in exclude and state.available(now)
+        ]
+        if not candidates:  # 全被封了 挑最早解封的 总比不发强
+            candidates = sorted(
+                (state for state in self.proxies.values() if state.url not in exclude),
+                key=lambda state: state.banned_until,
+            )[:1]
+            if not candidates:
+                return None
+        if self.strategy == "sticky":
+            url = self._sticky.get(domain)
+            state = self.proxies.get(url) if url is not None else None
+            if state is None or state not in candidates:
+                state = max(candidates, key=lambda state: state.score(self.latency_ref))
+                self._sticky[domain] = state.url
+                if len(self._sticky) > self.sticky_max:
+                    self._sticky.popitem(last=False)
+            return state
+        return min(
+            candidates,
+            key=lambda state: (state.in_flight, -state.score(self.latency_ref)),
+        )
+
+    def acquire(self, domain: str, exclude=()) -> Optional[ProxyState]:
+        state = self.choose(domain, exclude)
+        if state is not None:
+            state.in_flight += 1
+        return state
+
+    def release(self, url: str, success: bool, latency: Optional[float] = None):
+        state = self.proxies.get(url)
+        if state is None:
+            return
+        state.in_flight = max(state.in_flight - 1, 0)
+        if success:
+            state.successes += 1
+            state.streak = 0
+            state.bans = 0
+            if latency is not None:
+                state.latency = (
+                    latency
+                    if state.latency is None
+                    else 0.8 * state.latency + 0.2 * latency
+                )
+            return
+        state.failures += 1
+        state.streak += 1
+        if state.streak >= self.max_failures or state.bans:  # 试用期里再失败直接封
+            state.bans += 1
+            state.banned_until = time.time() + min(
+                self.ban_time * 2 ** (state.bans - 1), self.max_ban_time
+            )
+            logger.info(
+                "Banned proxy %s for %.0f seconds",
+                _display(url),
+                state.banned_until - time.time(),
+            )
+
+
+def _display(url: str) -> str:
+    """日志和stats里不要出现代理密码"""
+    parts = urlsplit(url if "://" in url else "http://" + url)
+    return parts.netloc.rpartition("@")[2]
+
+
+class ProxyPoolMiddleware:
+    """
+    给没有手动设meta['proxy']的请求从代理池里分配代理
+    要排在scrapy的HttpProxyMiddleware(750)前面 它会把代理url里的账号密码变成Proxy-Authorization头
+    DOWNLOADER_MIDDLEWARES = {"...ProxyPoolMiddleware": 740}
+
+    settings.py 中
+    PROXY_POOL  代理列表 或者 PROXY_POOL_FILE 一行一个
+    PROXY_POOL_STRATEGY  least_loaded 或 sticky 默认least_loaded
+    PROXY_POOL_STICKY_MAX  sticky最多记住多少个域名的代理 超了先忘最早的 默认100000
+    PROXY_POOL_BAN_CODES  算作代理被封的状态码 默认403 407 429
+    PROXY_POOL_MAX_FAILURES  连续失败几次封掉 默认3
+    PROXY_POOL_BAN_TIME  第一次封多少秒 之后每次翻倍 默认300
+    PROXY_POOL_MAX_BAN_TIME  最多封多少秒 默认3600
+    PROXY_POOL_LATENCY_REF  打分时的参考延迟 秒 默认1
+    """
+
+    def __init__(self, pool: ProxyPool, ban_codes, stats=None):
+        self.pool = pool
+        self.ban_codes = set(int(code) for code in ban_codes)
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        proxies = settings.getlist("PROXY_POOL")
+        if settings.get("PROXY_POOL_FILE"):
+            with open(settings.get("PROXY_POOL_FILE"), encoding="utf-8") as f:
+                proxies += [line.strip() for line in f if line.strip()]
+        pool = ProxyPool(
+            proxies,
+            settings.get("PROXY_POOL_STRATEGY", "least_loaded"),
+            settings.getint("PROXY_POOL_MAX_FAILURES", 3),
+            settings.getfloat("PROXY_POOL_BAN_TIME", 300),
+            settings.getfloat("PROXY_POOL_MAX_BAN_TIME", 3600),
+            settings.getfloat("PROXY_POOL_LATENCY_REF", 1.0),
+            settings.getint("PROXY_POOL_STICKY_MAX", 100000),
+        )
+        s = cls(
+            pool,
+            settings.getlist("PROXY_POOL_BAN_CODES", [403, 407, 429]),
+            crawler.stats,
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def spider_opened(self, spider):
+        spider.logger.info(
+            "Spider  %s opened middleware: %s" % (spider.name, self.__class__.__name__)
+        )
+
+    def process_request(self, request: scrapy.Request, spider):
+        if not self.pool:
+            return None
+        if "proxy" in request.meta and "proxy_pool" not in request.meta:
+            return None  # 手动指定的不管
+        domain = urlsplit(request.url).hostname or ""
+        tried = request.meta.get("proxy_pool_tried", [])
+        previous = request.meta.get("_proxy_pool_released")
+        if previous is not None and not previous[1]:  # 重试的请求 换一个没失败过的
+            tried = tried + [previous[0]]
+        state = None
+        if previous is not None and previous[1]:  # 重定向之类的 接着用同一个
+            state = self.pool.proxies.get(previous[0])
+            if state is not None and state.available(time.time()):
+                state.in_flight += 1
+            else:
+                state = None
+        if state is None:
+            state = self.pool.acquire(domain, tried) or self.pool.acquire(domain)
+        if state is None:
+            return None
+        if state.url != request.meta.get("proxy"):
+            request.headers.pop(b"Proxy-Authorization", None)  # 上一个代理的
+        request.meta["proxy"] = state.url
+        request.meta["proxy_pool"] = state.url
+        request.meta["proxy_pool_tried"] = tried
+        request.meta.pop("_proxy_pool_released", None)
+        if self.stats is not None:
+            self.stats.inc_value("proxy_pool/assigned")
+        return None
+
+    def _release(self, request, success: bool, latency=None):
+        url = request.meta.get("proxy_pool")
+        if not url or "_proxy_pool_released" in request.meta:
+            return
+        request.meta["_proxy_pool_released"] = (url, success)
+        self.pool.release(url, success, latency)
+        if self.stats is not None and not success:
+            self.stats.inc_value(f"proxy_pool/failures/{_display(url)}")
+
+    def process_response(self, request: scrapy.Request, response, spider):
+        if response.status in self.ban_codes:
+            self._release(request, False)
+        else:
+            self._release(request, True, download_latency(request))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._release(request, False)
+        return None
@@ -1,34 +1,106 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import logging
+from typing import Optional
 
 import scrapy.downloadermiddlewares.retry as retry
 from scrapy import signals
+from twisted.internet import task
+
+from .journal import JournalWriter, dump_request, load_failed_requests
 
 logger = logging.getLogger(__name__)
 
 
 class LoggedRetryMiddleware(retry.RetryMiddleware):
     """
-    失败后会记录日志的重试中间件
-    需要在settings.py 中加入 FAILED_URL_PATH
+    失败后会记录日志的重试中间件 放弃重试的请求攒起来在后台线程里写文件
+
+    settings.py 中可选
+    FAILED_REQUEST_JOURNAL  完整的请求(method body headers meta priority callback)记到这里
+    FAILED_URL_PATH  只记url 一行一个
+    FAILED_REQUEST_BUFFER_SIZE  攒够多少字节写一次 默认64KB
+    FAILED_REQUEST_FLUSH_INTERVAL  最多隔多少秒写一次 默认5
+    FAILED_REQUEST_REPLAY  上次的FAILED_REQUEST_JOURNAL 启动时把里面的请求全部重新排进去
     """
 
-    def __init__(self, settings):
+    def __init__(self, settings, crawler=None):
         super().__init__(settings)
-        self.log_path = settings.get("FAILED_URL_PATH")
+        self.crawler = crawler
+        buffer_size = settings.getint("FAILED_REQUEST_BUFFER_SIZE", 64 * 1024)
+        self.flush_interval = settings.getfloat("FAILED_REQUEST_FLUSH_INTERVAL", 5)
+        self.journal = None  # type: Optional[JournalWriter]
+        self.url_log = None  # type: Optional[JournalWriter]
+        if settings.get("FAILED_REQUEST_JOURNAL"):
+            self.journal = JournalWriter(
+                settings.get("FAILED_REQUEST_JOURNAL"), buffer_size, self.flush_interval
+            )
+        if settings.get("FAILED_URL_PATH"):
+            self.url_log = JournalWriter(
+                settings.get("FAILED_URL_PATH"), buffer_size, self.flush_interval
+            )
+        self.replay_path = settings.get("FAILED_REQUEST_REPLAY")
+        self._flusher = None  # type: Optional[task.LoopingCall]
 
     @classmethod
     def from_crawler(cls, crawler):
-        s = cls(crawler.settings)
+        s = cls(crawler.settings, crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
     def spider_opened(self, spider):
         spider.logger.info(
             "Spider  %s opened middleware: %s" % (spider.name, self.__class__.__name__)
         )
+        if self.journal is not None or self.url_log is not None:
+            self._flusher = task.LoopingCall(self._flush)
+            self._flusher.start(self.flush_interval, now=False)
+        if self.replay_path:
+            task.cooperate(self._replay(spider))  # 一点一点排 不卡reactor
+
+    def _replay(self, spider):
+        count = 0
+        for request in load_failed_requests(self.replay_path, spider):
+            self.crawler.engine.crawl(request)
+            count += 1
+            yield None
+        self.crawler.stats.set_value("retry/journal/replayed", count)
+        logger.info("Re-enqueued %s failed requests from %s", count, self.replay_path)
+
+    def _flush(self):
+        for writer in (self.journal, self.url_log):
+            if writer is not None:
+                writer.flush()
+
+    def _close(self):
+        for writer in (self.journal, self.url_log):
+            if writer is not None:
+                writer.close()
+
+    async def spider_closed(self, spider):
+        if self._flusher is not None and self._flusher.running:
+            self._flusher.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self._close)
+
+    def _record_failure(self, request, reason, retries: int, spider):
+        if self.url_log is not None:
+            self.url_log.write((request.url + "\n").encode("utf-8"))
+        if self.journal is None:
+            return
+        if isinstance(reason, Exception):
+            reason = retry.global_object_name(reason.__class__)
+        try:
+            data = dump_request(request, spider, str(reason), retries)
+        except ValueError as e:  # callback不是spider的方法 存不了
+            logger.warning("Cannot journal %s: %s", request, e)
+            return
+        self.journal.write(data)
+        spider.crawler.stats.inc_value("retry/journal/written")
 
-    def _retry(self, request, reason, spider):
+    def _retry(self, request, reason, spider=None):
+        if spider is None:  # scrapy 2.13+ 不再传spider
+            spider = self.crawler.spider
         retries = request.meta.get("retry_times", 0) + 1
 
         retry_times = self.max_retry_times
@@ -63,5 +135,4 @@ class LoggedRetryMiddleware(retry.RetryMiddleware):
                 {"request": request, "retries": retries, "reason": reason},
                 extra={"spider": spider},
             )
-            with open(self.log_path, "a+", encoding="utf-8") as f:
-                f.write(request.url + "\n")
+            self._record_failure(request, reason, retries, spider)
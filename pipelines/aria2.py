@@ -6,6 +6,8 @@ from aiohttp.client_exceptions import ContentTypeError
 from itemadapter import ItemAdapter
 from scrapy.utils.defer import deferred_f_from_coro_f
 
+from downloadhandlers.sessions import SessionRegistry, get_session_registry
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,11 +22,19 @@ class Aria2Pipeline:
     ARIA2_OPTION_FIELD  包含option的字段 默认options
     """
 
-    def __init__(self, url: str, token: str, url_field: str, option_field: str):
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        url_field: str,
+        option_field: str,
+        sessions: SessionRegistry = None,
+    ):
         self.url = url
         self.token = token
         self.url_field = url_field
         self.option_field = option_field
+        self.sessions = sessions
         self.client: Aria2WebsocketTrigger = None
 
     @classmethod
@@ -34,11 +44,18 @@ class Aria2Pipeline:
             crawler.settings.get("ARIA2_TOKEN"),
             crawler.settings.get("ARIA2_URLS_FIELD", "file_urls"),
             crawler.settings.get("ARIA2_OPTION_FIELD", "options"),
+            get_session_registry(crawler),
         )
 
     @deferred_f_from_coro_f
     async def open_spider(self, spider):
-        self.client = await Aria2WebsocketTrigger.new(self.url, token=self.token)
+        self.client = await Aria2WebsocketTrigger.new(
+            self.url,
+            token=self.token,
+            client_session=self.sessions.session("aria2")
+            if self.sessions is not None
+            else None,
+        )
         if hasattr(self, "onDownloadStart"):
             self.client.onDownloadStart(self.onDownloadStart)
         if hasattr(self, "onDownloadPause"):
@@ -1,20 +1,703 @@
 import asyncio
 import json
-import re
+import logging
 import socket
-from typing import List, Optional
+import sqlite3
+import struct
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 import aiodns
 import aiohttp
+import httpx
 import scrapy.crawler
-from scrapy.resolver import CachingThreadedResolver, dnscache
+from scrapy.resolver import CachingThreadedResolver
 from scrapy.utils.defer import deferred_from_coro
-from twisted.internet.interfaces import IResolverSimple
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.error import DNSLookupError
+from twisted.internet.interfaces import IHostnameResolver, IResolverSimple
+from twisted.internet._resolver import HostResolution
 from zope.interface.declarations import implementer
 
+try:
+    from downloadhandlers.sessions import get_session_registry
+except ImportError:  # 单独拷了resolver.py用
+    get_session_registry = None
 
-@implementer(IResolverSimple)
-class CachingAsyncResolver(CachingThreadedResolver):
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOH_ENDPOINTS = [
+    "https://1.0.0.1/dns-query",
+    "https://1.1.1.1/dns-query",
+    "https://[2606:4700:4700::1001]/dns-query",
+    "https://[2606:4700:4700::1111]/dns-query",
+    "https://cloudflare-dns.com/dns-query",
+    "https://dns.google/resolve",
+    "https://doh.opendns.com/dns-query",
+]
+DEFAULT_DOH_WIRE_ENDPOINTS = [
+    endpoint.replace("/resolve", "/dns-query") for endpoint in DEFAULT_DOH_ENDPOINTS
+]
+
+
+class DNSCacheEntry:
+    __slots__ = ("value", "ttl", "expire", "hits")
+
+    def __init__(self, value: Any, ttl: float, remaining: Optional[float] = None):
+        self.value = value
+        self.ttl = ttl
+        self.hits = 0
+        self.expire = time.monotonic() + (ttl if remaining is None else remaining)
+
+
+class TTLCache(OrderedDict):
+    """
+    带过期时间的LRU缓存，满了先淘汰最久没用的
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        super().__init__()
+        self.limit = limit
+
+    def get_entry(self, key) -> Optional[DNSCacheEntry]:
+        entry = super().get(key)
+        if entry is None:
+            return None
+        if entry.expire <= time.monotonic():
+            del self[key]
+            return None
+        self.move_to_end(key)
+        return entry
+
+    def put(self, key, value: Any, ttl: float, remaining: Optional[float] = None):
+        if ttl <= 0 or (remaining is not None and remaining <= 0):
+            return
+        if self.limit is not None:
+            if self.limit == 0:
+                return
+            if key not in self:
+                while len(self) >= self.limit:
+                    self.popitem(last=False)
+        self[key] = DNSCacheEntry(value, ttl, remaining)
+        self.move_to_end(key)
+
+
+class DNSCache:
+    """
+    resolver专用的dns缓存，遵守记录的TTL，解析失败的域名进负缓存
+
+    settings.py 中可选
+    DNSCACHE_MIN_TTL  ttl下限 默认60
+    DNSCACHE_MAX_TTL  ttl上限 默认86400
+    DNSCACHE_NEGATIVE_TTL  解析失败缓存多久 默认30 0为关闭
+    DNSCACHE_NEGATIVE_SIZE  负缓存大小 默认1000
+    DNSCACHE_SNAPSHOT_PATH  sqlite快照文件 reactor关闭前写入 下次启动时一次读进内存 默认None不保存
+    """
+
+    def __init__(
+        self,
+        size: Optional[int] = None,
+        min_ttl: float = 60,
+        max_ttl: float = 86400,
+        negative_ttl: float = 30,
+        negative_size: int = 1000,
+        snapshot_path: Optional[str] = None,
+    ):
+        self.snapshot_path = snapshot_path
+        self._snapshot = None  # type: Optional[sqlite3.Connection]
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self._positive = TTLCache(size)
+        self._negative = TTLCache(negative_size if size != 0 else 0)
+        if snapshot_path:
+            self.load()
+
+    @classmethod
+    def from_settings(cls, settings, size: Optional[int]):
+        return cls(
+            size,
+            settings.getfloat("DNSCACHE_MIN_TTL", 60),
+            settings.getfloat("DNSCACHE_MAX_TTL", 86400),
+            settings.getfloat("DNSCACHE_NEGATIVE_TTL", 30),
+            settings.getint("DNSCACHE_NEGATIVE_SIZE", 1000),
+            settings.get("DNSCACHE_SNAPSHOT_PATH"),
+        )
+
+    def clamp(self, ttl: Optional[float]) -> float:
+        if ttl is None:
+            ttl = self.min_ttl
+        return min(max(ttl, self.min_ttl), self.max_ttl)
+
+    def get(self, name: str):
+        """
+        命中返回缓存的结果，负缓存命中直接抛DNSNameError，没有返回None
+        """
+        entry = self._positive.get_entry(name)
+        if entry is not None:
+            entry.hits += 1
+            return entry.value
+        entry = self._negative.get_entry(name)
+        if entry is not None:
+            raise DNSNameError(entry.value)
+        return None
+
+    def peek(self, name: str) -> Optional[DNSCacheEntry]:
+        return self._positive.get_entry(name)
+
+    def set(self, name: str, value: Any, ttl: Optional[float] = None):
+        self._negative.pop(name, None)
+        old = self._positive.get(name)
+        self._positive.put(name, value, self.clamp(ttl))
+        if old is not None and name in self._positive:  # 刷新后还是热门
+            self._positive[name].hits = old.hits
+
+    def set_failure(self, name: str, msg: str):
+        self._negative.put(name, msg, self.negative_ttl)
+
+    def __contains__(self, name: str) -> bool:
+        return self._positive.get_entry(name) is not None
+
+    def __len__(self):
+        return len(self._positive)
+
+    def _open_snapshot(self) -> sqlite3.Connection:
+        if self._snapshot is None:
+            self._snapshot = sqlite3.connect(self.snapshot_path)
+            self._snapshot.execute(
+                "CREATE TABLE IF NOT EXISTS dnscache "
+                "(name TEXT PRIMARY KEY, primary_addrs TEXT, secondary_addrs TEXT, "
+                "ttl REAL, expire REAL)"
+            )
+        return self._snapshot
+
+    def load(self):
+        """
+        启动时(reactor还没跑)把快照里没过期的一次读进内存，之后查询不碰sqlite，剩下的ttl照旧
+        按过期时间排 缓存放不下的时候留活得久的
+        """
+        now = time.time()
+        db = self._open_snapshot()
+        rows = db.execute(
+            "SELECT name, primary_addrs, secondary_addrs, ttl, expire FROM dnscache "
+            "WHERE expire > ? ORDER BY expire",
+            (now,),
+        ).fetchall()
+        db.close()
+        self._snapshot = None
+        for name, primary, secondary, ttl, expire in rows:
+            value = AddressSet(json.loads(primary), json.loads(secondary))
+            self._positive.put(name, value, ttl, expire - now)
+        logger.debug("loaded %d dns records from %s", len(rows), self.snapshot_path)
+
+    def save(self):
+        """
+        把没过期的记录写进快照
+        """
+        if not self.snapshot_path:
+            return
+        now = time.monotonic()
+        wall = time.time()
+        rows = [
+            (
+                name,
+                json.dumps(entry.value.primary),
+                json.dumps(entry.value.secondary),
+                entry.ttl,
+                wall + entry.expire - now,
+            )
+            for name, entry in self._positive.items()
+            if entry.expire > now
+        ]
+        db = self._open_snapshot()
+        with db:
+            db.execute("DELETE FROM dnscache WHERE expire <= ?", (wall,))
+            db.executemany(
+                "INSERT OR REPLACE INTO dnscache VALUES (?, ?, ?, ?, ?)", rows
+            )
+        db.close()
+        self._snapshot = None
+        logger.debug("saved %d dns records to %s", len(rows), self.snapshot_path)
+
+
+class SingleFlight:
+    """
+    同一个key同时只跑一次，并发的调用者共享同一个结果
+    get_stats  每次记数的时候再去拿stats 给建的时候还没有stats的用
+    """
+
+    def __init__(
+        self,
+        stats=None,
+        stats_key: str = "dnscache/coalesced",
+        get_stats: Optional[Callable[[], Any]] = None,
+    ):
+        self._inflight = {}  # type: Dict[Any, asyncio.Future]
+        self.stats = stats
+        self.stats_key = stats_key
+        self.get_stats = get_stats
+
+    async def do(self, key, func: Callable[..., Awaitable], *args):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func(*args))
+            self._inflight[key] = fut
+            fut.add_done_callback(partial(self._done, key))
+        else:
+            stats = self.stats if self.get_stats is None else self.get_stats()
+            if stats is not None:
+                stats.inc_value(self.stats_key)
+        # shield一下 免得一个调用者被取消把大家的查询都取消了
+        return await asyncio.shield(fut)
+
+    def _done(self, key, fut: asyncio.Future):
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        if not fut.cancelled():
+            fut.exception()  # 没人等的时候也别报 never retrieved
+
+    def __contains__(self, key) -> bool:
+        return key in self._inflight
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+class EndpointState:
+    __slots__ = ("latency", "error_rate", "samples", "failures", "cooldown_until")
+
+    def __init__(self, window: int):
+        self.latency = None  # type: Optional[float]
+        self.error_rate = 0.0
+        self.samples = deque(maxlen=window)
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+
+class EndpointScorer:
+    """
+    给doh服务器打分，延迟和错误率都用EWMA，连续失败的丢进冷却
+
+    settings.py 中可选
+    DOH_EWMA_ALPHA  EWMA系数 默认0.3
+    DOH_HEDGE_PERCENTILE  最好的服务器延迟到这个分位数还没回来就问下一个 默认0.9
+    DOH_HEDGE_MIN_DELAY  对冲最短等待 默认0.05秒
+    DOH_HEDGE_DEFAULT_DELAY  还没有延迟样本时的对冲等待 默认0.5秒
+    DOH_ENDPOINT_MAX_FAILURES  连续失败几次进冷却 默认3
+    DOH_ENDPOINT_COOLDOWN  冷却时间 默认30秒
+    """
+
+    def __init__(
+        self,
+        endpoints: List[str],
+        alpha: float = 0.3,
+        hedge_percentile: float = 0.9,
+        hedge_min_delay: float = 0.05,
+        hedge_default_delay: float = 0.5,
+        max_failures: int = 3,
+        cooldown: float = 30,
+        window: int = 64,
+    ):
+        self.alpha = alpha
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._states = OrderedDict(
+            (endpoint, EndpointState(window)) for endpoint in endpoints
+        )  # type: Dict[str, EndpointState]
+
+    @classmethod
+    def from_settings(cls, settings, endpoints: List[str]):
+        return cls(
+            endpoints,
+            settings.getfloat("DOH_EWMA_ALPHA", 0.3),
+            settings.getfloat("DOH_HEDGE_PERCENTILE", 0.9),
+            settings.getfloat("DOH_HEDGE_MIN_DELAY", 0.05),
+            settings.getfloat("DOH_HEDGE_DEFAULT_DELAY", 0.5),
+            settings.getint("DOH_ENDPOINT_MAX_FAILURES", 3),
+            settings.getfloat("DOH_ENDPOINT_COOLDOWN", 30),
+        )
+
+    def score(self, endpoint: str) -> float:
+        state = self._states[endpoint]
+        latency = (
+            self.hedge_default_delay if state.latency is None else state.latency
+        )
+        return latency * (1 + 10 * state.error_rate)
+
+    def ranked(self) -> List[str]:
+        """
+        按分数从好到坏排，冷却中的放最后
+        """
+        now = time.monotonic()
+        return sorted(
+            self._states,
+            key=lambda e: (self._states[e].cooldown_until > now, self.score(e)),
+        )
+
+    def hedge_delay(self, endpoint: str) -> float:
+        samples = self._states[endpoint].samples
+        if not samples:
+            return self.hedge_default_delay
+        ordered = sorted(samples)
+        index = min(int(len(ordered) * self.hedge_percentile), len(ordered) - 1)
+        return max(ordered[index], self.hedge_min_delay)
+
+    def record_success(self, endpoint: str, latency: float):
+        state = self._states[endpoint]
+        state.latency = (
+            latency
+            if state.latency is None
+            else self.alpha * latency + (1 - self.alpha) * state.latency
+        )
+        state.error_rate *= 1 - self.alpha
+        state.samples.append(latency)
+        state.failures = 0
+
+    def record_failure(self, endpoint: str):
+        state = self._states[endpoint]
+        state.error_rate = self.alpha + (1 - self.alpha) * state.error_rate
+        state.failures += 1
+        if state.failures >= self.max_failures:
+            state.cooldown_until = time.monotonic() + self.cooldown
+            state.failures = 0
+            logger.debug("doh endpoint %s cooling down", endpoint)
+
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+QTYPE_FAMILY = {QTYPE_A: socket.AF_INET, QTYPE_AAAA: socket.AF_INET6}
+RCODE_NXDOMAIN = 3  # 只有这个是域名不存在 SERVFAIL之类的是服务器的问题 要换一个问
+
+
+def build_dns_query(hostname: str, qtype: int = QTYPE_A) -> bytes:
+    """
+    拼一个rfc1035的查询报文，doh要求id为0
+    """
+    qname = b"".join(
+        bytes((len(label),)) + label
+        for label in hostname.rstrip(".").encode("idna").split(b".")
+    )
+    return (
+        struct.pack("!HHHHHH", 0, 0x0100, 1, 0, 0, 0)  # RD
+        + qname
+        + b"\x00"
+        + struct.pack("!HH", qtype, 1)
+    )
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:  # 压缩指针
+            return offset + 2
+        offset += length + 1
+
+
+def parse_dns_response(data: bytes) -> Tuple[int, List[Tuple[int, str, int]]]:
+    """
+    只解析answer段里的A和AAAA，返回 (rcode, [(type, ip, ttl), ...])
+    报文不完整或者格式不对抛DNSLookupError 和服务器出错一样换下一个问
+    """
+    try:
+        return _parse_dns_response(data)
+    except (struct.error, IndexError, ValueError) as exc:
+        raise DNSLookupError("Malformed dns response: {!r}".format(exc)) from exc
+
+
+def _parse_dns_response(data: bytes) -> Tuple[int, List[Tuple[int, str, int]]]:
+    _, flags, qdcount, ancount, _, _ = struct.unpack_from("!HHHHHH", data)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    if offset > len(data):
+        raise ValueError("truncated question section")
+    records = []
+    for _ in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        if offset + rdlength > len(data):
+            raise ValueError("truncated answer section")
+        family = QTYPE_FAMILY.get(rtype)
+        if family is not None:
+            records.append(
+                (rtype, socket.inet_ntop(family, data[offset : offset + rdlength]), ttl)
+            )
+        offset += rdlength
+    return flags & 0x000F, records
+
+
+class DNSNameError(DNSLookupError):
+    """
+    域名确实解析不到，比如NXDOMAIN，这种会进负缓存
+    """
+
+
+class DohNameError(DNSNameError):
+    """
+    doh服务器明确返回解析失败，比如NXDOMAIN
+    """
+
+
+def _addr_to_str(addr) -> str:
+    return addr.decode() if isinstance(addr, bytes) else addr
+
+
+def is_ip_address(name: str) -> bool:
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, name)
+            return True
+        except (OSError, ValueError):
+            pass
+    return False
+
+
+def _crawler_stats(crawler):
+    """CrawlerProcess没有stats crawler没开始爬之前读stats会抛RuntimeError"""
+    try:
+        return getattr(crawler, "stats", None)
+    except RuntimeError:
+        return None
+
+
+class AddressSet:
+    """
+    一个域名解析出来的全部地址，每次取的时候轮换一下，好把连接摊到各个cdn节点上
+    primary是优先的地址族，secondary是另一个，最近连不上的地址排到最后
+    """
+
+    __slots__ = ("primary", "secondary", "_index")
+
+    def __init__(self, primary: List[str], secondary: Optional[List[str]] = None):
+        self.primary = primary
+        self.secondary = secondary or []
+        self._index = 0
+
+    @property
+    def addresses(self) -> List[str]:
+        return self.primary + self.secondary
+
+    def ordered(self, failed: Optional[TTLCache] = None) -> List[str]:
+        index = self._index
+        self._index += 1
+        result = []
+        for addresses in (self.primary, self.secondary):
+            if addresses:
+                start = index % len(addresses)
+                result.extend(addresses[start:])
+                result.extend(addresses[:start])
+        if failed:
+            good = [a for a in result if failed.get_entry(a) is None]
+            result = good + [a for a in result if a not in good]
+        return result
+
+    def next(self, failed: Optional[TTLCache] = None) -> str:
+        return self.ordered(failed)[0]
+
+    def __len__(self):
+        return len(self.primary) + len(self.secondary)
+
+
+@implementer(IResolverSimple, IHostnameResolver)
+class AsyncResolverBase(CachingThreadedResolver):
+    """
+    两个async resolver共用的部分：缓存、合并并发查询、地址轮换和ipv6
+    子类实现 _query_addresses
+
+    settings.py 中可选
+    DNS_IPV6_ENABLED  同时查AAAA 默认False
+    DNS_PREFERRED_FAMILY  ipv4或者ipv6 默认ipv4 设成ipv6会同时打开DNS_IPV6_ENABLED
+    DNS_ADDRESS_FAILURE_TTL  连不上的地址多久之内排到最后 默认60秒
+    DNS_REFRESH_HITS  命中多少次算热门域名 热门的快过期时后台提前刷新 默认5 0为关闭
+    DNS_REFRESH_RATIO  剩余ttl低于这个比例就刷新 默认0.1
+    DNS_REFRESH_CONCURRENCY  同时最多几个后台刷新 默认8
+
+    ipv6地址只有scrapy调用install_on_reactor(2.7+)时才能用上，
+    老版本走IResolverSimple，只拿得到ipv4地址
+    """
+
+    def __init__(
+        self,
+        reactor,
+        cache_size,
+        timeout,
+        dns_cache: Optional[DNSCache] = None,
+        stats=None,
+        families: Tuple[int, ...] = (socket.AF_INET,),
+        failure_ttl: float = 60,
+    ):
+        super().__init__(reactor, cache_size, timeout)
+        self._cache = DNSCache(cache_size) if dns_cache is None else dns_cache
+        self._inflight = SingleFlight(get_stats=lambda: self.stats)
+        self._stats = stats
+        self.families = families
+        self.failure_ttl = failure_ttl
+        self._failed = TTLCache(max(cache_size, 1000))
+        self.refresh_hits = 5
+        self.refresh_ratio = 0.1
+        self.refresh_concurrency = 8
+        self._refreshing = set()  # type: Set[asyncio.Future]
+        self._crawler = None
+
+    @property
+    def stats(self):
+        """
+        scrapy拿CrawlerProcess建resolver 那时候还没有stats
+        用到的时候从第一个有stats的crawler上借
+        """
+        if self._stats is None and self._crawler is not None:
+            for crawler in getattr(self._crawler, "crawlers", ()):
+                stats = _crawler_stats(crawler)
+                if stats is not None:
+                    self._stats = stats
+                    break
+        return self._stats
+
+    @staticmethod
+    def families_from_settings(settings) -> Tuple[int, ...]:
+        preferred = settings.get("DNS_PREFERRED_FAMILY", "ipv4").lower()
+        if preferred == "ipv6":
+            return socket.AF_INET6, socket.AF_INET
+        if settings.getbool("DNS_IPV6_ENABLED", False):
+            return socket.AF_INET, socket.AF_INET6
+        return (socket.AF_INET,)
+
+    def _bind_crawler(self, crawler):
+        self._crawler = crawler
+        self.failure_ttl = crawler.settings.getfloat("DNS_ADDRESS_FAILURE_TTL", 60)
+        self.refresh_hits = crawler.settings.getint("DNS_REFRESH_HITS", 5)
+        self.refresh_ratio = crawler.settings.getfloat("DNS_REFRESH_RATIO", 0.1)
+        self.refresh_concurrency = crawler.settings.getint(
+            "DNS_REFRESH_CONCURRENCY", 8
+        )
+        # scrapy拿CrawlerProcess建resolver 整个进程共用 没有signals 所以在reactor关闭前存快照
+        self.reactor.addSystemEventTrigger("before", "shutdown", self._cache.save)
+        return self
+
+    def install_on_reactor(self):
+        self.reactor.installNameResolver(self)
+
+    def getHostByName(self, name, timeout=None):
+        return deferred_from_coro(self._getHostByName(name, timeout))
+
+    async def _getHostByName(self, name, timeout=None):
+        """IResolverSimple只能给ipv4 DNS_PREFERRED_FAMILY=ipv6时ipv6排在前面 要挑出来"""
+        for address in await self.resolve_all(name, timeout):
+            if ":" not in address:
+                return address
+        raise DNSLookupError("Failed to resolve {}: no ipv4 address".format(name))
+
+    def resolveHostName(
+        self,
+        resolutionReceiver,
+        hostName,
+        portNumber=0,
+        addressTypes=None,
+        transportSemantics="TCP",
+    ):
+        resolution = HostResolution(hostName)
+        resolutionReceiver.resolutionBegan(resolution)
+
+        def on_result(addresses):
+            for address in addresses:
+                address_type = IPv6Address if ":" in address else IPv4Address
+                if addressTypes and address_type not in addressTypes:
+                    continue
+                resolutionReceiver.addressResolved(
+                    address_type(transportSemantics, address, portNumber)
+                )
+
+        def on_error(failure):
+            if not failure.check(DNSLookupError):
+                logger.debug("while looking up %s: %s", hostName, failure.value)
+
+        d = deferred_from_coro(self.resolve_all(hostName, self.timeout))
+        d.addCallbacks(on_result, on_error)
+        d.addBoth(lambda _: resolutionReceiver.resolutionComplete())
+        return resolution
+
+    async def resolve_all(self, name, timeout=None) -> List[str]:
+        """
+        返回这个域名的全部地址，已经按轮换和失败情况排好序，第一个就是该连的
+        """
+        if is_ip_address(name):  # just an ip
+            return [name]
+        addresses = self._cache.get(name)
+        if addresses is None:
+            addresses = await self._inflight.do(name, self._lookup, name, timeout)
+        else:
+            self._maybe_refresh(name, timeout)
+        return addresses.ordered(self._failed)
+
+    def _maybe_refresh(self, name, timeout=None):
+        """
+        热门域名快过期的时候在后台重新解析，请求这边继续用旧结果
+        """
+        if (
+            not self.refresh_hits
+            or len(self._refreshing) >= self.refresh_concurrency
+            or name in self._inflight
+        ):
+            return
+        entry = self._cache.peek(name)
+        if entry is None or entry.hits < self.refresh_hits:
+            return
+        if entry.expire - time.monotonic() > entry.ttl * self.refresh_ratio:
+            return
+        task = asyncio.ensure_future(self._refresh(name, timeout))
+        self._refreshing.add(task)
+        task.add_done_callback(self._refreshing.discard)
+
+    async def _refresh(self, name, timeout=None):
+        try:
+            await self._inflight.do(name, self._lookup, name, timeout)
+        except Exception as e:
+            logger.debug("refreshing %s failed: %r", name, e)
+            return
+        if self.stats is not None:
+            self.stats.inc_value("dnscache/refreshed")
+
+    def mark_failed(self, address: str):
+        """
+        连不上某个地址的时候调用，之后一段时间内它会被排到最后
+        目前只有httpx(downloadhandlers/resolve.py的ResolvingNetworkBackend)会调，
+        twisted aiohttp curl_cffi拿到整张地址表自己挨个连，连不上哪个地址不会告诉这里
+        """
+        self._failed.put(address, True, self.failure_ttl)
+
+    async def _lookup(self, name, timeout=None) -> AddressSet:
+        try:
+            by_family, ttl = await self._query_addresses(name, timeout)
+        except DNSNameError as exc:
+            self._cache.set_failure(name, exc.args[0] if exc.args else name)
+            raise
+        ordered = [by_family.get(family, []) for family in self.families]
+        addresses = AddressSet(ordered[0], ordered[1] if len(ordered) > 1 else None)
+        if not addresses:
+            msg = "Failed to resolve {}: no address".format(name)
+            self._cache.set_failure(name, msg)
+            raise DNSNameError(msg)
+        self._cache.set(name, addresses, ttl)
+        return addresses
+
+    async def _query_addresses(
+        self, name, timeout=None
+    ) -> Tuple[Dict[int, List[str]], Optional[float]]:
+        """
+        返回 ({family: [ip, ...]}, ttl)
+        """
+        raise NotImplementedError
+
+
+class CachingAsyncResolver(AsyncResolverBase):
     """
     Async caching resolver. Require aiodns
     """
@@ -25,13 +708,13 @@ class CachingAsyncResolver(CachingThreadedResolver):
         cache_size,
         timeout,
         nameservers: Optional[List[str]] = None,
+        dns_cache: Optional[DNSCache] = None,
+        stats=None,
+        families: Tuple[int, ...] = (socket.AF_INET,),
         **kwargs,
     ):
-        super().__init__(reactor, cache_size, timeout)
+        super().__init__(reactor, cache_size, timeout, dns_cache, stats, families)
         self._resolver = aiodns.DNSResolver(nameservers, None, **kwargs)
-        self._pattern = re.compile(
-            r"((\d|[1-9]\d|1\d\d|2[0-4]\d|25[0-5])\.){3}(1\d\d|2[0-4]\d|25[0-5]|[1-9]\d|\d)"
-        )
 
     @classmethod
     def from_crawler(cls, crawler: scrapy.crawler.Crawler, reactor):
@@ -44,35 +727,47 @@ class CachingAsyncResolver(CachingThreadedResolver):
             cache_size,
             crawler.settings.getfloat("DNS_TIMEOUT"),
             crawler.settings.getlist("AIODNS_NAMESERVERS", None),
+            DNSCache.from_settings(crawler.settings, cache_size),
+            _crawler_stats(crawler),
+            cls.families_from_settings(crawler.settings),
             **crawler.settings.getdict("AIODNS_KW", {}),
-        )
+        )._bind_crawler(crawler)
 
-    def getHostByName(self, name, timeout=None):
-        return deferred_from_coro(self._getHostByName(name, timeout))
-
-    async def _getHostByName(self, name, timeout=None):
-        if self._pattern.match(name) is not None:  # just an ip
-            return name
-        if name in dnscache:
-            return dnscache[name]
+    async def _query_addresses(self, name, timeout=None):
+        family = self.families[0] if len(self.families) == 1 else socket.AF_UNSPEC
         try:
             resp = await asyncio.wait_for(
-                self._resolver.getaddrinfo(name, socket.AF_INET), timeout
+                self._resolver.getaddrinfo(name, family), timeout
             )
-            result = resp.nodes[0].addr[0].decode()
-            dnscache[name] = result
-            return result
         except asyncio.TimeoutError:
             raise
         except aiodns.error.DNSError as exc:
-            msg = exc.args[1] if len(exc.args) >= 1 else "DNS lookup failed"
-            raise OSError(msg) from exc
+            msg = exc.args[1] if len(exc.args) > 1 else "DNS lookup failed"
+            if exc.args and exc.args[0] in (
+                aiodns.error.ARES_ENOTFOUND,
+                aiodns.error.ARES_ENODATA,
+            ):
+                raise DNSNameError(msg) from exc
+            raise DNSLookupError(msg) from exc
+        by_family = {}  # type: Dict[int, List[str]]
+        ttl = None
+        for node in resp.nodes:
+            address = _addr_to_str(node.addr[0])
+            addresses = by_family.setdefault(node.family, [])
+            if address not in addresses:  # 每种socktype都会有一条
+                addresses.append(address)
+            node_ttl = getattr(node, "ttl", None)
+            if node_ttl is not None:
+                ttl = node_ttl if ttl is None else min(ttl, node_ttl)
+        return by_family, ttl
 
 
-@implementer(IResolverSimple)
-class CachingAsyncDohResolver(CachingThreadedResolver):
+class CachingAsyncDohResolver(AsyncResolverBase):
     """
     Doh resolver
+
+    settings.py 中可选
+    DOH_WIRE_FORMAT  用rfc8484的application/dns-message 走http2多路复用 默认False走json
     """
 
     def __init__(
@@ -82,29 +777,24 @@ class CachingAsyncDohResolver(CachingThreadedResolver):
         timeout,
         endpoints: List[str] = None,
         boot: List[str] = None,
+        dns_cache: Optional[DNSCache] = None,
+        stats=None,
+        scorer: Optional[EndpointScorer] = None,
+        wire_format: bool = False,
+        families: Tuple[int, ...] = (socket.AF_INET,),
     ):
-        super().__init__(reactor, cache_size, timeout)
+        super().__init__(reactor, cache_size, timeout, dns_cache, stats, families)
 
-        self.endpoints = (
-            [
-                "https://1.0.0.1/dns-query",
-                "https://1.1.1.1/dns-query",
-                "https://[2606:4700:4700::1001]/dns-query",
-                "https://[2606:4700:4700::1111]/dns-query",
-                "https://cloudflare-dns.com/dns-query",
-                "https://dns.google/resolve",
-                "https://doh.opendns.com/dns-query",
-            ]
-            if not endpoints
-            else endpoints
+        self.wire_format = wire_format
+        self.endpoints = endpoints or (
+            DEFAULT_DOH_WIRE_ENDPOINTS if wire_format else DEFAULT_DOH_ENDPOINTS
         )
         self._client_session = None
-        self._pattern = re.compile(
-            r"((\d|[1-9]\d|1\d\d|2[0-4]\d|25[0-5])\.){3}(1\d\d|2[0-4]\d|25[0-5]|[1-9]\d|\d)"
-        )
+        self._h2_client = None  # type: Optional[httpx.AsyncClient]
         self._boot = boot or [
             "8.8.8.8"
         ]  # bootstrap DNS server for aiohttp resolver, and then connect to the real DOH servers
+        self._scorer = EndpointScorer(self.endpoints) if scorer is None else scorer
 
     @classmethod
     def from_crawler(cls, crawler, reactor):
@@ -112,71 +802,130 @@ class CachingAsyncDohResolver(CachingThreadedResolver):
             cache_size = crawler.settings.getint("DNSCACHE_SIZE")
         else:
             cache_size = 0
+        wire_format = crawler.settings.getbool("DOH_WIRE_FORMAT", False)
+        endpoints = crawler.settings.getlist("DOH_ENDPOINTS", None) or (
+            DEFAULT_DOH_WIRE_ENDPOINTS if wire_format else DEFAULT_DOH_ENDPOINTS
+        )
         return cls(
             reactor,
             cache_size,
             crawler.settings.getfloat("DNS_TIMEOUT"),
-            crawler.settings.getlist("DOH_ENDPOINTS", None),
+            endpoints,
             crawler.settings.getlist("DOH_BOOT", None),
-        )
+            DNSCache.from_settings(crawler.settings, cache_size),
+            _crawler_stats(crawler),
+            EndpointScorer.from_settings(crawler.settings, endpoints),
+            wire_format,
+            cls.families_from_settings(crawler.settings),
+        )._bind_crawler(crawler)
 
-    def getHostByName(self, name, timeout=None):
-        return deferred_from_coro(self._getHostByName(name, timeout))
+    async def _query_addresses(self, name, timeout=None):
+        """
+        先问分数最好的服务器，过了对冲时间还没回来再问下一个，失败了马上换下一个
+        """
+        ranked = self._scorer.ranked()
+        pending = set()
+        error = None
 
-    async def _getHostByName(self, name, timeout=None):
-        if self._pattern.match(name) is not None:  # just an ip
-            return name
-        if name in dnscache:
-            return dnscache[name]
-
-        queue = asyncio.Queue()
-        tasks = [
-            asyncio.create_task(
-                self._resolve(endpoint, name, socket.AF_INET, timeout, queue)
-            )
-            for endpoint in self.endpoints
-        ]
-        ips = await queue.get()
-        for task in tasks:
-            task.cancel()
-            try:
-                await task
-            except asyncio.CancelledError:
-                pass
-        result = ips[0]
-        dnscache[name] = result
-        return result
+        def launch():
+            endpoint = ranked[len(tasks)]
+            task = asyncio.ensure_future(self._resolve(endpoint, name, timeout))
+            tasks.append(task)
+            pending.add(task)
+            if len(tasks) > 1 and self.stats is not None:
+                self.stats.inc_value("dnscache/doh_hedged")
 
-        # for task in asyncio.as_completed(tasks):
-        #     try:
-        #         ips = await task
-        #         result = ips[0]
-        #         self._cache_result(result, name)
-        #         return result
-        #     except asyncio.CancelledError:
-        #         continue
-        #     except Exception as e:
-        #         print(str(e))
-        #         continue
-        # return []
+        tasks = []
+        launch()
+        try:
+            while pending:
+                delay = (
+                    self._scorer.hedge_delay(ranked[len(tasks) - 1])
+                    if len(tasks) < len(ranked)
+                    else None
+                )
+                done, pending = await asyncio.wait(
+                    pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:  # 对冲
+                    launch()
+                    continue
+                for task in done:
+                    exc = task.exception()
+                    if exc is None:
+                        return task.result()
+                    error = exc
+                    if isinstance(exc, DohNameError):  # 服务器明确说没有 不用再等了
+                        raise exc
+                    logger.debug("doh lookup of %s failed: %r", name, exc)
+                    if len(tasks) < len(ranked):
+                        launch()
+            raise DNSLookupError(str(error)) from error
+        finally:
+            for task in pending:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
 
     async def _resolve(
-        self, endpoint, hostname, family, timeout=None, queue: asyncio.Queue = None
-    ) -> List[str]:
+        self, endpoint, hostname, timeout=None
+    ) -> Tuple[Dict[int, List[str]], Optional[int]]:
+        """
+        A和AAAA一起查，耗时和成败记到scorer里
+        """
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *[
+                self._query(endpoint, hostname, family, timeout)
+                for family in self.families
+            ],
+            return_exceptions=True,
+        )
+        by_family = {}  # type: Dict[int, List[str]]
+        ttl = None
+        error = None
+        for family, result in zip(self.families, results):
+            if isinstance(result, BaseException):
+                if error is None or isinstance(error, DohNameError):
+                    error = result
+                continue
+            by_family[family], family_ttl = result
+            if family_ttl is not None:
+                ttl = family_ttl if ttl is None else min(ttl, family_ttl)
+        if by_family or isinstance(error, DohNameError):
+            # 服务器是好的 只是可能没这个域名
+            self._scorer.record_success(endpoint, time.monotonic() - start)
+        else:
+            self._scorer.record_failure(endpoint)
+        if not by_family:
+            raise error
+        return by_family, ttl
+
+    async def _query(
+        self, endpoint, hostname, family, timeout=None
+    ) -> Tuple[List[str], Optional[int]]:
         if timeout is None:
             timeout = 30
+        if self.wire_format:
+            return await self._query_wire(endpoint, hostname, family, timeout)
         params = {
             "name": hostname,
             "type": "AAAA" if family == socket.AF_INET6 else "A",
             "do": "false",
             "cd": "false",
         }
-        if self._client_session is None:
-            self._client_session = aiohttp.ClientSession(
-                connector=aiohttp.TCPConnector(
-                    resolver=aiohttp.AsyncResolver(nameservers=self._boot)
-                )
+        if self._client_session is None or self._client_session.closed:
+            connector = partial(
+                aiohttp.TCPConnector,
+                resolver=aiohttp.AsyncResolver(nameservers=self._boot),
             )
+            if get_session_registry is not None and self._crawler is not None:
+                registry = get_session_registry(self._crawler, self.reactor)
+                self._client_session = registry.session("doh", connector=connector)
+            else:
+                self._client_session = aiohttp.ClientSession(connector=connector())
 
         async with self._client_session.get(
             endpoint,
@@ -185,10 +934,7 @@ class CachingAsyncDohResolver(CachingThreadedResolver):
             timeout=aiohttp.ClientTimeout(total=timeout),
         ) as resp:
             if resp.status == 200:
-                data = self._parse_result(hostname, await resp.text())
-                if queue is not None:
-                    await queue.put(data)
-                return data
+                return self._parse_result(hostname, await resp.text(), family)
             else:
                 raise Exception(
                     "Failed to resolve {} with {}: HTTP Status {}".format(
@@ -196,18 +942,77 @@ class CachingAsyncDohResolver(CachingThreadedResolver):
                     )
                 )
 
-    def _parse_result(self, hostname, response) -> List[str]:
+    async def _query_wire(
+        self, endpoint, hostname, family, timeout
+    ) -> Tuple[List[str], Optional[int]]:
+        """
+        rfc8484 POST，同一个服务器的所有查询复用一条http2连接
+        """
+        if self._h2_client is None or self._h2_client.is_closed:
+            kwargs = dict(
+                http2=True,
+                headers={
+                    "accept": "application/dns-message",
+                    "content-type": "application/dns-message",
+                },
+            )
+            if get_session_registry is not None and self._crawler is not None:
+                registry = get_session_registry(self._crawler, self.reactor)
+                self._h2_client = registry.httpx_client("doh", **kwargs)
+            else:
+                self._h2_client = httpx.AsyncClient(**kwargs)
+        qtype = QTYPE_AAAA if family == socket.AF_INET6 else QTYPE_A
+        resp = await self._h2_client.post(
+            endpoint, content=build_dns_query(hostname, qtype), timeout=timeout
+        )
+        if resp.status_code != 200:
+            raise Exception(
+                "Failed to resolve {} with {}: HTTP Status {}".format(
+                    hostname, endpoint, resp.status_code
+                )
+            )
+        rcode, records = parse_dns_response(resp.content)
+        if rcode == RCODE_NXDOMAIN:
+            raise DohNameError(
+                "Failed to resolve {}: DNS Status {}".format(hostname, rcode)
+            )
+        if rcode != 0:
+            raise DNSLookupError(
+                "Failed to resolve {} with {}: DNS Status {}".format(
+                    hostname, endpoint, rcode
+                )
+            )
+        records = [record for record in records if record[0] == qtype]
+        if not records:
+            raise DohNameError("Failed to resolve {}: no address".format(hostname))
+        return [record[1] for record in records], min(record[2] for record in records)
+
+    def _parse_result(
+        self, hostname, response, family=socket.AF_INET
+    ) -> Tuple[List[str], Optional[int]]:
+        """
+        返回 (ips, ttl)，ttl取所有记录里最小的
+        """
         data = json.loads(response)
+        if data["Status"] == RCODE_NXDOMAIN:
+            raise DohNameError(
+                "Failed to resolve {}: DNS Status {}".format(hostname, data["Status"])
+            )
         if data["Status"] != 0:
-            raise Exception("Failed to resolve {}".format(hostname))
+            raise DNSLookupError(
+                "Failed to resolve {}: DNS Status {}".format(hostname, data["Status"])
+            )
 
-        # Pattern to match IPv4 addresses
+        qtype = QTYPE_AAAA if family == socket.AF_INET6 else QTYPE_A
         result = []
+        ttl = None
 
-        for i in data["Answer"]:
-            ip = i["data"]
-
-            if self._pattern.match(ip) is not None:
-                result.append(ip)
+        for i in data.get("Answer", []):
+            if i.get("type") == qtype:  # 跳过CNAME之类的
+                result.append(i["data"])
+                if "TTL" in i:
+                    ttl = i["TTL"] if ttl is None else min(ttl, i["TTL"])
 
-        return result
+        if not result:
+            raise DohNameError("Failed to resolve {}: no address".format(hostname))
+        return result, ttl
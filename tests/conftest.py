@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+from scrapy.utils.reactor import install_reactor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+
+
+@pytest.fixture
+def run():
+    """在reactor的loop上跑协程 reactor本身不启动"""
+    from twisted.internet import reactor
+
+    return reactor._asyncioEventloop.run_until_complete
+
+
+@asynccontextmanager
+async def serve(app: web.Application):
+    """本地随便找个端口起服务 返回http://127.0.0.1:端口"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        await runner.cleanup()
+
+
+def stub_args(**kwargs) -> argparse.Namespace:
+    """benchmarks.tlsproxy_stub的参数"""
+    kwargs.setdefault("delay", 0)
+    kwargs.setdefault("body_size", 1024)
+    kwargs.setdefault("chunk_size", 64 * 1024)
+    kwargs.setdefault("chunk_delay", 0)
+    return argparse.Namespace(**kwargs)
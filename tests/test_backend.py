@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from aiohttp import web
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+
+from conftest import serve
+from downloadhandlers.router import RouterDownloadHandler
+from middlewares.backend import AdaptiveBackendMiddleware
+
+
+def test_slow_httpx_backend_is_demoted(run):
+    """httpx没有download_latency 按download_phases的total算 平均太慢就降级"""
+
+    async def slow(request):
+        await asyncio.sleep(0.2)
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", slow)
+
+    async def main():
+        async with serve(app) as url:
+            crawler = get_crawler(
+                settings_dict={
+                    "ADAPTIVE_BACKEND_ORDER": ["httpx", "twisted"],
+                    "ADAPTIVE_BACKEND_MAX_LATENCY": 0.1,
+                    "ADAPTIVE_BACKEND_MAX_FAILURES": 2,
+                }
+            )
+            crawler._apply_settings()
+            middleware = AdaptiveBackendMiddleware.from_crawler(crawler)
+            handler = RouterDownloadHandler(crawler)
+            spider = Spider("test")
+            try:
+                for _ in range(2):
+                    request = Request(url + "/")
+                    middleware.process_request(request, spider)
+                    assert request.meta["download_backend"] == "httpx"
+                    response = await handler.download_request(request)
+                    assert request.meta.get("download_latency") is None
+                    result = middleware.process_response(request, response, spider)
+                    assert result is response
+            finally:
+                await handler.close()
+        assert middleware.choose("127.0.0.1") == "twisted"
+        assert crawler.stats.get_value("adaptive_backend/httpx/slow") == 2
+
+    run(main())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import socket
+
+import pytest
+from aiohttp import web
+from scrapy import Spider
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.misc import build_from_crawler
+from twisted.internet.error import DNSLookupError
+from twisted.internet.testing import MemoryReactorClock
+
+import resolver
+from downloadhandlers.sessions import get_session_registry
+
+
+@pytest.mark.parametrize(
+    "resolver_class",
+    [resolver.CachingAsyncResolver, resolver.CachingAsyncDohResolver],
+)
+def test_build_from_crawler_process(resolver_class, run):
+    """scrapy在CrawlerProcess.start里就是这么建resolver的 这时候还没有stats和signals"""
+    process = CrawlerProcess({"DNSCACHE_ENABLED": True})
+    reactor = MemoryReactorClock()
+    res = build_from_crawler(resolver_class, process, reactor=reactor)
+    assert res.stats is None
+    assert reactor.triggers["before"]["shutdown"]  # 关的时候存快照
+
+    crawler = process.create_crawler(Spider)
+    process.crawlers.add(crawler)  # process.crawl()里也是这么加的
+    crawler._apply_settings()
+
+    async def lookup():
+        await asyncio.sleep(0)
+        return ["1.2.3.4"]
+
+    async def main():
+        await asyncio.gather(*[res._inflight.do("a.test", lookup) for _ in range(3)])
+
+    run(main())
+    assert crawler.stats.get_value("dnscache/coalesced") == 2
+
+
+def test_doh_session_from_crawler_process():
+    """DoH的session从CrawlerProcess的registry拿 reactor关闭前关掉"""
+    loop = asyncio.new_event_loop()
+
+    async def dns_json(request):
+        answer = [{"type": 1, "data": "1.2.3.4", "TTL": 300}]
+        return web.json_response({"Status": 0, "Answer": answer})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/resolve", dns_json)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            process = CrawlerProcess(
+                {"DOH_ENDPOINTS": [f"http://127.0.0.1:{port}/resolve"]}
+            )
+            reactor = MemoryReactorClock()
+            res = build_from_crawler(
+                resolver.CachingAsyncDohResolver, process, reactor=reactor
+            )
+            assert await res.resolve_all("a.test") == ["1.2.3.4"]
+
+            registry = get_session_registry(process)
+            assert registry.session("doh") is res._client_session
+            assert len(reactor.triggers["before"]["shutdown"]) == 2  # 快照和session
+            await registry.close()
+            assert res._client_session.closed
+        finally:
+            await runner.cleanup()
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+class StaticResolver(resolver.AsyncResolverBase):
+    def __init__(self, addresses, families):
+        super().__init__(MemoryReactorClock(), 100, 5, families=families)
+        self.addresses = addresses
+
+    async def _query_addresses(self, name, timeout=None):
+        return self.addresses, 300
+
+
+def test_get_host_by_name_prefers_ipv6(run):
+    """DNS_PREFERRED_FAMILY=ipv6 resolve_all里ipv6在前 getHostByName还是只给ipv4"""
+    families = (socket.AF_INET6, socket.AF_INET)
+    res = StaticResolver(
+        {socket.AF_INET: ["1.2.3.4"], socket.AF_INET6: ["2001:db8::1"]}, families
+    )
+    assert run(res.resolve_all("a.test")) == ["2001:db8::1", "1.2.3.4"]
+    assert run(res._getHostByName("a.test")) == "1.2.3.4"
+
+    res = StaticResolver({socket.AF_INET6: ["2001:db8::1"]}, families)
+    with pytest.raises(DNSLookupError, match="no ipv4"):
+        run(res._getHostByName("a.test"))
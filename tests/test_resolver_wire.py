@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""DOH_WIRE_FORMAT的rfc8484报文 本地起doh服务器测"""
+import asyncio
+import socket
+import struct
+
+import pytest
+from aiohttp import web
+from twisted.internet.error import DNSLookupError
+from twisted.internet.testing import MemoryReactorClock
+
+import resolver
+from conftest import serve
+from resolver import (
+    QTYPE_A,
+    QTYPE_AAAA,
+    DNSNameError,
+    build_dns_query,
+    parse_dns_response,
+)
+
+QTYPE_CNAME = 5
+
+
+def read_question(query: bytes):
+    """(域名, qtype)"""
+    labels = []
+    offset = 12
+    while query[offset]:
+        length = query[offset]
+        labels.append(query[offset + 1 : offset + 1 + length].decode())
+        offset += length + 1
+    (qtype,) = struct.unpack_from("!H", query, offset + 1)
+    return ".".join(labels), qtype
+
+
+def answer(name: bytes, rtype: int, rdata: bytes, ttl: int = 300) -> bytes:
+    return name + struct.pack("!HHIH", rtype, 1, ttl, len(rdata)) + rdata
+
+
+def reply(query: bytes, answers=(), rcode: int = 0) -> bytes:
+    """问题段原样带回去 answer的名字用压缩指针指回问题(0xC00C)"""
+    header = struct.pack("!HHHHHH", 0, 0x8180 | rcode, 1, len(answers), 0, 0)
+    return header + query[12:] + b"".join(answers)
+
+
+def cname_chain(query: bytes) -> bytes:
+    """
+    a.test CNAME b.test CNAME c.test A 10.0.0.3
+    每一跳的名字都是指向上一条rdata的指针 rdata里的test也指回问题
+    """
+    base = len(query)  # 问题段正好在头后面 answer从这里开始
+    first = answer(b"\xc0\x0c", QTYPE_CNAME, b"\x01b\xc0\x0e")
+    second_name = struct.pack("!H", 0xC000 | (base + 12))  # 指向b.test
+    second = answer(second_name, QTYPE_CNAME, b"\x01c\xc0\x0e")
+    third_name = struct.pack("!H", 0xC000 | (base + len(first) + 12))  # 指向c.test
+    third = answer(third_name, QTYPE_A, socket.inet_aton("10.0.0.3"), ttl=60)
+    return reply(query, [first, second, third])
+
+
+def doh_app(handler, counter=None) -> web.Application:
+    async def dns_query(request: web.Request):
+        query = await request.read()
+        if counter is not None:
+            counter.append(read_question(query))
+        data = handler(query, *read_question(query))
+        if isinstance(data, web.Response):
+            return data
+        return web.Response(body=data, content_type="application/dns-message")
+
+    app = web.Application()
+    app.router.add_post("/dns-query", dns_query)
+    return app
+
+
+def make_resolver(*endpoints, families=(socket.AF_INET,)):
+    return resolver.CachingAsyncDohResolver(
+        MemoryReactorClock(),
+        100,
+        5,
+        list(endpoints),
+        wire_format=True,
+        families=families,
+    )
+
+
+async def close(res):
+    if res._h2_client is not None:
+        await res._h2_client.aclose()
+
+
+def addresses(query, name, qtype):
+    if qtype == QTYPE_AAAA:
+        rdata = socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+    else:
+        rdata = socket.inet_aton("10.0.0.1")
+    return reply(query, [answer(b"\xc0\x0c", qtype, rdata)])
+
+
+def test_build_and_parse():
+    query = build_dns_query("a.test", QTYPE_AAAA)
+    assert read_question(query) == ("a.test", QTYPE_AAAA)
+    assert parse_dns_response(addresses(query, "a.test", QTYPE_AAAA)) == (
+        0,
+        [(QTYPE_AAAA, "2001:db8::1", 300)],
+    )
+    assert parse_dns_response(cname_chain(build_dns_query("a.test"))) == (
+        0,
+        [(QTYPE_A, "10.0.0.3", 60)],
+    )
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x00" * 5,
+        build_dns_query("a.test")[:-2],
+        reply(build_dns_query("a.test"), [answer(b"\xc0\x0c", QTYPE_A, b"\x01")]),
+        reply(build_dns_query("a.test"), [answer(b"\xc0\x0c", QTYPE_A, b"")])[:-4],
+        reply(build_dns_query("a.test"), [b""]),  # 说有一条answer 其实没有
+    ],
+)
+def test_malformed_packets(data):
+    with pytest.raises(DNSLookupError, match="Malformed"):
+        parse_dns_response(data)
+
+
+def test_a_and_aaaa(run):
+    async def main():
+        async with serve(doh_app(addresses)) as url:
+            res = make_resolver(
+                url + "/dns-query", families=(socket.AF_INET, socket.AF_INET6)
+            )
+            try:
+                return await res.resolve_all("a.test")
+            finally:
+                await close(res)
+
+    assert run(main()) == ["10.0.0.1", "2001:db8::1"]
+
+
+def test_cname_chain(run):
+    async def main():
+        async with serve(doh_app(lambda query, *_: cname_chain(query))) as url:
+            res = make_resolver(url + "/dns-query")
+            try:
+                result = await res.resolve_all("a.test")
+            finally:
+                await close(res)
+        return result, res._cache.peek("a.test").ttl
+
+    assert run(main()) == (["10.0.0.3"], 60)
+
+
+def test_nxdomain_is_cached(run):
+    seen = []
+
+    async def main():
+        app = doh_app(lambda query, *_: reply(query, rcode=3), seen)
+        async with serve(app) as url:
+            res = make_resolver(url + "/dns-query")
+            try:
+                for _ in range(2):
+                    with pytest.raises(DNSNameError):
+                        await res.resolve_all("missing.test")
+            finally:
+                await close(res)
+
+    run(main())
+    assert seen == [("missing.test", QTYPE_A)]  # 第二次是负缓存挡下来的
+
+
+@pytest.mark.parametrize(
+    "broken",
+    [
+        lambda query, *_: reply(query, rcode=2),  # SERVFAIL
+        lambda query, *_: reply(query)[:-3],  # 报文被截断
+        lambda query, *_: web.Response(status=502),
+    ],
+)
+def test_failover_to_next_endpoint(run, broken):
+    async def main():
+        async with serve(doh_app(broken)) as bad, serve(doh_app(addresses)) as good:
+            res = make_resolver(bad + "/dns-query", good + "/dns-query")
+            try:
+                return await res.resolve_all("a.test")
+            finally:
+                await close(res)
+
+    assert run(main()) == ["10.0.0.1"]
+
+
+def test_http2_multiplexing(run, tmp_path, monkeypatch):
+    """真的走tls+h2 所有查询复用一条连接"""
+    trustme = pytest.importorskip("trustme")
+    hypercorn_asyncio = pytest.importorskip("hypercorn.asyncio")
+    from hypercorn.config import Config
+
+    ca = trustme.CA()
+    cert = ca.issue_cert("127.0.0.1")
+    cert.private_key_and_cert_chain_pem.write_to_path(str(tmp_path / "server.pem"))
+    ca.cert_pem.write_to_path(str(tmp_path / "ca.pem"))
+    monkeypatch.setenv("SSL_CERT_FILE", str(tmp_path / "ca.pem"))
+
+    seen = []
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        query = b""
+        while True:
+            message = await receive()
+            query += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        seen.append((scope["http_version"], scope["client"]))
+        await asyncio.sleep(0.05)  # 让查询在连接上重叠
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/dns-message")],
+            }
+        )
+        await send(
+            {
+                "type": "http.response.body",
+                "body": addresses(query, *read_question(query)),
+            }
+        )
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.certfile = config.keyfile = str(tmp_path / "server.pem")
+    config.alpn_protocols = ["h2"]
+
+    async def main():
+        stop = asyncio.Event()
+        server = asyncio.ensure_future(
+            hypercorn_asyncio.serve(app, config, shutdown_trigger=stop.wait)
+        )
+        for _ in range(100):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+            except OSError:
+                await asyncio.sleep(0.02)
+                continue
+            writer.close()
+            break
+        res = make_resolver(f"https://127.0.0.1:{port}/dns-query")
+        try:
+            return await asyncio.gather(
+                *[res.resolve_all(f"host{i}.test") for i in range(10)]
+            )
+        finally:
+            await close(res)
+            stop.set()
+            await server
+
+    assert run(main()) == [["10.0.0.1"]] * 10
+    assert len(seen) == 10
+    assert {version for version, _ in seen} == {"2"}
+    assert len({client for _, client in seen}) == 1
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+
+from benchmarks.tlsproxy_stub import make_app
+from conftest import serve, stub_args
+from downloadhandlers.router import RouterDownloadHandler
+from downloadhandlers.sessions import get_session_registry
+
+
+def test_tlsproxy_without_tls_meta(run):
+    """只写了download_backend 没有meta['tls']的请求也能走tlsproxy"""
+
+    async def main():
+        async with serve(make_app(stub_args(body_size=5))) as url:
+            crawler = get_crawler(settings_dict={"TLSPROXY": f"{url}/request"})
+            crawler._apply_settings()
+            handler = RouterDownloadHandler(crawler)
+            try:
+                request = Request(
+                    "http://example.com/", meta={"download_backend": "tlsproxy"}
+                )
+                response = await handler.download_request(request)
+            finally:
+                await handler.close()
+                await get_session_registry(crawler).close()
+        assert response.status == 200
+        assert response.body == b"xxxxx"
+        assert "tls" in response.flags
+
+    run(main())
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import gc
+
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from downloadhandlers import timing
+
+
+def test_domain_label():
+    """前MAX_DOMAINS个域名单独记 每个crawler各算各的"""
+    settings = {"DOWNLOAD_PHASE_STATS_MAX_DOMAINS": 1}
+    crawler = get_crawler(settings_dict=settings)
+    other = get_crawler(settings_dict=settings)
+    assert timing._domain_label(crawler, "a.test") == "a.test"
+    assert timing._domain_label(crawler, "b.test") == "other"
+    assert timing._domain_label(crawler, "a.test") == "a.test"
+    assert timing._domain_label(other, "b.test") == "b.test"
+    assert not hasattr(crawler, "_phase_stats_domains")
+
+
+def test_domain_label_released():
+    """crawler没了域名表跟着释放 真的crawler会被日志记录拿住 这里用个替身"""
+
+    class Crawler:
+        settings = Settings()
+
+    crawler = Crawler()
+    timing._domain_label(crawler, "a.test")
+    assert crawler in timing._domains
+    del crawler
+    gc.collect()
+    assert not any(isinstance(key, Crawler) for key in timing._domains)
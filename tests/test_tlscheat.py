@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import pytest
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+
+from downloadhandlers import tlscheat
+
+
+class FakeComandy:
+    def __init__(self, path):
+        self.payloads = []
+
+    def request(self, payload):
+        self.payloads.append(payload)
+        return {"status": 200, "headers": {}, "data": "ok"}
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.setattr(tlscheat, "Comandy", FakeComandy)
+    crawler = get_crawler()
+    crawler._apply_settings()
+    handler = tlscheat.TLSCheatDownloadHandler(crawler)
+    handler.engine_started(None, None)
+    yield handler
+    handler.executor.shutdown()
+
+
+def test_text_body(run, handler):
+    request = Request(
+        "http://example.com/", method="POST", body="你好", meta={"tls": {}}
+    )
+    response = run(handler.download_request(request))
+    assert response.body == b"ok"
+    assert handler.comandy.payloads[0]["data"] == "你好"
+
+
+def test_binary_body_is_rejected(run, handler):
+    request = Request(
+        "http://example.com/", method="POST", body=b"\xff\x00", meta={"tls": {}}
+    )
+    with pytest.raises(ValueError, match="utf-8"):
+        run(handler.download_request(request))
+    assert handler.comandy.payloads == []
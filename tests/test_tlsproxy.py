@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""FramedTLSProxyClient对着benchmarks.tlsproxy_stub测"""
+import asyncio
+
+import aiohttp
+import pytest
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+
+from benchmarks.tlsproxy_stub import make_app
+from conftest import serve, stub_args
+from downloadhandlers.body import DownloadCancelledError, check_size
+from downloadhandlers.tlsproxy import FramedTLSProxyClient
+
+
+async def framed(app, coro):
+    """起stub 连上ws 跑coro(client)"""
+    async with serve(app) as url:
+        async with aiohttp.ClientSession() as session:
+            client = FramedTLSProxyClient(session, url.replace("http", "ws") + "/ws")
+            try:
+                return await coro(client)
+            finally:
+                await client.close()
+
+
+def test_single_frame(run):
+    async def main(client):
+        return await client.request({"url": "http://example.com/?size=10"}, b"")
+
+    meta, body = run(framed(make_app(stub_args()), main))
+    assert meta["status"] == 200
+    assert meta["more"] is False
+    assert body == b"x" * 10
+
+
+def test_multi_frame_body(run):
+    async def main(client):
+        sizes = []
+
+        def check(size, expected):
+            sizes.append((size, expected))
+
+        result = await client.request(
+            {"url": "http://example.com/?size=10"}, b"", check
+        )
+        return result, sizes
+
+    (meta, body), sizes = run(framed(make_app(stub_args(chunk_size=4)), main))
+    assert meta["more"] is True
+    assert meta["length"] == 10
+    assert body == b"x" * 10
+    assert sizes == [(10, True), (4, False), (8, False), (10, False)]
+
+
+def test_maxsize_cancels_stream(run):
+    """超过DOWNLOAD_MAXSIZE 客户端发FRAME_CANCEL stub不再往下发"""
+    cancelled = []
+    app = make_app(stub_args(chunk_size=4, chunk_delay=0.05), cancelled)
+    settings = get_crawler(settings_dict={"DOWNLOAD_MAXSIZE": 6}).settings
+    request = Request("http://example.com/?size=100")
+
+    async def main(client):
+        with pytest.raises(DownloadCancelledError):
+            await client.request(
+                {"url": request.url},
+                b"",
+                lambda size, expected: check_size(
+                    request, settings, size, expected, warn=False
+                ),
+            )
+        for _ in range(50):
+            if cancelled:
+                break
+            await asyncio.sleep(0.01)
+        # 连接还能接着用
+        return await client.request({"url": "http://example.com/?size=3"}, b"")
+
+    _, body = run(framed(app, main))
+    assert cancelled == [1]
+    assert body == b"xxx"
+
+
+def test_connection_lost_fails_pending(run):
+    """ws断了 在等的请求全部失败 下一个请求重新连"""
+
+    async def main(client):
+        tasks = [
+            asyncio.ensure_future(
+                client.request({"url": "http://example.com/?size=1"}, b"")
+            )
+            for _ in range(3)
+        ]
+        while len(client._pending) < 3:
+            await asyncio.sleep(0.01)
+        client._ws._response.connection.transport.abort()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        _, body = await client.request({"url": "http://example.com/?size=2"}, b"")
+        return results, body
+
+    results, body = run(framed(make_app(stub_args(delay=0.5)), main))
+    assert [type(e) for e in results] == [ConnectionError] * 3
+    assert body == b"xx"